@@ -0,0 +1,105 @@
+"""Structured access log and slow-request sampler.
+
+Every request is written as one JSON line (event "access") with its request
+id, client, status, duration and sizes; /watermark adds input and output
+dimensions, bytes and formats, stage timings and cache hits and misses.
+Requests slower than WATERMARK_SLOW_REQUEST_MS also get a fuller record
+(event "slow_request") with the watermark config, every stage with the size
+and mode of the images it produced, and memory figures. The slowest of
+those are kept for the /metrics endpoint.
+"""
+import heapq
+import os
+import re
+import threading
+import time
+import uuid
+
+import memory_stats
+from profiling import get_json_logger, log_event
+
+ACCESS_LOG_ENABLED = os.environ.get('WATERMARK_ACCESS_LOG', 'true').lower() in ('1', 'true', 'yes')
+# 0 disables the slow-request records
+SLOW_REQUEST_MS = float(os.environ.get('WATERMARK_SLOW_REQUEST_MS', '2000'))
+SLOW_REQUESTS_KEPT = int(os.environ.get('WATERMARK_SLOW_REQUESTS', '10'))
+
+# Caller-supplied request ids are echoed into logs, so keep them tame
+_REQUEST_ID = re.compile(r'[A-Za-z0-9._:-]{1,128}')
+
+logger = get_json_logger('watermark.access')
+
+_lock = threading.Lock()
+_slowest = []  # min-heap of (duration_ms, sequence, record)
+_sequence = 0
+_slow_requests = 0
+
+
+def request_id(supplied=None):
+    """The caller's X-Request-ID when it is reasonable, otherwise a new one"""
+    if supplied and _REQUEST_ID.fullmatch(supplied):
+        return supplied
+    return uuid.uuid4().hex
+
+
+def stage_timings(recorder):
+    """Milliseconds per stage name (repeated stages are summed)"""
+    timings = {}
+    for s in recorder.stages:
+        timings[s.name] = round(timings.get(s.name, 0) + s.elapsed_ms, 3)
+    return timings
+
+
+def cache_outcomes(delta):
+    """Hits and misses from a cache delta, leaving out caches that were not used"""
+    return {name: {'hits': c['hits'], 'misses': c['misses']}
+            for name, c in delta.items() if c['hits'] or c['misses']}
+
+
+def _diagnostic_record(record, recorder, details):
+    """The slow-request record: the access fields plus what explains the time"""
+    full = dict(record, **details)
+    if recorder is not None:
+        stages = memory_stats.summarize_stages(recorder)
+        python_peak = max((s['python_peak_bytes'] for s in stages), default=0)
+        full['stages'] = recorder.to_dict()['stages']
+        # Every image a stage produced, in order: where modes change and sizes grow
+        full['images'] = [dict(image, stage=s.name) for s in recorder.stages for image in s.images]
+        full['memory'] = {
+            # Upper bound, as for sampled requests; Python allocations only when tracked
+            'peak_bytes': sum(s['image_bytes'] for s in stages) + python_peak,
+            'python_peak_bytes': python_peak if recorder.track_allocations else None,
+            'rss_bytes': memory_stats.current_rss_bytes(),
+            'peak_rss_bytes': memory_stats.peak_rss_bytes()
+        }
+    return full
+
+
+def finish(record, started, recorder=None, details=None):
+    """Log a finished request, and keep it if it was slow"""
+    global _sequence, _slow_requests
+    record['duration_ms'] = round((time.perf_counter() - started) * 1000, 3)
+    if ACCESS_LOG_ENABLED:
+        log_event(logger, 'access', **record)
+    if not SLOW_REQUEST_MS or record['duration_ms'] < SLOW_REQUEST_MS:
+        return
+
+    full = _diagnostic_record(record, recorder, details or {})
+    with _lock:
+        _slow_requests += 1
+        _sequence += 1
+        entry = (record['duration_ms'], _sequence, full)
+        if len(_slowest) < SLOW_REQUESTS_KEPT:
+            heapq.heappush(_slowest, entry)
+        elif entry[0] > _slowest[0][0]:
+            heapq.heapreplace(_slowest, entry)
+    log_event(logger, 'slow_request', **full)
+
+
+def snapshot():
+    """Slow-request count and the slowest records for the /metrics endpoint"""
+    with _lock:
+        return {
+            'threshold_ms': SLOW_REQUEST_MS,
+            'slow_requests': _slow_requests,
+            'slowest': [entry[2] for entry in sorted(_slowest, reverse=True)]
+        }
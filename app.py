@@ -1,10 +1,35 @@
-from flask import Flask, request, jsonify
-from PIL import Image, ImageDraw, ImageFont
+import time
+_IMPORT_STARTED = time.monotonic()
+
+from flask import Flask, Response, g, has_request_context, request, jsonify
+from PIL import Image, ImageDraw, ImageFilter, ImageFont, ImageSequence, UnidentifiedImageError
 import io
 import base64
+import hashlib
+import json
 import os
 import glob
+import importlib
+import itertools
+import math
+import mmap
+import queue
+import string
+import tempfile
+import threading
+import traceback
+import uuid
 from datetime import datetime
+from collections import namedtuple
+from contextlib import ExitStack, contextmanager
+from functools import lru_cache, partial
+
+import access_log
+import buffer_pool
+import memory_stats
+import render_pool
+import webhooks
+from profiling import StageRecorder, log_event, profile_call, record_stages, stage
 
 app = Flask(__name__)
 
@@ -18,8 +43,140 @@ DEFAULT_CONFIG = {
     'transparency': 1.0  # Full opacity
 }
 
+# "shadow" / "glow" style options; true uses these, an object overrides them
+TEXT_EFFECT_DEFAULTS = {
+    'shadow': {'color': '#000000', 'opacity': 0.6, 'offset': [2, 2], 'blur': 2, 'spread': 0},
+    'glow': {'color': '#000000', 'opacity': 0.8, 'offset': [0, 0], 'blur': 3, 'spread': 2}
+}
+# Bounds blur and spread (and so the sprite's growth and filter cost)
+MAX_EFFECT_RADIUS = 20
+
+# font_color / stroke_color "auto" picks from this palette (or "color_palette")
+AUTO_COLOR_PALETTE = [c.strip() for c in os.environ.get(
+    'WATERMARK_AUTO_PALETTE', '#FFFFFF,#000000').split(',') if c.strip()]
+MAX_PALETTE_COLORS = 16
+# Longest side, in samples, of the luminance probe taken inside a text box
+AUTO_COLOR_PROBE_SIZE = 48
+
+# Per-request debug output (debug_timings / debug_profile) is only honoured
+# when the deployment opts in, so it can never be switched on from outside
+DEBUG_TIMINGS_ENABLED = os.environ.get('WATERMARK_DEBUG_TIMINGS', 'false').lower() in ('1', 'true', 'yes')
+DEBUG_PROFILE_ENABLED = os.environ.get('WATERMARK_DEBUG_PROFILE', 'false').lower() in ('1', 'true', 'yes')
+
+# Largest image whose tiled pattern overlay is kept in memory for reuse
+# (two are kept, so at most 4 bytes x 2 x this much)
+PATTERN_OVERLAY_CACHE_MAX_PIXELS = int(os.environ.get('WATERMARK_PATTERN_CACHE_MAX_PIXELS', 8_000_000))
+# Largest text sprite (or pattern tile, or logo variant) kept in the sprite
+# caches; bigger ones are rendered per request, so 256 cached sprites stay
+# under ~100MB
+SPRITE_CACHE_MAX_PIXELS = int(os.environ.get('WATERMARK_SPRITE_CACHE_MAX_PIXELS', 100_000))
+MAX_FONT_SIZE = int(os.environ.get('WATERMARK_MAX_FONT_SIZE', 1000))
+MAX_STROKE_WIDTH = int(os.environ.get('WATERMARK_MAX_STROKE_WIDTH', 100))
+
+# Logos registered by name (POST /logos or PNG files in this directory)
+LOGO_DIR = os.environ.get('WATERMARK_LOGO_DIR')
+MAX_LOGO_PIXELS = int(os.environ.get('WATERMARK_MAX_LOGO_PIXELS', 16_000_000))
+
+# Animated GIF/WebP/APNG input is kept animated for these output formats
+ANIMATED_FORMATS = ('GIF', 'WEBP', 'PNG')
+MAX_ANIMATION_FRAMES = int(os.environ.get('WATERMARK_MAX_ANIMATION_FRAMES', 1000))
+# Every frame is decoded to RGBA at once, so frames x width x height is
+# bounded too (4 bytes a pixel, about twice over while compositing)
+MAX_ANIMATION_PIXELS = int(os.environ.get('WATERMARK_MAX_ANIMATION_PIXELS', 50_000_000))
+ANIMATION_WORKERS = int(os.environ.get('WATERMARK_ANIMATION_WORKERS', min(4, os.cpu_count() or 1)))
+_animation_executor = None
+_animation_lock = threading.Lock()
+
+# Modes each output format can store; others are converted to RGB(A) first
+SAVE_MODES = {
+    'JPEG': ('L', 'RGB', 'CMYK'),
+    'PNG': ('1', 'L', 'LA', 'I', 'I;16', 'P', 'RGB', 'RGBA'),
+    'WEBP': ('RGB', 'RGBA'),
+    'BMP': ('1', 'L', 'P', 'RGB', 'RGBA')
+}
+
+# Images at or above this size are watermarked in place, strip by strip
+LARGE_IMAGE_PIXELS = int(os.environ.get('WATERMARK_LARGE_IMAGE_PIXELS', 40_000_000))
+LARGE_IMAGE_STRIP_HEIGHT = int(os.environ.get('WATERMARK_STRIP_HEIGHT', 1024))
+
+# Pillow's decompression-bomb limit; raise it for print-resolution inputs
+if os.environ.get('WATERMARK_MAX_IMAGE_PIXELS'):
+    Image.MAX_IMAGE_PIXELS = int(os.environ['WATERMARK_MAX_IMAGE_PIXELS']) or None
+
+# POST /watermark/stream: items processed at once (shared by all streams),
+# and items read ahead per stream before their results have been written
+STREAM_WORKERS = int(os.environ.get('WATERMARK_STREAM_WORKERS', min(4, os.cpu_count() or 1)))
+STREAM_WINDOW = int(os.environ.get('WATERMARK_STREAM_WINDOW', 2 * STREAM_WORKERS))
+_stream_executor = None
+_stream_lock = threading.Lock()
+
+# Invisible forensic mark (the id_code in the DCT domain) for every request
+# unless it sends "forensic": false; off by default
+FORENSIC_DEFAULT = os.environ.get('WATERMARK_FORENSIC', 'false').lower() in ('1', 'true', 'yes')
+# Palette (GIF) and animated outputs cannot carry it
+FORENSIC_FORMATS = ('JPEG', 'PNG', 'WEBP', 'TIFF', 'BMP')
+VERIFY_MAX_ITEMS = int(os.environ.get('WATERMARK_VERIFY_MAX_ITEMS', 100))
+
+# POST /layout decodes this much of a base64 image first, growing as needed
+HEADER_PROBE_BYTES = 64 * 1024
+
+# Requests with a callback_url run in the background on this many threads
+JOB_WORKERS = int(os.environ.get('WATERMARK_JOB_WORKERS', min(4, os.cpu_count() or 1)))
+_job_executor = None
+_job_lock = threading.Lock()
+
+# Renders run in child processes when WATERMARK_RENDER_PROCESSES is set
+# (see render_pool.py); the pool starts during warm-up
+_render_processes = None
+_render_lock = threading.Lock()
+
+# Requests may read input_path / write output_path only inside this directory
+SHARED_ROOT = os.path.realpath(os.environ['WATERMARK_SHARED_ROOT']) if os.environ.get('WATERMARK_SHARED_ROOT') else None
+
+# Named style presets (POST /presets or a JSON file of name -> preset)
+PRESETS_FILE = os.environ.get('WATERMARK_PRESETS_FILE')
+
+# Image formats we decode and encode; only these Pillow plugins are loaded
+# ('*' accepts every format Pillow knows, at the cost of loading them all)
+IMAGE_FORMATS = os.environ.get('WATERMARK_IMAGE_FORMATS', 'JPEG,MPO,PNG,WEBP,GIF,TIFF,BMP')
+IMAGE_FORMATS = None if IMAGE_FORMATS.strip() == '*' else tuple(
+    f.strip().upper() for f in IMAGE_FORMATS.split(',') if f.strip())
+PILLOW_PLUGINS = {
+    'JPEG': 'JpegImagePlugin', 'MPO': 'MpoImagePlugin', 'PNG': 'PngImagePlugin',
+    'WEBP': 'WebPImagePlugin', 'GIF': 'GifImagePlugin', 'TIFF': 'TiffImagePlugin',
+    'BMP': 'BmpImagePlugin', 'JPEG2000': 'Jpeg2KImagePlugin', 'ICO': 'IcoImagePlugin',
+    'PPM': 'PpmImagePlugin', 'TGA': 'TgaImagePlugin', 'PSD': 'PsdImagePlugin'
+}
+
+# Fonts loaded during warm-up, before /ready reports ready
+PREWARM_FONTS = [f.strip() for f in os.environ.get(
+    'WATERMARK_PREWARM_FONTS', 'DejaVuSans-Bold.ttf,DejaVuSans.ttf').split(',') if f.strip()]
+PREWARM_FONT_SIZES = [int(s) for s in os.environ.get(
+    'WATERMARK_PREWARM_FONT_SIZES', '14,16,18,20,24,28,32,36,48').split(',') if s.strip()]
+
+# Compositing engine: 'pillow' (full-frame overlays) or 'numpy' (region blends)
+RENDER_ENGINE = os.environ.get('WATERMARK_ENGINE', 'pillow').lower()
+
+def _is_truthy(value):
+    """Interpret a JSON flag or header value as a boolean"""
+    if isinstance(value, str):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+def invalid_image(e):
+    """Error text for an undecodable input, the same in any process.
+    
+    Pillow names the file object it failed on, and its repr (a BytesIO or
+    a render process's shared memory reader, with an address) means nothing
+    to the caller.
+    """
+    if isinstance(e, UnidentifiedImageError):
+        return 'Invalid image data: cannot identify image file'
+    return f'Invalid image data: {str(e)}'
+
+@lru_cache(maxsize=1)
 def get_system_fonts():
-    """Get all available system fonts"""
+    """Get all available system fonts (scanned once per process)"""
     font_paths = []
     font_dirs = [
         "/usr/share/fonts/",           # Linux/Ubuntu
@@ -40,6 +197,7 @@ def get_system_fonts():
     
     return fonts
 
+@lru_cache(maxsize=128)
 def load_font(font_name, size):
     """Load font with automatic system font detection"""
     available_fonts = get_system_fonts()
@@ -77,6 +235,31 @@ def load_font(font_name, size):
     # Ultimate fallback
     return ImageFont.load_default()
 
+# Caches reported in debug output; each entry exposes functools' cache_info()
+CACHES = {
+    'system_fonts': get_system_fonts,
+    'fonts': load_font
+}
+
+def cache_snapshot():
+    """Current hit/miss counters for every registered cache"""
+    snapshot = {}
+    for name, cached in CACHES.items():
+        info = cached.cache_info()
+        snapshot[name] = {'hits': info.hits, 'misses': info.misses, 'size': info.currsize}
+    return snapshot
+
+def cache_delta(before, after):
+    """Hits and misses recorded between two cache snapshots"""
+    return {
+        name: {
+            'hits': after[name]['hits'] - before.get(name, {}).get('hits', 0),
+            'misses': after[name]['misses'] - before.get(name, {}).get('misses', 0),
+            'size': after[name]['size']
+        }
+        for name in after
+    }
+
 def hex_to_rgba(hex_color, alpha=255):
     """Convert hex color to RGBA tuple"""
     if hex_color.startswith('#'):
@@ -86,165 +269,1245 @@ def hex_to_rgba(hex_color, alpha=255):
         return (r, g, b, alpha)
     return (255, 255, 255, alpha)  # Default white
 
+def _linear(value):
+    """sRGB channel value (0-255) in linear light"""
+    c = value / 255
+    return c / 12.92 if c <= 0.04045 else ((c + 0.055) / 1.055) ** 2.4
+
+_LINEAR = [_linear(v) for v in range(256)]
+
+def relative_luminance(color):
+    """WCAG relative luminance of an RGB(A) color, from 0 (black) to 1 (white)"""
+    r, g, b = color[:3]
+    return 0.2126 * _LINEAR[r] + 0.7152 * _LINEAR[g] + 0.0722 * _LINEAR[b]
+
+def contrast_ratio(a, b):
+    """WCAG contrast ratio of two relative luminances, from 1 to 21"""
+    return (max(a, b) + 0.05) / (min(a, b) + 0.05)
+
+def most_contrasting(palette, color):
+    """The palette color that stands out most against color"""
+    luminance = relative_luminance(color)
+    return max(palette, key=lambda c: contrast_ratio(relative_luminance(c), luminance))
+
+def pick_contrasting(palette, histogram):
+    """The palette color most legible on a background, given its luma histogram.
+    
+    Scored by the contrast reached against all but the worst 10% of the
+    background (so a few highlights do not decide it), then by the mean.
+    """
+    total = sum(histogram)
+    best, best_score = palette[0], None
+    for color in palette:
+        luminance = relative_luminance(color)
+        ratios = sorted((contrast_ratio(luminance, _LINEAR[v]), count)
+                        for v, count in enumerate(histogram) if count)
+        seen = 0
+        for ratio, count in ratios:
+            seen += count
+            if seen >= total * 0.1:
+                break
+        score = (ratio, sum(r * c for r, c in ratios) / total)
+        if best_score is None or score > best_score:
+            best, best_score = color, score
+    return best
+
+def _parse_palette(value):
+    """Validated tuple of RGBA colors for "auto" text colors"""
+    if value is None:
+        value = AUTO_COLOR_PALETTE
+    if not isinstance(value, (list, tuple)) or not 1 <= len(value) <= MAX_PALETTE_COLORS:
+        raise ValueError(f'color_palette must be a list of 1 to {MAX_PALETTE_COLORS} colors, got {value!r}')
+    return tuple(_parse_color(c, 'color_palette') for c in value)
+
+# Named positions as (horizontal, vertical) anchors
+NAMED_POSITIONS = {
+    'top-left': ('start', 'start'),
+    'top-center': ('center', 'start'),
+    'top-right': ('end', 'start'),
+    'center-left': ('start', 'center'),
+    'center': ('center', 'center'),
+    'center-right': ('end', 'center'),
+    'bottom-left': ('start', 'end'),
+    'bottom-center': ('center', 'end'),
+    'bottom-right': ('end', 'end')
+}
+
+def _length_rule(value, name):
+    """(amount, is_percent) from a pixel number or a 'N%' string"""
+    try:
+        if isinstance(value, str) and value.endswith('%'):
+            return (float(value[:-1]) / 100, True)
+        return (int(value), False)
+    except (TypeError, ValueError):
+        raise ValueError(f'{name} must be a number of pixels or a percentage like "5%", got {value!r}')
+
+def _resolve_length(rule, reference):
+    """Pixel length from a compiled length rule and the reference length"""
+    amount, is_percent = rule
+    return int(amount * reference) if is_percent else amount
+
+def _edge_rule(position_config, start, end):
+    """(edge, length rule) for the first of two opposite edges that is set"""
+    for edge in (start, end):
+        if edge in position_config:
+            return (edge, _length_rule(position_config[edge], edge))
+    return None
+
+def _parse_color(value, name):
+    """Validated RGBA tuple from '#RRGGBB', '#RGB' or a list of 3-4 channels"""
+    if isinstance(value, str):
+        hex_color = value[1:] if value.startswith('#') else value
+        if len(hex_color) == 3:
+            hex_color = ''.join(c * 2 for c in hex_color)
+        if len(hex_color) == 6 and all(c in string.hexdigits for c in hex_color):
+            return hex_to_rgba(hex_color, 255)  # Full opacity, transparency applied later
+    elif (isinstance(value, (list, tuple)) and len(value) in (3, 4) and
+          all(isinstance(c, int) and 0 <= c <= 255 for c in value)):
+        return tuple(value) + (255,) * (4 - len(value))
+    raise ValueError(f'{name} must be a hex color like "#FF6B35", got {value!r}')
+
+def _number(value, name, minimum=None, maximum=None):
+    """Validated number within optional bounds"""
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        raise ValueError(f'{name} must be a number, got {value!r}')
+    if minimum is not None and value < minimum:
+        raise ValueError(f'{name} must be at least {minimum}, got {value!r}')
+    if maximum is not None and value > maximum:
+        raise ValueError(f'{name} must be at most {maximum}, got {value!r}')
+    return value
+
+def _integer(value, name, minimum=None, maximum=None):
+    """Validated whole number within optional bounds (2.0 is accepted as 2)"""
+    value = _number(value, name, minimum, maximum)
+    if value != int(value):
+        raise ValueError(f'{name} must be a whole number, got {value!r}')
+    return int(value)
+
+class _Frozen:
+    """Immutable __slots__ object, compared and hashed by its key.
+    
+    The hash is derived from a digest of the key, so unlike hash() of
+    strings it is the same in every worker process.
+    """
+    __slots__ = ('key', '_hash')
+    
+    def _freeze(self, key, **fields):
+        for name, value in fields.items():
+            object.__setattr__(self, name, value)
+        object.__setattr__(self, 'key', key)
+        digest = hashlib.sha1(repr(key).encode('utf-8')).digest()
+        object.__setattr__(self, '_hash', int.from_bytes(digest[:8], 'big'))
+    
+    @property
+    def digest(self):
+        """Stable hex id, usable in logs and cross-process cache keys"""
+        return f'{self._hash:016x}'
+    
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+    
+    def __eq__(self, other):
+        return type(other) is type(self) and other.key == self.key
+    
+    def __hash__(self):
+        return self._hash
+    
+    def __repr__(self):
+        return f'{type(self).__name__}({self.key!r})'
+
+class PositionRule(_Frozen):
+    """Compiled position: a named anchor, or left/right and top/bottom offsets"""
+    __slots__ = ('anchors', 'horizontal', 'vertical', 'margin')
+    
+    def __init__(self, position_config, margin=20):
+        margin = _number(margin, 'margin')
+        if isinstance(position_config, dict):
+            anchors = None
+            horizontal = _edge_rule(position_config, 'left', 'right')
+            vertical = _edge_rule(position_config, 'top', 'bottom')
+        else:
+            # Unknown names fall back to bottom-right
+            anchors = NAMED_POSITIONS.get(position_config, NAMED_POSITIONS['bottom-right'])
+            horizontal = vertical = None
+        self._freeze((anchors, horizontal, vertical, margin), anchors=anchors,
+                     horizontal=horizontal, vertical=vertical, margin=margin)
+    
+    def _axis(self, anchor, edge, extent, size):
+        if self.anchors is not None:
+            if anchor == 'start':
+                return self.margin
+            if anchor == 'center':
+                return (extent - size) // 2
+            return extent - size - self.margin
+        if edge is None:
+            return self.margin
+        name, rule = edge
+        offset = _resolve_length(rule, extent)
+        return offset if name in ('left', 'top') else extent - offset - size
+    
+    def resolve(self, img_size, item_size):
+        """Top-left (x, y) of an item of item_size on an image of img_size"""
+        anchors = self.anchors or (None, None)
+        return (self._axis(anchors[0], self.horizontal, img_size[0], item_size[0]),
+                self._axis(anchors[1], self.vertical, img_size[1], item_size[1]))
+
 def parse_position(position_config, img_size, text_size, margin=20):
     """Parse position - supports both named positions and percentage positioning"""
-    img_width, img_height = img_size
-    text_width, text_height = text_size
+    return PositionRule(position_config, margin).resolve(img_size, text_size)
+
+class TextEffect(_Frozen):
+    """A blurred, offset copy of the text's silhouette drawn under it (shadow or glow)"""
+    __slots__ = ('color', 'opacity', 'offset', 'blur', 'spread')
     
-    # Handle percentage positioning
-    if isinstance(position_config, dict):
-        x = margin
-        y = margin
-        
-        # Parse left/right positioning
-        if 'left' in position_config:
-            if isinstance(position_config['left'], str) and position_config['left'].endswith('%'):
-                x = int((float(position_config['left'][:-1]) / 100) * img_width)
-            else:
-                x = int(position_config['left'])
-        elif 'right' in position_config:
-            if isinstance(position_config['right'], str) and position_config['right'].endswith('%'):
-                x = img_width - int((float(position_config['right'][:-1]) / 100) * img_width) - text_width
-            else:
-                x = img_width - int(position_config['right']) - text_width
-        
-        # Parse top/bottom positioning
-        if 'top' in position_config:
-            if isinstance(position_config['top'], str) and position_config['top'].endswith('%'):
-                y = int((float(position_config['top'][:-1]) / 100) * img_height)
-            else:
-                y = int(position_config['top'])
-        elif 'bottom' in position_config:
-            if isinstance(position_config['bottom'], str) and position_config['bottom'].endswith('%'):
-                y = img_height - int((float(position_config['bottom'][:-1]) / 100) * img_height) - text_height
-            else:
-                y = img_height - int(position_config['bottom']) - text_height
-        
-        return (x, y)
-    
-    # Handle named positions (existing functionality)
-    positions = {
-        'top-left': (margin, margin),
-        'top-center': ((img_width - text_width) // 2, margin),
-        'top-right': (img_width - text_width - margin, margin),
-        'center-left': (margin, (img_height - text_height) // 2),
-        'center': ((img_width - text_width) // 2, (img_height - text_height) // 2),
-        'center-right': (img_width - text_width - margin, (img_height - text_height) // 2),
-        'bottom-left': (margin, img_height - text_height - margin),
-        'bottom-center': ((img_width - text_width) // 2, img_height - text_height - margin),
-        'bottom-right': (img_width - text_width - margin, img_height - text_height - margin)
-    }
+    def __init__(self, value, name):
+        if value is True:
+            value = {}
+        if not isinstance(value, dict):
+            raise ValueError(f'{name} must be true or an object like {{"blur": 3, "offset": [2, 2]}}')
+        options = dict(TEXT_EFFECT_DEFAULTS[name], **value)
+        color = _parse_color(options['color'], f'{name} color')
+        opacity = float(_number(options['opacity'], f'{name} opacity', minimum=0, maximum=1))
+        offset = options['offset']
+        if isinstance(offset, (int, float)) and not isinstance(offset, bool):
+            offset = [offset, offset]
+        if not isinstance(offset, (list, tuple)) or len(offset) != 2:
+            raise ValueError(f'{name} offset must be a number or [x, y], got {offset!r}')
+        offset = tuple(round(_number(o, f'{name} offset', -MAX_EFFECT_RADIUS, MAX_EFFECT_RADIUS))
+                       for o in offset)
+        blur = float(_number(options['blur'], f'{name} blur', minimum=0, maximum=MAX_EFFECT_RADIUS))
+        spread = round(_number(options['spread'], f'{name} spread', minimum=0, maximum=MAX_EFFECT_RADIUS))
+        self._freeze((color, opacity, offset, blur, spread), color=color, opacity=opacity,
+                     offset=offset, blur=blur, spread=spread)
     
-    return positions.get(position_config, positions['bottom-right'])
+    @property
+    def reach(self):
+        """How far the effect extends beyond the (offset) text silhouette"""
+        return self.spread + math.ceil(self.blur * 3)
 
-def create_text_overlay(text, position_config, img_size, config):
-    """Create a transparent text overlay that can be blended with main image"""
-    img_width, img_height = img_size
+class TextStyle(_Frozen):
+    """Validated text style with its font already loaded.
     
-    # Get configuration
-    font_size = config.get('font_size', DEFAULT_CONFIG['font_size'])
-    font_name = config.get('font', 'DejaVuSans-Bold.ttf')
-    margin = config.get('margin', DEFAULT_CONFIG['margin'])
-    transparency = config.get('transparency', DEFAULT_CONFIG['transparency'])
+    A font_color or stroke_color of "auto" is listed in auto and chosen per
+    image from palette (resolve_auto_colors). Until then the style holds
+    the palette's first color, and the stroke that contrasts most with it.
+    """
+    __slots__ = ('font_name', 'font_size', 'font_color', 'stroke_color', 'stroke_width',
+                 'transparency', 'effects', 'auto', 'palette', 'font')
     
-    # Handle colors - full opacity for the overlay, transparency applied later
-    font_color = config.get('font_color', '#FFFFFF')
-    if isinstance(font_color, str):
-        font_color = hex_to_rgba(font_color, 255)  # Full opacity initially
+    def __init__(self, config):
+        font_name = config.get('font', 'DejaVuSans-Bold.ttf')
+        if not isinstance(font_name, str):
+            raise ValueError(f'font must be a font file name, got {font_name!r}')
+        font_size = _number(config.get('font_size', DEFAULT_CONFIG['font_size']), 'font_size',
+                            minimum=1, maximum=MAX_FONT_SIZE)
+        auto = tuple(name for name in ('font_color', 'stroke_color') if config.get(name) == 'auto')
+        palette = _parse_palette(config.get('color_palette')) if auto else ()
+        if 'font_color' in auto:
+            font_color = palette[0]
+        else:
+            font_color = _parse_color(config.get('font_color', '#FFFFFF'), 'font_color')
+        if 'stroke_color' in auto:
+            stroke_color = most_contrasting(palette, font_color)
+        else:
+            stroke_color = _parse_color(config.get('stroke_color', '#000000'), 'stroke_color')
+        stroke_width = _integer(config.get('stroke_width', DEFAULT_CONFIG['stroke_width']), 'stroke_width',
+                                minimum=0, maximum=MAX_STROKE_WIDTH)
+        transparency = _number(config.get('transparency', DEFAULT_CONFIG['transparency']),
+                               'transparency', minimum=0, maximum=1)
+        # Drawn bottom to top: shadow, then glow, then the text
+        effects = tuple(TextEffect(config[name], name) for name in ('shadow', 'glow') if config.get(name))
+        self._set(font_name, font_size, font_color, stroke_color, stroke_width, transparency,
+                  effects, auto, palette)
+    
+    def _set(self, font_name, font_size, font_color, stroke_color, stroke_width, transparency,
+             effects, auto, palette):
+        self._freeze(
+            (font_name, font_size, font_color, stroke_color, stroke_width, transparency,
+             tuple(e.key for e in effects), auto, palette),
+            font_name=font_name, font_size=font_size, font_color=font_color,
+            stroke_color=stroke_color, stroke_width=stroke_width, transparency=transparency,
+            effects=effects, auto=auto, palette=palette, font=load_font(font_name, font_size)
+        )
     
-    stroke_color = config.get('stroke_color', '#000000')
-    if isinstance(stroke_color, str):
-        stroke_color = hex_to_rgba(stroke_color, 255)  # Full opacity initially
+    def with_colors(self, font_color, stroke_color):
+        """This style with fixed colors where it had "auto" ones"""
+        style = object.__new__(TextStyle)
+        style._set(self.font_name, self.font_size, font_color, stroke_color, self.stroke_width,
+                   self.transparency, self.effects, (), ())
+        return style
+
+class TextItem(_Frozen):
+    """One text item: 'combined' (handle and ID on two lines), 'handle' or 'id'"""
+    __slots__ = ('role', 'position', 'style')
     
-    stroke_width = config.get('stroke_width', DEFAULT_CONFIG['stroke_width'])
+    def __init__(self, role, position, style):
+        self._freeze((role, position.key, style.key), role=role, position=position, style=style)
     
-    # Load font
-    font = load_font(font_name, font_size)
+    def text(self, social_handle, id_code):
+        if self.role == 'handle':
+            return social_handle
+        if self.role == 'id':
+            return id_code
+        return f"{social_handle}\n{id_code}"
+
+class PatternSpec(_Frozen):
+    """Tiled pattern options: text override, angle and (spacing_x, spacing_y)"""
+    __slots__ = ('text', 'angle', 'spacing')
     
-    # Create a transparent overlay the same size as the main image
-    overlay = Image.new('RGBA', (img_width, img_height), (0, 0, 0, 0))
-    draw = ImageDraw.Draw(overlay)
+    def __init__(self, pattern_config, config):
+        text, angle, spacing = parse_pattern(pattern_config, config)
+        self._freeze((text, angle, spacing), text=text, angle=angle, spacing=spacing)
+
+class LogoSpec(_Frozen):
+    """A registered logo reference with its size, opacity and position rules"""
+    __slots__ = ('name', 'width', 'height', 'opacity', 'position')
+    
+    def __init__(self, logo_config, config):
+        name = logo_config['name']
+        width = logo_config.get('width')
+        height = logo_config.get('height')
+        width = _length_rule(width, 'logo width') if width is not None else None
+        height = _length_rule(height, 'logo height') if height is not None else None
+        opacity = float(_number(logo_config.get('opacity', 1.0), 'logo opacity', minimum=0, maximum=1))
+        margin = logo_config.get('margin', config.get('margin', DEFAULT_CONFIG['margin']))
+        position = PositionRule(logo_config.get('position', 'top-left'), margin)
+        self._freeze((name, width, height, opacity, position.key), name=name, width=width,
+                     height=height, opacity=opacity, position=position)
+
+class WatermarkSpec(_Frozen):
+    """A whole watermark config, compiled once: text items, pattern and logos"""
+    __slots__ = ('style', 'items', 'pattern', 'logos')
+    
+    def __init__(self, config):
+        style = TextStyle(config)
+        margin = config.get('margin', DEFAULT_CONFIG['margin'])
+        handle_position = config.get('handle_position')
+        id_position = config.get('id_position')
+        
+        if handle_position and id_position:
+            # Social handle and ID separately, each with its own style overrides
+            items = []
+            for role, position, overrides in (('handle', handle_position, config.get('handle_style')),
+                                              ('id', id_position, config.get('id_style'))):
+                item_config = dict(config, **(overrides or {}))
+                items.append(TextItem(role, PositionRule(position, item_config.get('margin', margin)),
+                                      TextStyle(item_config)))
+            items = tuple(items)
+        else:
+            # Original combined watermark
+            items = (TextItem('combined', PositionRule(config.get('position', 'bottom-right'), margin), style),)
+        
+        pattern = PatternSpec(config['pattern'], config) if config.get('pattern') else None
+        logos = tuple(LogoSpec(logo_config, config) for logo_config in config.get('logos') or [])
+        self._set(style, items, pattern, logos)
+    
+    def _set(self, style, items, pattern, logos):
+        self._freeze(
+            (style.key, tuple(i.key for i in items), pattern.key if pattern else None,
+             tuple(l.key for l in logos)),
+            style=style, items=items, pattern=pattern, logos=logos
+        )
+    
+    @property
+    def auto(self):
+        """Whether a text color that is drawn is chosen per image"""
+        styles = (self.style,) if self.pattern else tuple(item.style for item in self.items)
+        return any(style.auto for style in styles)
+    
+    def with_text_styles(self, style, items):
+        """This spec with other pattern style and text items (logos unchanged)"""
+        spec = object.__new__(WatermarkSpec)
+        spec._set(style, items, self.pattern, self.logos)
+        return spec
+
+@lru_cache(maxsize=256)
+def _compile_spec(canonical):
+    return WatermarkSpec(json.loads(canonical))
+
+def compile_spec(config):
+    """Compiled WatermarkSpec for a config dict, memoized per distinct config"""
+    if isinstance(config, WatermarkSpec):
+        return config
+    return _compile_spec(json.dumps(config, sort_keys=True, default=str))
+
+CACHES['specs'] = _compile_spec
+
+# image: tight RGBA rendering of the text (transparency already applied)
+# offset: where the sprite's top-left sits relative to the text position
+# text_size: the size used for positioning, as measured without stroke
+TextSprite = namedtuple('TextSprite', ['image', 'offset', 'text_size'])
+
+@lru_cache(maxsize=256)
+def _render_text_sprite(text, style):
+    font = style.font
+    stroke_width = style.stroke_width
+    transparency = style.transparency
     
     # Get text dimensions
-    bbox = draw.textbbox((0, 0), text, font=font)
+    measure = ImageDraw.Draw(Image.new('RGBA', (1, 1)))
+    bbox = measure.textbbox((0, 0), text, font=font)
     text_width = bbox[2] - bbox[0]
     text_height = bbox[3] - bbox[1]
     
-    # Parse position
-    x, y = parse_position(position_config, img_size, (text_width, text_height), margin)
-    
-    # Ensure text stays within image bounds
-    x = max(0, min(x, img_width - text_width))
-    y = max(0, min(y, img_height - text_height))
+    # Ink extent including the stroke, relative to the text position
+    left, top, right, bottom = measure.textbbox((0, 0), text, font=font, stroke_width=stroke_width)
+    sprite = Image.new('RGBA', (max(1, right - left), max(1, bottom - top)), (0, 0, 0, 0))
     
-    # Draw text on overlay with full opacity
-    draw.text(
-        (x, y), 
+    # Draw text on the sprite with full opacity
+    ImageDraw.Draw(sprite).text(
+        (-left, -top), 
         text, 
         font=font, 
-        fill=font_color,
-        stroke_fill=stroke_color,
+        fill=style.font_color,
+        stroke_fill=style.stroke_color,
         stroke_width=stroke_width,
         align='left'
     )
     
-    # Apply transparency to the entire overlay
+    # Shadow/glow are baked into the cached sprite, never drawn per image
+    if style.effects:
+        sprite, (grow_left, grow_top) = _add_text_effects(sprite, style.effects)
+        left, top = left - grow_left, top - grow_top
+    
+    # Apply transparency to the sprite
     if transparency < 1.0:
-        # Create alpha mask
-        alpha = overlay.split()[-1]  # Get alpha channel
+        alpha = sprite.split()[-1]  # Get alpha channel
         alpha = alpha.point(lambda p: int(p * transparency))  # Apply transparency
-        overlay.putalpha(alpha)
+        sprite.putalpha(alpha)
+    
+    return TextSprite(sprite, (left, top), (text_width, text_height))
+
+def _sprite_cacheable(text, style):
+    """Whether a sprite is small enough to cache, estimated without rendering it.
+    
+    Assumes every glyph fits in an em square, which is close enough to keep
+    one huge font_size from pinning hundreds of megabytes in the caches.
+    """
+    lines = text.split('\n')
+    grow = 2 * (style.stroke_width + max((e.reach + max(map(abs, e.offset)) for e in style.effects), default=0))
+    width = max(len(line) for line in lines) * style.font_size + grow
+    height = len(lines) * style.font_size * 1.2 + grow
+    return width * height <= SPRITE_CACHE_MAX_PIXELS
+
+def _add_text_effects(sprite, effects):
+    """Composite effect layers under a text sprite, growing it to fit them.
+    
+    Returns the new sprite and how much it grew on the left and top.
+    """
+    pad_left = max(0, max(e.reach - e.offset[0] for e in effects))
+    pad_top = max(0, max(e.reach - e.offset[1] for e in effects))
+    pad_right = max(0, max(e.reach + e.offset[0] for e in effects))
+    pad_bottom = max(0, max(e.reach + e.offset[1] for e in effects))
+    size = (sprite.width + pad_left + pad_right, sprite.height + pad_top + pad_bottom)
+    
+    canvas = Image.new('RGBA', size, (0, 0, 0, 0))
+    silhouette = sprite.getchannel('A')
+    for effect in effects:
+        mask = Image.new('L', size, 0)
+        mask.paste(silhouette, (pad_left + effect.offset[0], pad_top + effect.offset[1]))
+        if effect.spread:
+            mask = mask.filter(ImageFilter.MaxFilter(2 * effect.spread + 1))
+        if effect.blur:
+            mask = mask.filter(ImageFilter.GaussianBlur(effect.blur))
+        strength = effect.opacity * effect.color[3] / 255
+        if strength < 1.0:
+            mask = mask.point(lambda p: int(p * strength))
+        layer = Image.new('RGBA', size, effect.color[:3] + (255,))
+        layer.putalpha(mask)
+        canvas.alpha_composite(layer)
+    canvas.alpha_composite(sprite, (pad_left, pad_top))
+    return canvas, (pad_left, pad_top)
+
+def render_text_sprite(text, style):
+    """Rendered text sprite for a TextStyle, cached by text and style"""
+    with stage('render_sprite') as s:
+        render = _render_text_sprite if _sprite_cacheable(text, style) else _render_text_sprite.__wrapped__
+        sprite = render(text, style)
+        s.note(sprite_size=list(sprite.image.size))
+    return sprite
+
+CACHES['text_sprites'] = _render_text_sprite
+
+# image: RGBA layer to blend; position: where its top-left goes on the image
+# box: the laid-out item (text box or logo box) as (left, top, right, bottom)
+Placement = namedtuple('Placement', ['image', 'position', 'box'])
+
+def text_placement(text, position, img_size, style):
+    """Lay out one text item (PositionRule, TextStyle) on an image of img_size"""
+    img_width, img_height = img_size
+    
+    sprite = render_text_sprite(text, style)
+    text_width, text_height = sprite.text_size
+    
+    # Resolve the compiled position
+    x, y = position.resolve(img_size, (text_width, text_height))
+    
+    # Ensure text stays within image bounds
+    x = max(0, min(x, img_width - text_width))
+    y = max(0, min(y, img_height - text_height))
+    
+    return Placement(
+        sprite.image,
+        (x + sprite.offset[0], y + sprite.offset[1]),
+        (x, y, x + text_width, y + text_height)
+    )
+
+def _luminance_histogram(image, box):
+    """Luma histogram of a box, from a probe of at most AUTO_COLOR_PROBE_SIZE
+    samples a side. Nearest-neighbour sampling reads only the sampled pixels,
+    so the cost does not grow with the box or the image."""
+    left, top = max(0, box[0]), max(0, box[1])
+    right, bottom = min(image.width, box[2]), min(image.height, box[3])
+    if right <= left or bottom <= top:
+        left, top, right, bottom = 0, 0, image.width, image.height
+    width, height = right - left, bottom - top
+    scale = max(1, max(width, height) / AUTO_COLOR_PROBE_SIZE)
+    probe = image.resize((max(1, round(width / scale)), max(1, round(height / scale))),
+                         Image.Resampling.NEAREST, box=(left, top, right, bottom))
+    return probe.convert('L').histogram()
+
+def _resolve_style(image, style, box):
+    """style with its "auto" colors picked for the background inside box"""
+    font_color = style.font_color
+    if 'font_color' in style.auto:
+        font_color = pick_contrasting(style.palette, _luminance_histogram(image, box))
+    stroke_color = style.stroke_color
+    if 'stroke_color' in style.auto:
+        stroke_color = most_contrasting(style.palette, font_color)
+    return style.with_colors(font_color, stroke_color)
+
+def resolve_auto_colors(image, config, social_handle, id_code):
+    """Compiled spec with "auto" text colors chosen for this image.
+    
+    Each item samples only its own text box, laid out as for rendering; a
+    pattern covers the whole frame. Specs without "auto" colors are
+    returned as they are.
+    """
+    spec = compile_spec(config)
+    if not spec.auto:
+        return spec
+    with stage('auto_color') as s:
+        if spec.pattern:
+            style = _resolve_style(image, spec.style, (0, 0) + image.size)
+            spec = spec.with_text_styles(style, spec.items)
+            colors = [style.font_color]
+        else:
+            items = []
+            for item in spec.items:
+                if item.style.auto:
+                    placement = text_placement(item.text(social_handle, id_code), item.position,
+                                               image.size, item.style)
+                    item = TextItem(item.role, item.position, _resolve_style(image, item.style, placement.box))
+                items.append(item)
+            spec = spec.with_text_styles(spec.style, tuple(items))
+            colors = [item.style.font_color for item in items]
+        s.note(colors=['#%02X%02X%02X' % color[:3] for color in colors])
+    return spec
+
+def create_text_overlay(text, position, img_size, style):
+    """Create a transparent text overlay that can be blended with main image"""
+    placement = text_placement(text, position, img_size, style)
+    
+    # Create a transparent overlay the same size as the main image
+    with stage('new_overlay') as s:
+        overlay = Image.new('RGBA', img_size, (0, 0, 0, 0))
+        s.image(overlay)
+    
+    # Place the pre-rendered text on the overlay
+    with stage('paste_sprite') as s:
+        overlay.paste(placement.image, placement.position)
+        s.note(box=list(placement.box))
     
     return overlay
 
-def add_single_watermark_text(img, text, position_config, config):
+def blend_placement(img, placement, origin=(0, 0)):
+    """Alpha-composite a placement into img, clipped to img's bounds.
+    
+    origin is where img's top-left sits in the coordinates of the placement,
+    so a crop of a larger image can be blended into directly.
+    """
+    x = placement.position[0] - origin[0]
+    y = placement.position[1] - origin[1]
+    layer = placement.image
+    left, top = max(0, -x), max(0, -y)
+    right = min(layer.width, img.width - x)
+    bottom = min(layer.height, img.height - y)
+    if right <= left or bottom <= top:
+        return img
+    img.alpha_composite(layer, dest=(x + left, y + top), source=(left, top, right, bottom))
+    return img
+
+def add_single_watermark_text(img, text, position, style):
     """Add a single watermark text using proper transparency blending"""
     # Create text overlay
-    overlay = create_text_overlay(text, position_config, img.size, config)
+    overlay = create_text_overlay(text, position, img.size, style)
     
     # Blend overlay with main image
     if img.mode != 'RGBA':
-        img = img.convert('RGBA')
+        with stage('convert_rgba') as s:
+            img = img.convert('RGBA')
+            s.image(img)
     
     # Composite the overlay onto the main image
-    img = Image.alpha_composite(img, overlay)
+    with stage('composite') as s:
+        img = Image.alpha_composite(img, overlay)
+        s.image(img)
     
     return img
 
+def parse_pattern(pattern_config, config):
+    """Normalize pattern options to (text override, angle, (spacing_x, spacing_y))"""
+    if pattern_config is True:
+        pattern_config = {}
+    angle = float(_number(pattern_config.get('angle', 30), 'pattern angle'))
+    
+    # Gap between tiles: one number for both directions or [x, y]
+    default_spacing = config.get('font_size', DEFAULT_CONFIG['font_size']) * 2
+    spacing = pattern_config.get('spacing', default_spacing)
+    if isinstance(spacing, (list, tuple)):
+        spacing_x, spacing_y = (int(v) for v in spacing)
+    else:
+        spacing_x = spacing_y = int(spacing)
+    spacing_x = int(pattern_config.get('spacing_x', spacing_x))
+    spacing_y = int(pattern_config.get('spacing_y', spacing_y))
+    if spacing_x < 0 or spacing_y < 0:
+        raise ValueError('pattern spacing must not be negative')
+    
+    return pattern_config.get('text'), angle, (spacing_x, spacing_y)
+
+def _rotate_tile(sprite, angle):
+    """Rotated text sprite used as the repeating unit of a pattern"""
+    if angle % 360 == 0:
+        return sprite.image
+    return sprite.image.rotate(angle, resample=Image.Resampling.BICUBIC, expand=True)
+
+@lru_cache(maxsize=64)
+def _cached_pattern_tile(text, style, angle):
+    return _rotate_tile(_render_text_sprite(text, style), angle)
+
+def _repeat(strip, length, step, axis):
+    """Fill a strip along one axis by doubling the already filled part"""
+    filled = step
+    while filled < length:
+        count = min(filled, length - filled)
+        if axis == 0:
+            strip.paste(strip.crop((0, 0, count, strip.height)), (filled, 0))
+        else:
+            strip.paste(strip.crop((0, 0, strip.width, count)), (0, filled))
+        filled += count
+
+def _render_pattern_tile(text, style, angle):
+    """Pattern tile, from the cache unless it is too large to keep"""
+    if _sprite_cacheable(text, style):
+        return _cached_pattern_tile(text, style, angle)
+    return _rotate_tile(_render_text_sprite.__wrapped__(text, style), angle)
+
+def _tile_row(tile, width, step, start):
+    """One row of tiles every `step` pixels from x = start (0 or negative)"""
+    row = Image.new('RGBA', (width, tile.height), (0, 0, 0, 0))
+    # The tiles at start and start + step fill the first period exactly
+    row.paste(tile, (start, 0))
+    row.paste(tile, (start + step, 0))
+    _repeat(row, width, step, axis=0)
+    return row
+
+@lru_cache(maxsize=2)
+def _render_pattern_overlay(text, style, angle, spacing, img_size):
+    """Full-frame overlay tiled from the cached tile (few, large entries)"""
+    tile = _render_pattern_tile(text, style, angle)
+    cell_width = tile.width + spacing[0]
+    cell_height = tile.height + spacing[1]
+    img_width, img_height = img_size
+    
+    # Two rows (the odd one staggered by half a cell) make the vertical
+    # period, doubled down the frame; nothing is larger than the frame, so
+    # a huge spacing costs no memory
+    overlay = Image.new('RGBA', img_size, (0, 0, 0, 0))
+    overlay.paste(_tile_row(tile, img_width, cell_width, 0), (0, 0))
+    if cell_height < img_height:
+        overlay.paste(_tile_row(tile, img_width, cell_width, -(cell_width // 2)), (0, cell_height))
+    _repeat(overlay, img_height, 2 * cell_height, axis=1)
+    return overlay
+
+CACHES['pattern_tiles'] = _cached_pattern_tile
+CACHES['pattern_overlays'] = _render_pattern_overlay
+
+def pattern_placements(img_size, text, pattern, style):
+    """Every tile of a pattern as a placement (same grid as the pattern overlay)"""
+    tile = _render_pattern_tile(pattern.text or text, style, pattern.angle)
+    cell_width = tile.width + pattern.spacing[0]
+    cell_height = tile.height + pattern.spacing[1]
+    img_width, img_height = img_size
+    
+    placements = []
+    for row, y in enumerate(range(0, img_height, cell_height)):
+        # Odd rows are staggered by half a cell
+        start = -(cell_width // 2) if row % 2 else 0
+        for x in range(start, img_width, cell_width):
+            placements.append(Placement(tile, (x, y), (x, y, x + tile.width, y + tile.height)))
+    return placements
+
+def add_watermark_pattern(img, text, pattern, style):
+    """Tile a rotated text watermark across the whole image"""
+    text = pattern.text or text
+    
+    with stage('pattern_overlay') as s:
+        # Only keep full-frame overlays for moderately sized images in the cache
+        render = _render_pattern_overlay
+        if img.width * img.height > PATTERN_OVERLAY_CACHE_MAX_PIXELS:
+            render = _render_pattern_overlay.__wrapped__
+        overlay = render(text, style, pattern.angle, pattern.spacing, img.size)
+        s.note(angle=pattern.angle, spacing=list(pattern.spacing))
+        s.image(overlay)
+    
+    # Composite the overlay onto the main image
+    with stage('composite') as s:
+        img = Image.alpha_composite(img, overlay)
+        s.image(img)
+    
+    return img
+
+# name -> (version, decoded RGBA image); the version keys the variant cache
+LOGOS = {}
+_logos_lock = threading.Lock()
+_logo_versions = itertools.count(1)
+
+def register_logo(name, image):
+    """Decode a logo once and keep it for watermark requests"""
+    if image.width * image.height > MAX_LOGO_PIXELS:
+        raise ValueError(f'logo is larger than {MAX_LOGO_PIXELS} pixels')
+    logo = image.convert('RGBA')
+    with _logos_lock:
+        LOGOS[name] = (next(_logo_versions), logo)
+    return logo
+
+def unregister_logo(name):
+    with _logos_lock:
+        return LOGOS.pop(name, None) is not None
+
+def load_logo_dir(path):
+    """Register every PNG in a directory under its file name (without extension)"""
+    for file in sorted(os.listdir(path)):
+        if file.lower().endswith('.png'):
+            with Image.open(os.path.join(path, file)) as logo:
+                register_logo(os.path.splitext(file)[0], logo)
+
+@lru_cache(maxsize=64)
+def _logo_variant(name, version, size, opacity):
+    """Logo scaled to size with opacity applied, ready to blend"""
+    with _logos_lock:
+        current = LOGOS.get(name)
+    if current is None or current[0] != version:
+        raise KeyError(name)
+    logo = current[1]
+    
+    if logo.size != size:
+        # Pillow resizes RGBA in premultiplied form, so edges do not darken
+        logo = logo.resize(size, Image.Resampling.LANCZOS)
+    if opacity < 1.0:
+        logo = logo.copy()
+        alpha = logo.split()[-1]
+        alpha = alpha.point(lambda p: int(p * opacity))
+        logo.putalpha(alpha)
+    return logo
+
+CACHES['logo_variants'] = _logo_variant
+
+def logo_placement(img_size, logo):
+    """Scaled variant of a LogoSpec's logo and its position on an image of img_size"""
+    img_width, img_height = img_size
+    name = logo.name
+    with _logos_lock:
+        version, image = LOGOS[name]
+    
+    # Target size from width and/or height, keeping the aspect ratio
+    width = logo.width
+    height = logo.height
+    if width is not None and height is not None:
+        size = (_resolve_length(width, img_width), _resolve_length(height, img_height))
+    elif width is not None:
+        w = _resolve_length(width, img_width)
+        size = (w, round(image.height * w / image.width))
+    elif height is not None:
+        h = _resolve_length(height, img_height)
+        size = (round(image.width * h / image.height), h)
+    else:
+        size = image.size
+    size = (max(1, min(size[0], img_width)), max(1, min(size[1], img_height)))
+    
+    with stage('logo_variant') as s:
+        # Large variants (up to the whole frame) are made per request, not pinned in the cache
+        render = _logo_variant
+        if size[0] * size[1] > SPRITE_CACHE_MAX_PIXELS:
+            render = _logo_variant.__wrapped__
+        variant = render(name, version, size, logo.opacity)
+        s.note(logo=name)
+        s.image(variant)
+    
+    # Same positioning rules as the text
+    x, y = logo.position.resolve(img_size, size)
+    x = max(0, min(x, img_width - size[0]))
+    y = max(0, min(y, img_height - size[1]))
+    
+    return Placement(variant, (x, y), (x, y, x + size[0], y + size[1]))
+
+def add_logo(img, logo):
+    """Blend a registered logo into its bounding box only"""
+    placement = logo_placement(img.size, logo)
+    with stage('logo_composite') as s:
+        img.alpha_composite(placement.image, dest=placement.position)
+        s.note(box=list(placement.box))
+    return img
+
+def _numpy_engine():
+    """The NumPy engine module, imported only when it is selected"""
+    import numpy_engine
+    CACHES.setdefault('numpy_layers', numpy_engine)
+    return numpy_engine
+
+def _forensic():
+    """The forensic watermark module (needs NumPy), imported on first use"""
+    import forensic
+    return forensic
+
 def add_watermark(image, social_handle, id_code, config):
     """Add watermark to image - supports single or separate positioning with proper transparency"""
-    img = image.copy()
+    spec = resolve_auto_colors(image, config, social_handle, id_code)
+    if RENDER_ENGINE == 'numpy':
+        return add_watermark_numpy(image, social_handle, id_code, spec)
+    
+    with stage('copy') as s:
+        img = image.copy()
+        s.image(img)
     
     # Ensure image is in RGBA mode for transparency support
     if img.mode != 'RGBA':
-        img = img.convert('RGBA')
+        with stage('convert_rgba') as s:
+            img = img.convert('RGBA')
+            s.image(img)
+    
+    # Logos go underneath the text
+    for logo in spec.logos:
+        img = add_logo(img, logo)
+    
+    if spec.pattern:
+        # Handle and ID repeated diagonally across the whole frame
+        img = add_watermark_pattern(img, f"{social_handle}  {id_code}", spec.pattern, spec.style)
+    else:
+        for item in spec.items:
+            img = add_single_watermark_text(img, item.text(social_handle, id_code), item.position, item.style)
+    
+    return img
+
+def add_watermark_numpy(image, social_handle, id_code, config):
+    """add_watermark using the NumPy engine: blends only the covered regions"""
+    engine = _numpy_engine()
+    config = resolve_auto_colors(image, config, social_handle, id_code)
+    
+    # Same RGBA result as the Pillow engine
+    with stage('convert_rgba') as s:
+        img = image.convert('RGBA') if image.mode != 'RGBA' else image.copy()
+        s.image(img)
+    
+    placements = watermark_placements(img.size, social_handle, id_code, config)
+    with stage('blend_placements') as s:
+        for placement in placements:
+            engine.blend_into(img, placement.image, placement.position)
+        s.note(placements=len(placements))
+    
+    return img
+
+def watermark_placements(img_size, social_handle, id_code, config):
+    """Every layer of the watermark as placements, in compositing order"""
+    spec = compile_spec(config)
+    placements = [logo_placement(img_size, logo) for logo in spec.logos]
+    if spec.pattern:
+        placements += pattern_placements(img_size, f"{social_handle}  {id_code}", spec.pattern, spec.style)
+    else:
+        placements += [text_placement(item.text(social_handle, id_code), item.position, img_size, item.style)
+                       for item in spec.items]
+    return placements
+
+@lru_cache(maxsize=None)
+def _converts_per_strip(mode):
+    """Whether strips of an image in mode can be blended in RGBA and converted back.
+    
+    Palette and bilevel images cannot take the watermark's colors, and
+    Pillow cannot convert RGBA back to some modes (e.g. I;16).
+    """
+    if mode in ('P', 'PA', '1'):
+        return False
+    try:
+        Image.new(mode, (1, 1)).convert('RGBA').convert(mode)
+    except (ValueError, OSError):
+        return False
+    return True
+
+def _coverage_mask(size, placements, origin):
+    """Mask of the pixels of a region (at origin) that any placement covers"""
+    mask = Image.new('L', size, 0)
+    for placement in placements:
+        covered = placement.image.getchannel('A').point(lambda a: 255 if a else 0)
+        mask.paste(255, (placement.position[0] - origin[0], placement.position[1] - origin[1]), covered)
+    return mask
+
+def add_watermark_regions(image, social_handle, id_code, config, strip_height=None):
+    """Watermark a large image in place, strip by strip.
+    
+    Unlike add_watermark this neither copies the image nor converts all of
+    it to RGBA: only the strips that the watermark's bounding boxes overlap
+    are cropped, blended and pasted back, and the image keeps its mode
+    (L, CMYK, ...) unless strips of it cannot be converted back.
+    """
+    config = resolve_auto_colors(image, config, social_handle, id_code)
+    if image.mode not in ('RGB', 'RGBA') and not _converts_per_strip(image.mode):
+        with stage('convert_rgb') as s:
+            has_alpha = 'A' in image.getbands() or 'transparency' in image.info
+            image = image.convert('RGBA' if has_alpha else 'RGB')
+            s.image(image)
+    
+    placements = watermark_placements(image.size, social_handle, id_code, config)
+    strip_height = strip_height or LARGE_IMAGE_STRIP_HEIGHT
+    
+    blend = blend_placement
+    if RENDER_ENGINE == 'numpy':
+        engine = _numpy_engine()
+        if image.mode in ('RGB', 'RGBA'):
+            # Each blend already touches only its own region, straight into RGB
+            with stage('blend_placements') as s:
+                for placement in placements:
+                    engine.blend_into(image, placement.image, placement.position)
+                s.note(placements=len(placements))
+            return image
+        
+        def blend(region, placement, origin):
+            position = (placement.position[0] - origin[0], placement.position[1] - origin[1])
+            return engine.blend_into(region, placement.image, position)
+    
+    with stage('blend_regions') as s:
+        strips = 0
+        for top in range(0, image.height, strip_height):
+            bottom = min(image.height, top + strip_height)
+            hits = [p for p in placements
+                    if p.position[1] < bottom and p.position[1] + p.image.height > top]
+            if not hits:
+                continue
+            
+            # Only the columns the placements cover
+            left = max(0, min(p.position[0] for p in hits))
+            right = min(image.width, max(p.position[0] + p.image.width for p in hits))
+            if right <= left:
+                continue
+            region = image.crop((left, top, right, bottom))
+            blended = region if region.mode == 'RGBA' else region.convert('RGBA')
+            for placement in hits:
+                blend(blended, placement, (left, top))
+            if image.mode == 'RGB':
+                region = blended.convert('RGB')
+            elif image.mode != 'RGBA':
+                # Only covered pixels go back, so the rest of the strip keeps
+                # its exact values (CMYK -> RGBA -> CMYK is not lossless)
+                region.paste(blended.convert(image.mode), mask=_coverage_mask(region.size, hits, (left, top)))
+            else:
+                region = blended
+            image.paste(region, (left, top))
+            strips += 1
+        s.note(placements=len(placements), strips=strips)
     
-    # Check if separate positioning is requested
-    handle_position = config.get('handle_position')
-    id_position = config.get('id_position')
+    return image
+
+def render_watermark_layer(size, social_handle, id_code, config):
+    """All watermark layers rendered once onto a transparent canvas"""
+    return add_watermark(Image.new('RGBA', size, (0, 0, 0, 0)), social_handle, id_code, config)
+
+def _animation_pool():
+    global _animation_executor
+    with _animation_lock:
+        if _animation_executor is None:
+            # Imported here: only animated requests need it
+            from concurrent.futures import ThreadPoolExecutor
+            _animation_executor = ThreadPoolExecutor(max_workers=ANIMATION_WORKERS,
+                                                     thread_name_prefix='animation')
+        return _animation_executor
+
+def _chunks(items, count):
+    size = max(1, -(-len(items) // count))
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def _composite_frames(frames, layer):
+    return [Image.alpha_composite(frame, layer) for frame in frames]
+
+def check_animation_size(image):
+    """ValueError for an animation too large to decode; reads no frame data"""
+    if image.n_frames > MAX_ANIMATION_FRAMES:
+        raise ValueError(f'Animation has more than {MAX_ANIMATION_FRAMES} frames')
+    if image.n_frames * image.width * image.height > MAX_ANIMATION_PIXELS:
+        raise ValueError(f'Animation is too large: {image.n_frames} frames of '
+                         f'{image.width}x{image.height} exceed {MAX_ANIMATION_PIXELS} pixels')
+
+def add_watermark_frames(image, social_handle, id_code, config):
+    """Watermark every frame of an animated image with one shared layer"""
+    check_animation_size(image)
+    # Colors are picked once, from the first frame, so they do not flicker
+    config = resolve_auto_colors(image, config, social_handle, id_code)
+    frames = []
+    durations = []
+    disposals = []
+    with stage('decode_frames') as s:
+        for frame in ImageSequence.Iterator(image):
+            # Converting loads the frame, which refreshes its info (duration)
+            frames.append(frame.convert('RGBA'))
+            durations.append(frame.info.get('duration', image.info.get('duration', 100)))
+            disposals.append(getattr(frame, 'disposal_method', 0))
+        s.note(frames=len(frames))
     
-    if handle_position and id_position:
-        # Add social handle and ID separately
-        handle_config = config.copy()
-        handle_config.update(config.get('handle_style', {}))
+    chunks = _chunks(frames, ANIMATION_WORKERS)
+    if RENDER_ENGINE == 'numpy':
+        # Each sprite is blended into a whole chunk of frames at once
+        placements = watermark_placements(image.size, social_handle, id_code, config)
+        engine = _numpy_engine()
         
-        id_config = config.copy()
-        id_config.update(config.get('id_style', {}))
+        def blend_chunk(chunk):
+            for placement in placements:
+                engine.blend_batch(chunk, placement.image, placement.position)
+            return chunk
         
-        img = add_single_watermark_text(img, social_handle, handle_position, handle_config)
-        img = add_single_watermark_text(img, id_code, id_position, id_config)
+        with stage('blend_frames') as s:
+            results = _animation_pool().map(blend_chunk, chunks)
+            frames = [frame for chunk in results for frame in chunk]
+            s.note(chunks=len(chunks), placements=len(placements))
     else:
-        # Original combined watermark
-        watermark_text = f"{social_handle}\n{id_code}"
-        position = config.get('position', 'bottom-right')
-        img = add_single_watermark_text(img, watermark_text, position, config)
+        # Render the watermark sprite(s) once for the whole animation
+        with stage('watermark_layer') as s:
+            layer = render_watermark_layer(image.size, social_handle, id_code, config)
+            s.image(layer)
+        
+        # Blend the shared layer onto the frames in parallel chunks
+        with stage('composite_frames') as s:
+            results = _animation_pool().map(_composite_frames, chunks, [layer] * len(chunks))
+            frames = [frame for chunk in results for frame in chunk]
+            s.note(chunks=len(chunks))
     
+    info = {
+        'duration': durations,
+        'disposal': disposals,
+        'loop': image.info.get('loop', 0)
+    }
+    return frames, info
+
+def _shared_palette(frames):
+    """One adaptive palette built from a sample of frames"""
+    step = max(1, len(frames) // 4)
+    samples = [frame.convert('RGB') for frame in frames[::step][:4]]
+    for sample in samples:
+        sample.thumbnail((256, 256))
+    strip = Image.new('RGB', (sum(s.width for s in samples), max(s.height for s in samples)))
+    x = 0
+    for sample in samples:
+        strip.paste(sample, (x, 0))
+        x += sample.width
+    # Index 255 stays free for transparency
+    return strip.quantize(colors=255)
+
+def _quantize_frames(frames, palette):
+    quantized = []
+    for frame in frames:
+        p_frame = frame.convert('RGB').quantize(palette=palette, dither=Image.Dither.NONE)
+        transparent = frame.getchannel('A').point(lambda a: 255 if a < 128 else 0)
+        if transparent.getbbox():
+            p_frame.paste(255, mask=transparent)
+        quantized.append(p_frame)
+    return quantized
+
+def save_animation(frames, info, fp, output_format, quality=95):
+    """Encode watermarked frames, keeping timing, disposal and loop settings"""
+    options = {
+        'save_all': True,
+        'duration': info['duration'],
+        'loop': info['loop']
+    }
+    if output_format == 'GIF':
+        # Map every frame to one shared palette instead of one palette per frame
+        with stage('quantize_frames') as s:
+            palette = _shared_palette(frames)
+            chunks = _chunks(frames, ANIMATION_WORKERS)
+            results = _animation_pool().map(_quantize_frames, chunks, [palette] * len(chunks))
+            frames = [frame for chunk in results for frame in chunk]
+            s.note(frames=len(frames))
+        options.update(disposal=info['disposal'], transparency=255, optimize=False)
+    elif output_format == 'WEBP':
+        options.update(quality=quality)
+    
+    with stage('encode') as s:
+        frames[0].save(fp, format=output_format, append_images=frames[1:], **options)
+        s.note(output_format=output_format, frames=len(frames))
+
+def prepare_for_format(img, output_format):
+    """Flatten transparent images onto white when the output format is JPEG,
+    and convert modes the output format cannot store (e.g. CMYK to PNG)"""
+    if img.mode in ('RGBA', 'LA', 'P') and output_format == 'JPEG':
+        with stage('flatten_for_jpeg') as s:
+            rgb_image = Image.new('RGB', img.size, (255, 255, 255))
+            if img.mode != 'RGBA':
+                img = img.convert('RGBA')
+            rgb_image.paste(img, mask=img.split()[-1])
+            img = rgb_image
+            s.image(img)
+    modes = SAVE_MODES.get(output_format)
+    if modes and img.mode not in modes:
+        with stage('convert_for_format') as s:
+            img = img.convert('RGBA' if 'A' in img.getbands() and 'RGBA' in modes else 'RGB')
+            s.image(img)
     return img
 
+def load_image_plugins():
+    """Import only the Pillow plugins for IMAGE_FORMATS instead of all of them.
+    
+    Returns the formats Image.open() should try (MPO files open through the
+    JPEG plugin, so it has no opener of its own), or None for all formats.
+    """
+    if IMAGE_FORMATS is None:
+        Image.init()
+        return None
+    for image_format in IMAGE_FORMATS:
+        module = PILLOW_PLUGINS.get(image_format)
+        if module is None:
+            raise ValueError(f'WATERMARK_IMAGE_FORMATS: unknown format {image_format} '
+                             f'(choose from {", ".join(PILLOW_PLUGINS)})')
+        importlib.import_module(f'PIL.{module}')
+    return tuple(f for f in IMAGE_FORMATS if f in Image.OPEN)
+
+def _process_age_seconds():
+    """Seconds since this process started (includes interpreter and server boot)"""
+    try:
+        with open('/proc/self/stat') as f:
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return round(uptime - start_ticks / os.sysconf('SC_CLK_TCK'), 3)
+    except (OSError, ValueError, IndexError):
+        return None
+
+# Set once warm-up has finished; /ready reports 503 until then
+_ready = threading.Event()
+_warm_up_started = False
+_warm_up_lock = threading.Lock()
+STARTUP = {'import_seconds': None, 'warmup_seconds': None, 'ready_seconds': None,
+           'process_ready_seconds': None}
+
+def warm_up():
+    """Load fonts and codecs and run the pipeline once, then report ready"""
+    started = time.monotonic()
+    get_system_fonts()
+    for font_name in PREWARM_FONTS:
+        for size in PREWARM_FONT_SIZES:
+            load_font(font_name, size)
+    
+    # One tiny watermark through every codec we encode (and decode)
+    sample = add_watermark(Image.new('RGB', (64, 64)), '@warmup', 'WARMUP', build_config({}))
+    for image_format in IMAGE_FORMATS or ('JPEG', 'PNG', 'WEBP', 'GIF'):
+        if image_format not in Image.SAVE or image_format == 'MPO':
+            continue
+        buffer = io.BytesIO()
+        prepare_for_format(sample, image_format).save(buffer, format=image_format)
+        buffer.seek(0)
+        Image.open(buffer, formats=DECODE_FORMATS).load()
+    
+    # Render processes start now and warm themselves up in the background
+    _render_pool()
+    
+    finished = time.monotonic()
+    STARTUP.update(
+        warmup_seconds=round(finished - started, 4),
+        ready_seconds=round(finished - _IMPORT_STARTED, 4),
+        process_ready_seconds=_process_age_seconds()
+    )
+    _ready.set()
+
+def start_warm_up():
+    """Warm up in the background so /health answers while it runs (once per process).
+    
+    Called by the server entry point, by the first request and by render
+    processes, never at import: importing app (tests, bulk.py, a reloader
+    parent) must not start threads or render processes. The RSS sampler
+    starts alongside it in the web server only.
+    """
+    global _warm_up_started
+    with _warm_up_lock:
+        if _warm_up_started:
+            return
+        _warm_up_started = True
+    threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+
+@app.before_request
+def start_access_log():
+    if not _warm_up_started:
+        # e.g. the readiness probe under gunicorn
+        start_warm_up()
+        memory_stats.start_rss_sampler()
+    g.request_id = access_log.request_id(request.headers.get('X-Request-ID'))
+    g.started = time.perf_counter()
+    g.access = {}
+    g.diagnostics = {}
+    g.recorder = None
+
+def note_access(diagnostic=False, **fields):
+    """Add fields to this request's access log line, or with diagnostic=True
+    only to its slow-request record; does nothing outside a request"""
+    if has_request_context() and 'access' in g:
+        (g.diagnostics if diagnostic else g.access).update(fields)
+
+@app.after_request
+def write_access_log(response):
+    """Log the request once its response has been sent (streams included)"""
+    response.headers['X-Request-ID'] = g.request_id
+    record = {
+        'request_id': g.request_id,
+        'method': request.method,
+        'path': request.path,
+        'status': response.status_code,
+        'client': request.remote_addr,
+        'request_bytes': request.content_length,
+        # None for streamed responses
+        'response_bytes': response.content_length
+    }
+    if request.headers.get('X-Forwarded-For'):
+        record['forwarded_for'] = request.headers['X-Forwarded-For']
+    if response.status_code >= 400 and response.is_json:
+        record['error'] = (response.get_json(silent=True) or {}).get('error')
+    record.update(g.access)
+    finish = partial(access_log.finish, record, g.started, g.recorder, g.diagnostics)
+    if response.is_streamed:
+        # Logged when the server closes the stream, so the duration covers it
+        response.call_on_close(finish)
+    else:
+        finish()
+    return response
+
 @app.route('/health', methods=['GET'])
 def health_check():
     return jsonify({'status': 'healthy', 'service': 'watermark-fiiin'})
 
+@app.route('/ready', methods=['GET'])
+def readiness_check():
+    """200 once warm-up has finished, 503 while fonts and codecs are loading"""
+    if not _ready.is_set():
+        return jsonify({'status': 'warming', 'service': 'watermark-fiiin'}), 503
+    return jsonify({'status': 'ready', 'service': 'watermark-fiiin', 'startup': STARTUP})
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Process metrics for monitoring"""
+    return jsonify({
+        'memory': memory_stats.snapshot(),
+        'buffers': buffer_pool.snapshot(),
+        'webhooks': webhooks.snapshot(),
+        'slow_requests': access_log.snapshot(),
+        'render': _render_processes.snapshot() if _render_processes else {'processes': 0},
+        'startup': dict(STARTUP, ready=_ready.is_set())
+    })
+
 @app.route('/fonts', methods=['GET'])
 def list_fonts():
     """List all available system fonts"""
@@ -284,92 +1547,857 @@ def list_fonts():
         ]
     })
 
+@app.route('/logos', methods=['GET'])
+def list_logos():
+    """List registered logos"""
+    with _logos_lock:
+        logos = {name: list(logo.size) for name, (_, logo) in LOGOS.items()}
+    return jsonify({'total_logos': len(logos), 'logos': logos})
+
+@app.route('/logos', methods=['POST'])
+def upload_logo():
+    """Register (or replace) a logo once so requests can reference it by name"""
+    data = request.get_json()
+    if not data or not data.get('name') or 'image' not in data:
+        return jsonify({'error': 'Logo name and image data are required'}), 400
+    
+    try:
+        logo = Image.open(io.BytesIO(base64.b64decode(data['image'])), formats=DECODE_FORMATS)
+        logo = register_logo(data['name'], logo)
+    except Exception as e:
+        return jsonify({'error': f'Invalid logo image: {str(e)}'}), 400
+    
+    return jsonify({'success': True, 'name': data['name'], 'size': list(logo.size)})
+
+@app.route('/logos/<name>', methods=['DELETE'])
+def delete_logo(name):
+    if not unregister_logo(name):
+        return jsonify({'error': f'Unknown logo: {name}'}), 404
+    return jsonify({'success': True, 'name': name})
+
+@app.route('/presets', methods=['GET'])
+def list_presets():
+    """List registered presets"""
+    with _presets_lock:
+        presets = dict(PRESETS)
+    return jsonify({'total_presets': len(presets), 'presets': presets})
+
+@app.route('/presets', methods=['POST'])
+def upload_preset():
+    """Register (or replace) a named preset and warm its caches"""
+    data = request.get_json()
+    if not data or not data.get('name'):
+        return jsonify({'error': 'Preset name is required'}), 400
+    
+    name = data['name']
+    preset = {key: value for key, value in data.items() if key != 'name'}
+    try:
+        spec, warmed = register_preset(name, preset)
+    except (TypeError, ValueError, KeyError) as e:
+        return jsonify({'error': f'Invalid preset: {str(e)}'}), 400
+    
+    return jsonify({'success': True, 'name': name, 'spec': spec.digest, 'warmed': warmed})
+
+@app.route('/presets/<name>', methods=['DELETE'])
+def delete_preset(name):
+    if not unregister_preset(name):
+        return jsonify({'error': f'Unknown preset: {name}'}), 404
+    return jsonify({'success': True, 'name': name})
+
+def prepare_watermark_request(data):
+    """Apply the preset and check required fields; returns (data, error message)"""
+    if not isinstance(data, dict) or ('image' not in data and 'input_path' not in data):
+        return data, 'No image data provided'
+    if 'image' in data and 'input_path' in data:
+        return data, 'Send either image or input_path, not both'
+    
+    # Preset fields first, request fields override them
+    if data.get('preset'):
+        try:
+            data = apply_preset(data)
+        except KeyError:
+            return data, f'Unknown preset: {data["preset"]}'
+    
+    if 'social_handle' not in data:
+        return data, 'Social handle is required'
+    
+    if 'id_code' not in data:
+        return data, 'ID code is required'
+    
+    logos = data.get('logos', [])
+    if not isinstance(logos, list) or not all(isinstance(l, dict) for l in logos):
+        return data, 'logos must be a list of objects like {"name": "brand"}'
+    unknown = [l.get('name') for l in logos if l.get('name') not in LOGOS]
+    if unknown:
+        return data, f'Unknown logo: {", ".join(map(str, unknown))}'
+    
+    if data.get('pattern') not in (None, False, True) and not isinstance(data['pattern'], dict):
+        return data, 'pattern must be an object like {"angle": 30, "spacing": 80}'
+    return data, None
+
 @app.route('/watermark', methods=['POST'])
 def watermark_image():
     try:
-        data = request.get_json()
+        data, error = prepare_watermark_request(request.get_json())
+        if error:
+            return jsonify({'error': error}), 400
         
-        # Validate required fields
-        if not data or 'image' not in data:
-            return jsonify({'error': 'No image data provided'}), 400
+        # Answer now and POST the result to the caller when it is done
+        if data.get('callback_url'):
+            return submit_job(data)
         
-        if 'social_handle' not in data:
-            return jsonify({'error': 'Social handle is required'}), 400
+        # Optional debug output, only when enabled for this deployment
+        debug_timings = DEBUG_TIMINGS_ENABLED and (
+            _is_truthy(data.get('debug_timings', False)) or
+            _is_truthy(request.headers.get('X-Debug-Timings', ''))
+        )
+        debug_profile = DEBUG_PROFILE_ENABLED and (
+            _is_truthy(data.get('debug_profile', False)) or
+            _is_truthy(request.headers.get('X-Debug-Profile', ''))
+        )
         
-        if 'id_code' not in data:
-            return jsonify({'error': 'ID code is required'}), 400
+        # Stage timings go to the access log; a sampled share of requests
+        # also run with memory accounting
+        sample_memory = debug_timings or memory_stats.should_sample()
+        recorder = g.recorder = StageRecorder(track_allocations=sample_memory)
+        caches_before = cache_snapshot()
         
-        # Decode base64 image
-        try:
-            image_data = base64.b64decode(data['image'])
-            image = Image.open(io.BytesIO(image_data))
-        except Exception as e:
-            return jsonify({'error': f'Invalid image data: {str(e)}'}), 400
+        with recorder.activate():
+            result = _process_watermark_request(data, debug_profile)
+        note_access(
+            id_code=data['id_code'],
+            stages=access_log.stage_timings(recorder),
+            caches=access_log.cache_outcomes(cache_delta(caches_before, cache_snapshot()))
+        )
+        if isinstance(result, tuple):
+            return result
         
-        # Get watermark parameters
-        social_handle = data['social_handle']
-        id_code = data['id_code']
+        if sample_memory:
+            memory_stats.record_request(
+                recorder,
+                endpoint='/watermark',
+                id_code=result['metadata']['id_code'],
+                format=result['metadata']['format']
+            )
+        if debug_timings:
+            result['metadata']['debug'] = {
+                'timings': recorder.to_dict(),
+                'memory': memory_stats.summarize_stages(recorder),
+                'caches': cache_delta(caches_before, cache_snapshot())
+            }
         
-        # Configuration from request
-        config = {
-            'font_size': data.get('font_size', 24),
-            'font': data.get('font', 'DejaVuSans-Bold.ttf'),
-            'font_color': data.get('font_color', '#FFFFFF'),
-            'stroke_color': data.get('stroke_color', '#000000'),
-            'stroke_width': data.get('stroke_width', 2),
-            'position': data.get('position', 'bottom-right'),
-            'margin': data.get('margin', 20),
-            'opacity': data.get('opacity', 200),
-            'transparency': data.get('transparency', 1.0),  # Transparency control
-            # Separate positioning options
-            'handle_position': data.get('handle_position'),
-            'id_position': data.get('id_position'),
-            'handle_style': data.get('handle_style', {}),
-            'id_style': data.get('id_style', {})
-        }
+        return jsonify(result)
         
-        # Add watermark
+    except Exception as e:
+        note_access(diagnostic=True, traceback=traceback.format_exc())
+        log_event(access_log.logger, 'request_failed', request_id=g.request_id,
+                  error=f'{type(e).__name__}: {e}', traceback=traceback.format_exc())
+        return jsonify({'error': f'Processing failed: {str(e)}'}), 500
+
+def _stream_pool():
+    global _stream_executor
+    with _stream_lock:
+        if _stream_executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _stream_executor = ThreadPoolExecutor(max_workers=STREAM_WORKERS, thread_name_prefix='stream')
+        return _stream_executor
+
+def run_watermark_request(data):
+    """Process a validated body outside a request; returns (response body, status)"""
+    with app.app_context():
+        result = _process_watermark_request(data)
+        if isinstance(result, tuple):
+            response, status = result
+            return response.get_json(), status
+    return result, 200
+
+def process_stream_item(number, line):
+    """Watermark one NDJSON line; returns its result line as a dict"""
+    try:
+        data = json.loads(line)
+    except ValueError as e:
+        return {'line': number, 'success': False, 'status': 400, 'error': f'Invalid JSON: {str(e)}'}
+    # Results come back out of order, so every one carries the client's id
+    item_id = data.pop('id', number) if isinstance(data, dict) else number
+    try:
+        data, error = prepare_watermark_request(data)
+        if error:
+            return {'id': item_id, 'success': False, 'status': 400, 'error': error}
+        body, status = run_watermark_request(data)
+        if status != 200:
+            return dict(body, id=item_id, success=False, status=status)
+        return dict(body, id=item_id)
+    except Exception as e:
+        return {'id': item_id, 'success': False, 'status': 500, 'error': f'Processing failed: {str(e)}'}
+
+def stream_results(lines, window=STREAM_WINDOW):
+    """Yield result lines as items finish, reading at most `window` items ahead"""
+    results = queue.Queue()
+    slots = threading.Semaphore(window)
+    stopped = threading.Event()
+    
+    def read():
+        submitted = 0
+        try:
+            for number, line in enumerate(lines, 1):
+                if not line.strip():
+                    continue
+                # Wait for a result to be written before reading another item
+                slots.acquire()
+                if stopped.is_set():
+                    break
+                future = _stream_pool().submit(process_stream_item, number, line)
+                future.add_done_callback(lambda f: results.put(f.result()))
+                submitted += 1
+        except Exception as e:
+            results.put({'success': False, 'status': 400, 'error': f'Reading the request failed: {str(e)}'})
+            submitted += 1
+        results.put(submitted)
+    
+    threading.Thread(target=read, name='stream-reader', daemon=True).start()
+    written, total = 0, None
+    try:
+        while total is None or written < total:
+            item = results.get()
+            if isinstance(item, int):
+                total = item
+                continue
+            yield json.dumps(item) + '\n'
+            written += 1
+            slots.release()
+    finally:
+        # Client went away: let the reader stop instead of waiting for a slot
+        stopped.set()
+        slots.release()
+
+@app.route('/watermark/stream', methods=['POST'])
+def watermark_stream():
+    """Newline-delimited JSON in, one result line per item out as each finishes"""
+    return Response(stream_results(request.stream), mimetype='application/x-ndjson')
+
+def _job_pool():
+    global _job_executor
+    with _job_lock:
+        if _job_executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='job')
+        return _job_executor
+
+def run_job(job_id, data, accepted_at):
+    """Watermark in the background, then queue the completion callback"""
+    started = time.monotonic()
+    try:
+        body, status = run_watermark_request(data)
+    except Exception as e:
+        body, status = {'error': f'Processing failed: {str(e)}'}, 500
+    finished = time.monotonic()
+    
+    payload = {
+        'job_id': job_id,
+        'status': 'succeeded' if status == 200 else 'failed',
+        'timings': {
+            'queued_ms': round((started - accepted_at) * 1000, 1),
+            'processing_ms': round((finished - started) * 1000, 1),
+            'total_ms': round((finished - accepted_at) * 1000, 1)
+        }
+    }
+    if status == 200:
+        # Inline image, or only metadata (with output_path) for shared-volume jobs
+        payload['result'] = body
+    else:
+        payload.update(error=body.get('error'), status_code=status)
+    try:
+        webhooks.send(data['callback_url'], payload, job_id)
+    except Exception as e:
+        # Never queued, so its outbox slot would otherwise be held for good
+        webhooks.release()
+        log_event(webhooks.logger, 'webhook_failed', job_id=job_id, url=data['callback_url'],
+                  error=f'{type(e).__name__}: {e}')
+
+def submit_job(data):
+    """Accept a /watermark request for background processing (202)"""
+    try:
+        webhooks.validate_url(data['callback_url'])
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not webhooks.reserve():
+        return jsonify({'error': 'Too many jobs waiting for callbacks, retry later'}), 503
+    job_id = str(data.get('job_id') or uuid.uuid4().hex)
+    try:
+        _job_pool().submit(run_job, job_id, data, time.monotonic())
+    except RuntimeError:
+        webhooks.release()  # shutting down
+        raise
+    return jsonify({'success': True, 'job_id': job_id, 'status': 'accepted'}), 202
+
+def verify_item(item):
+    """Check one /verify item for the forensic mark"""
+    if not isinstance(item, dict) or ('image' not in item and 'input_path' not in item):
+        return {'error': 'Each item needs image or input_path'}
+    result = {'id': item['id']} if 'id' in item else {}
+    try:
+        with ExitStack() as resources:
+            if 'input_path' in item:
+                try:
+                    source = resources.enter_context(open_shared_input(
+                        resolve_shared_path(item['input_path']), item['input_path']))
+                except ValueError as e:
+                    result['error'] = f'Invalid path: {str(e)}'
+                    return result
+            else:
+                source = io.BytesIO(base64.b64decode(item['image']))
+            image = Image.open(source, formats=DECODE_FORMATS)
+            image.load()  # the first frame of an animation
+            result.update(_forensic().verify(image, item.get('id_code')))
+    except Exception as e:
+        result['error'] = invalid_image(e)
+    return result
+
+@app.route('/verify', methods=['POST'])
+def verify_images():
+    """Check many images for the invisible forensic mark in one call"""
+    data = request.get_json()
+    items = data.get('items') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'items must be a non-empty list like [{"image": "...", "id_code": "..."}]'}), 400
+    if len(items) > VERIFY_MAX_ITEMS:
+        return jsonify({'error': f'At most {VERIFY_MAX_ITEMS} items per call'}), 400
+    
+    results = [verify_item(item) for item in items]
+    return jsonify({
+        'results': results,
+        'summary': {
+            'checked': len(results),
+            'detected': sum(1 for r in results if r.get('detected')),
+            'matched': sum(1 for r in results if r.get('match')),
+            'errors': sum(1 for r in results if 'error' in r)
+        }
+    })
+
+def open_image_header(encoded):
+    """Open a base64 image from only as much of its start as its header needs"""
+    # Whole 4-character groups, so every prefix decodes on its own
+    chunk = HEADER_PROBE_BYTES // 3 * 4
+    while True:
+        try:
+            # Pillow reads the header in Image.open; pixels are never decoded here
+            return Image.open(io.BytesIO(base64.b64decode(encoded[:chunk])), formats=DECODE_FORMATS)
+        except (OSError, EOFError):
+            # A header cut off by the probe reads as an unidentified or truncated image
+            if chunk >= len(encoded):
+                raise
+            chunk *= 4  # large EXIF/ICC blocks or a TIFF directory further in
+
+def watermark_layout(img_size, social_handle, id_code, config):
+    """Bounding boxes of every watermark layer, without touching any pixels"""
+    spec = compile_spec(config)
+    layout = {'logos': [], 'items': []}
+    for logo in spec.logos:
+        placement = logo_placement(img_size, logo)
+        layout['logos'].append({'name': logo.name, 'box': list(placement.box)})
+    if spec.pattern:
+        tiles = pattern_placements(img_size, f"{social_handle}  {id_code}", spec.pattern, spec.style)
+        layout['pattern'] = {'tiles': len(tiles), 'tile_size': list(tiles[0].image.size) if tiles else None}
+    else:
+        for item in spec.items:
+            text = item.text(social_handle, id_code)
+            placement = text_placement(text, item.position, img_size, item.style)
+            layout['items'].append({'role': item.role, 'text': text, 'box': list(placement.box)})
+    return layout
+
+@app.route('/layout', methods=['POST'])
+def layout_preview():
+    """Where the watermark would land: /watermark's body, image header only"""
+    data, error = prepare_watermark_request(request.get_json())
+    if error:
+        return jsonify({'error': error}), 400
+    started = time.perf_counter()
+    try:
+        config = build_config(data)
+        compile_spec(config)
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': f'Invalid watermark config: {str(e)}'}), 400
+    
+    try:
+        input_path = resolve_shared_path(data['input_path']) if 'input_path' in data else None
+    except ValueError as e:
+        return jsonify({'error': f'Invalid path: {str(e)}'}), 400
+    
+    with ExitStack() as resources:
+        if input_path:
+            try:
+                source = resources.enter_context(open_shared_input(input_path, data['input_path']))
+            except ValueError as e:
+                return jsonify({'error': f'Invalid path: {str(e)}'}), 400
+        try:
+            # Either way only the header is read
+            image = Image.open(source, formats=DECODE_FORMATS) if input_path else open_image_header(data['image'])
+            size, image_format = image.size, image.format
+        except Exception as e:
+            return jsonify({'error': invalid_image(e)}), 400
+    
+    layout = watermark_layout(size, data['social_handle'], data['id_code'], config)
+    return jsonify(dict(layout, success=True, width=size[0], height=size[1], format=image_format,
+                        elapsed_ms=round((time.perf_counter() - started) * 1000, 3)))
+
+# name -> preset fields; a preset holds any request field except the image
+PRESETS = {}
+_presets_lock = threading.Lock()
+PRESET_FIELDS = ('font_size', 'font', 'font_color', 'stroke_color', 'stroke_width', 'position',
+                 'margin', 'opacity', 'transparency', 'handle_position', 'id_position',
+                 'handle_style', 'id_style', 'pattern', 'logos', 'shadow', 'glow', 'color_palette',
+                 'social_handle', 'id_code', 'format', 'quality', 'large_image', 'forensic')
+
+def prewarm_preset(preset):
+    """Compile a preset and render every sprite whose text it fixes"""
+    spec = compile_spec(build_config(preset))
+    handle = preset.get('social_handle')
+    id_code = preset.get('id_code')
+    sprites = 0
+    if spec.pattern:
+        if spec.pattern.text or (handle and id_code):
+            _render_pattern_tile(spec.pattern.text or f"{handle}  {id_code}", spec.style, spec.pattern.angle)
+            sprites += 1
+    else:
+        for item in spec.items:
+            needed = {'handle': (handle,), 'id': (id_code,), 'combined': (handle, id_code)}[item.role]
+            if all(needed):
+                render_text_sprite(item.text(handle, id_code), item.style)
+                sprites += 1
+    fonts = len({(item.style.font_name, item.style.font_size) for item in spec.items} |
+                {(spec.style.font_name, spec.style.font_size)})
+    return spec, {'fonts': fonts, 'sprites': sprites}
+
+def register_preset(name, preset):
+    """Validate, warm and store a preset; returns (spec, warmed counts)"""
+    unknown = sorted(set(preset) - set(PRESET_FIELDS))
+    if unknown:
+        raise ValueError(f'unknown preset fields: {", ".join(unknown)}')
+    for logo in preset.get('logos') or []:
+        if logo.get('name') not in LOGOS:
+            raise ValueError(f'unknown logo: {logo.get("name")}')
+    spec, warmed = prewarm_preset(preset)
+    with _presets_lock:
+        PRESETS[name] = preset
+    return spec, warmed
+
+def unregister_preset(name):
+    with _presets_lock:
+        return PRESETS.pop(name, None) is not None
+
+def load_presets_file(path):
+    """Register every preset in a JSON file of {"name": {fields...}}"""
+    with open(path) as f:
+        presets = json.load(f)
+    for name, preset in presets.items():
+        register_preset(name, preset)
+
+def apply_preset(data):
+    """Request body with its preset's fields filled in (KeyError if unknown)"""
+    with _presets_lock:
+        preset = PRESETS[data['preset']]
+    merged = dict(preset)
+    for key, value in data.items():
+        # Style blocks are merged so a request can override a single field
+        if key in ('handle_style', 'id_style') and isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = dict(merged[key], **value)
+        else:
+            merged[key] = value
+    return merged
+
+def watermark_to_file(image, fp, social_handle, id_code, config, output_format,
+                      quality=95, animated=False, large_image=False, forensic=False):
+    """Watermark a decoded image and encode it into fp in output_format"""
+    if animated:
+        frames, info = add_watermark_frames(image, social_handle, id_code, config)
+        save_animation(frames, info, fp, output_format, quality)
+        return
+    
+    # Add watermark
+    if large_image:
+        watermarked_image = add_watermark_regions(image, social_handle, id_code, config)
+    else:
         watermarked_image = add_watermark(image, social_handle, id_code, config)
+    
+    # Handle RGBA to RGB conversion for JPEG
+    watermarked_image = prepare_for_format(watermarked_image, output_format)
+    
+    # Invisible id_code mark, on the final pixels so flattening cannot disturb it
+    if forensic and output_format in FORENSIC_FORMATS:
+        with stage('forensic_embed') as s:
+            module = _forensic()
+            if watermarked_image.mode not in module.SUPPORTED_MODES:
+                watermarked_image = watermarked_image.convert(
+                    'RGBA' if 'A' in watermarked_image.getbands() else 'RGB')
+            s.note(embedded=module.embed(watermarked_image, id_code))
+    
+    # Save to bytes
+    with stage('encode') as s:
+        watermarked_image.save(fp, format=output_format, quality=quality)
+        s.note(output_bytes=fp.tell(), output_format=output_format)
+
+def build_config(data):
+    """Watermark config dict from a /watermark request body"""
+    return {
+        'font_size': data.get('font_size', 24),
+        'font': data.get('font', 'DejaVuSans-Bold.ttf'),
+        'font_color': data.get('font_color', '#FFFFFF'),
+        'stroke_color': data.get('stroke_color', '#000000'),
+        'stroke_width': data.get('stroke_width', 2),
+        'position': data.get('position', 'bottom-right'),
+        'margin': data.get('margin', 20),
+        'opacity': data.get('opacity', 200),
+        'transparency': data.get('transparency', 1.0),  # Transparency control
+        # Separate positioning options
+        'handle_position': data.get('handle_position'),
+        'id_position': data.get('id_position'),
+        'handle_style': data.get('handle_style', {}),
+        'id_style': data.get('id_style', {}),
+        # Tiled full-frame pattern mode
+        'pattern': data.get('pattern'),
+        # Registered logo layers
+        'logos': data.get('logos', []),
+        # Text effects, rendered into the cached sprites
+        'shadow': data.get('shadow'),
+        'glow': data.get('glow'),
+        # Choices for "auto" font/stroke colors
+        'color_palette': data.get('color_palette')
+    }
+
+def resolve_shared_path(path):
+    """Real path for a request path, which must stay inside SHARED_ROOT"""
+    if not SHARED_ROOT:
+        raise ValueError('paths are disabled on this server (set WATERMARK_SHARED_ROOT)')
+    if not isinstance(path, str) or not path or '\x00' in path:
+        raise ValueError('path must be a non-empty string')
+    # realpath follows symlinks, so a link cannot point out of the root
+    resolved = os.path.realpath(os.path.join(SHARED_ROOT, path))
+    if os.path.commonpath([SHARED_ROOT, resolved]) != SHARED_ROOT:
+        raise ValueError(f'{path} is outside the shared root')
+    # The root itself or any directory cannot be read as an image or replaced by one
+    if resolved == SHARED_ROOT or os.path.isdir(resolved):
+        raise ValueError(f'{path} is a directory, not a file')
+    return resolved
+
+@contextmanager
+def open_shared_input(path, name):
+    """Memory-map a shared input file; pages are read on demand, not copied.
+    
+    A file that cannot be mapped is a ValueError naming it as the caller
+    did (name), never by its resolved path on this server.
+    """
+    try:
+        f = open(path, 'rb')
+    except OSError as e:
+        raise ValueError(f'{name}: {e.strerror or "cannot be opened"}') from None
+    with f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise ValueError(f'{name} is empty')
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield mapped
+
+def write_atomically(path, write):
+    """Call write(file) on a temporary file and rename it to path when done.
+    
+    The temporary file is created in path's own directory (hidden, with a
+    .partial suffix that watchers skip), so it never lands outside it.
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    f = tempfile.NamedTemporaryFile(dir=directory, prefix=f'.{os.path.basename(path)}.',
+                                    suffix='.partial', delete=False)
+    try:
+        with f:
+            write(f)
+            size = f.tell()
+        os.replace(f.name, path)
+    except BaseException:
+        if os.path.exists(f.name):
+            os.remove(f.name)
+        raise
+    return size
+
+def _render_pool():
+    """The render process pool, or None when rendering in this process"""
+    global _render_processes
+    if not render_pool.enabled():
+        return None
+    with _render_lock:
+        if _render_processes is None:
+            _render_processes = render_pool.RenderPool(render_pool.PROCESSES)
+        return _render_processes
+
+def _process_watermark_request(data, debug_profile=False):
+    """Decode, watermark and encode one /watermark request body"""
+    # Keeps a memory-mapped input open until the response is built
+    with ExitStack() as resources:
+        return _watermark_request(data, resources, debug_profile)
+
+def _watermark_request(data, resources, debug_profile):
+    # Compiled once per distinct config, and validated before decoding
+    config = build_config(data)
+    note_access(diagnostic=True, config=config)
+    try:
+        spec = compile_spec(config)
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': f'Invalid watermark config: {str(e)}'}), 400
+    
+    # Files on the shared volume instead of base64 in the body
+    try:
+        input_path = resolve_shared_path(data['input_path']) if 'input_path' in data else None
+        output_path = resolve_shared_path(data['output_path']) if data.get('output_path') else None
+    except ValueError as e:
+        return jsonify({'error': f'Invalid path: {str(e)}'}), 400
+    
+    # Pixels are only ever decoded inside a render process when the pool is on
+    pool = _render_pool()
+    if pool is not None and not debug_profile:
+        return _render_in_pool(pool, data, config, input_path, output_path)
+    
+    if input_path:
+        try:
+            source = resources.enter_context(open_shared_input(input_path, data['input_path']))
+        except ValueError as e:
+            return jsonify({'error': f'Invalid path: {str(e)}'}), 400
+    
+    # Decode the image (base64 or memory-mapped file)
+    try:
+        if input_path:
+            input_bytes = len(source)
+        else:
+            image_data = base64.b64decode(data['image'])
+            source = io.BytesIO(image_data)
+            input_bytes = len(image_data)
+        image = decode_image(source, input_bytes)
+    except Exception as e:
+        return jsonify({'error': invalid_image(e)}), 400
+    
+    try:
+        options = output_options(image, data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    def render():
+        if output_path:
+            # Straight to disk: no output buffer and no base64
+            return render_output(image, data, spec, options, output_path=output_path), None
         
-        # Convert to output format
-        output_format = data.get('format', 'JPEG').upper()
-        
-        # Handle RGBA to RGB conversion for JPEG
-        if watermarked_image.mode in ('RGBA', 'P') and output_format == 'JPEG':
-            rgb_image = Image.new('RGB', watermarked_image.size, (255, 255, 255))
-            if watermarked_image.mode == 'P':
-                watermarked_image = watermarked_image.convert('RGBA')
-            rgb_image.paste(watermarked_image, mask=watermarked_image.split()[-1] if watermarked_image.mode == 'RGBA' else None)
-            watermarked_image = rgb_image
-        
-        # Save to bytes
-        img_byte_arr = io.BytesIO()
-        quality = data.get('quality', 95)
-        watermarked_image.save(img_byte_arr, format=output_format, quality=quality)
-        img_byte_arr.seek(0)
-        
-        # Return base64 encoded image
-        encoded_img = base64.b64encode(img_byte_arr.getvalue()).decode('utf-8')
-        
-        return jsonify({
-            'success': True,
-            'image': encoded_img,
-            'metadata': {
-                'social_handle': social_handle,
-                'id_code': id_code,
-                'positions': {
-                    'handle': config.get('handle_position', config.get('position')),
-                    'id': config.get('id_position', config.get('position'))
-                },
-                'font_size': config['font_size'],
-                'transparency': config['transparency'],
-                'format': output_format,
-                'processed_at': datetime.utcnow().isoformat()
-            }
-        })
+        # Sized like the input; the encoded output is usually in the same range
+        img_byte_arr = buffer_pool.acquire(input_bytes)
+        try:
+            details = render_output(image, data, spec, options, img_byte_arr)
+            
+            # Return base64 encoded image
+            with stage('base64_encode'):
+                with img_byte_arr.getbuffer() as encoded:
+                    return details, base64.b64encode(encoded).decode('utf-8')
+        finally:
+            buffer_pool.release(img_byte_arr)
+    
+    profile_text = None
+    if debug_profile:
+        (details, encoded_img), profile_text = profile_call(render)
+    else:
+        details, encoded_img = render()
+    details['input_bytes'] = input_bytes
+    note_image_access(details)
+    
+    result = watermark_result(data, config, details, encoded_img)
+    if profile_text is not None:
+        result['metadata']['profile'] = profile_text
+    return result
+
+def _render_in_pool(pool, data, config, input_path, output_path):
+    """Render a request in a render process; this process never decodes it"""
+    input_bytes = None
+    if not input_path:
+        try:
+            input_bytes = base64.b64decode(data['image'])
+        except Exception as e:
+            return jsonify({'error': invalid_image(e)}), 400
+    
+    task = {
+        'data': {key: value for key, value in data.items() if key != 'image'},
+        'config': config,
+        'input_path': input_path,
+        'output_path': output_path
+    }
+    with _logos_lock:
+        logos = dict(LOGOS)
+    # The output lives in shared memory until the stack closes
+    with ExitStack() as resources:
+        try:
+            with stage('render_process') as s:
+                details, output = resources.enter_context(pool.render(task, logos, input_bytes))
+                s.note(output_bytes=details['output_bytes'])
+        except render_pool.RenderError as e:
+            return jsonify({'error': str(e)}), e.status
+        record_stages(details.pop('stages'))
+        note_access(render_caches=access_log.cache_outcomes(details.pop('caches')))
+        note_image_access(details)
         
-    except Exception as e:
-        return jsonify({'error': f'Processing failed: {str(e)}'}), 500
+        encoded_img = None
+        if output is not None:
+            with stage('base64_encode'):
+                encoded_img = base64.b64encode(output).decode('utf-8')
+    return watermark_result(data, config, details, encoded_img)
+
+def render_task(task, source, fp=None):
+    """Render one task in a render process (see render_pool._serve).
+    
+    Raises ValueError for bad input, which the parent answers with a 400.
+    """
+    for name, logo in task['logos'].items():
+        if logo is None:
+            unregister_logo(name)
+        else:
+            register_logo(name, logo[1])
+    # Stages and cache use go back to the web worker's access log
+    recorder = StageRecorder()
+    caches_before = cache_snapshot()
+    data = task['data']
+    spec = compile_spec(task['config'])
+    with ExitStack() as resources:
+        resources.enter_context(recorder.activate())
+        if task['input_path']:
+            try:
+                source = resources.enter_context(open_shared_input(task['input_path'], data['input_path']))
+            except ValueError as e:
+                raise ValueError(f'Invalid path: {str(e)}')
+        try:
+            if task['input_path']:
+                input_bytes = len(source)
+            else:
+                input_bytes = task['input'][1]
+            image = decode_image(source, input_bytes)
+        except Exception as e:
+            raise ValueError(invalid_image(e))
+        # Drops the image's hold on the shared input before it is closed
+        resources.callback(image.close)
+        details = render_output(image, data, spec, output_options(image, data), fp, task['output_path'])
+    details.update(input_bytes=input_bytes, stages=recorder.to_dict()['stages'],
+                   caches=cache_delta(caches_before, cache_snapshot()))
+    return details
+
+def decode_image(source, input_bytes):
+    """Open and decode an input image from a file-like source"""
+    with stage('decode') as s:
+        image = Image.open(source, formats=DECODE_FORMATS)
+        image.load()
+        s.note(input_bytes=input_bytes, input_format=image.format)
+        s.image(image)
+    return image
+
+# How a decoded image is written: format, quality and which render path
+OutputOptions = namedtuple('OutputOptions', ['format', 'quality', 'animated', 'large_image', 'forensic'])
+
+def output_options(image, data):
+    """Output settings for a request; ValueError for an unsupported format"""
+    # Animated input stays animated (and in its own format unless one is requested)
+    animated = getattr(image, 'is_animated', False)
+    default_format = image.format if animated and image.format in ANIMATED_FORMATS else 'JPEG'
+    output_format = data.get('format', default_format).upper()
+    if IMAGE_FORMATS is not None and output_format not in IMAGE_FORMATS:
+        raise ValueError(f'Unsupported output format: {output_format}')
+    animated = animated and output_format in ANIMATED_FORMATS
+    if animated:
+        check_animation_size(image)
+    
+    # Very large stills are watermarked in place to bound memory
+    large_image = not animated and (
+        _is_truthy(data.get('large_image', False)) or
+        image.width * image.height >= LARGE_IMAGE_PIXELS
+    )
+    forensic = (_is_truthy(data.get('forensic', FORENSIC_DEFAULT)) and
+                not animated and output_format in FORENSIC_FORMATS)
+    return OutputOptions(output_format, data.get('quality', 95), animated, large_image, forensic)
+
+def render_output(image, data, spec, options, fp=None, output_path=None):
+    """Watermark and encode into fp, or atomically into output_path.
+    
+    Returns the details watermark_result() reports.
+    """
+    def write(f):
+        watermark_to_file(image, f, data['social_handle'], data['id_code'], spec, options.format,
+                          options.quality, options.animated, options.large_image, options.forensic)
+    
+    if output_path:
+        output_bytes = write_atomically(output_path, write)
+    else:
+        write(fp)
+        output_bytes = fp.tell()
+    return {
+        'size': list(image.size),
+        'input_format': image.format,
+        'input_mode': image.mode,
+        'format': options.format,
+        'output_bytes': output_bytes,
+        'frames': image.n_frames if options.animated else None,
+        'large_image': options.large_image,
+        'forensic': options.forensic
+    }
+
+def note_image_access(details):
+    """Input and output dimensions, bytes and formats for the access log"""
+    width, height = details['size']
+    note_access(
+        input={'format': details['input_format'], 'mode': details['input_mode'],
+               'width': width, 'height': height, 'bytes': details['input_bytes']},
+        output={'format': details['format'], 'width': width, 'height': height,
+                'bytes': details['output_bytes'], 'frames': details['frames']}
+    )
+
+def watermark_result(data, config, details, encoded_img=None):
+    """The /watermark response body for a rendered request"""
+    result = {
+        'success': True,
+        'metadata': {
+            'social_handle': data['social_handle'],
+            'id_code': data['id_code'],
+            'positions': {
+                'handle': config.get('handle_position', config.get('position')),
+                'id': config.get('id_position', config.get('position'))
+            },
+            'font_size': config['font_size'],
+            'transparency': config['transparency'],
+            'format': details['format'],
+            'processed_at': datetime.utcnow().isoformat()
+        }
+    }
+    if data.get('output_path'):
+        result['metadata'].update(output_path=data['output_path'], output_bytes=details['output_bytes'])
+    else:
+        result['image'] = encoded_img
+    if 'input_path' in data:
+        result['metadata']['input_path'] = data['input_path']
+    if data.get('preset'):
+        result['metadata']['preset'] = data['preset']
+    if config['pattern']:
+        result['metadata']['pattern'] = config['pattern']
+    if details['frames']:
+        result['metadata']['frames'] = details['frames']
+    if details['large_image']:
+        result['metadata']['large_image'] = True
+    if details['forensic']:
+        result['metadata']['forensic'] = True
+    return result
+
+buffer_pool.configure_image_pool()
+DECODE_FORMATS = load_image_plugins()
+
+if LOGO_DIR:
+    load_logo_dir(LOGO_DIR)
+
+if PRESETS_FILE:
+    load_presets_file(PRESETS_FILE)
+
+STARTUP['import_seconds'] = round(time.monotonic() - _IMPORT_STARTED, 4)
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    debug = True
+    # The debug reloader's watcher process only restarts the server, so
+    # warming up (and starting render processes) there would be wasted
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_warm_up()
+        memory_stats.start_rss_sampler()
+    app.run(host='0.0.0.0', port=5000, debug=debug)
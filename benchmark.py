@@ -0,0 +1,389 @@
+"""In-process benchmark for the watermark pipeline.
+
+Drives add_watermark directly and the /watermark route through the Flask
+test client (no running container needed) across a matrix of image sizes,
+input formats/modes, positioning, transparency and output formats.
+
+    python benchmark.py                          # quick matrix, JSON to stdout
+    python benchmark.py --full -o results.json   # 1MP-50MP, all output formats
+    python benchmark.py --save-baseline baseline.json
+    python benchmark.py --baseline baseline.json --fail-on-regression
+    python benchmark.py --engines pillow,numpy --targets add_watermark
+"""
+import argparse
+import base64
+import io
+import itertools
+import json
+import math
+import platform
+import sys
+import time
+from datetime import datetime
+
+import PIL
+from PIL import Image, ImageChops
+
+import access_log
+import app as service
+import memory_stats
+from profiling import StageRecorder, percentile
+
+# Input modes each input format can actually store
+FORMAT_MODES = {
+    'JPEG': ('RGB', 'L'),
+    'PNG': ('RGB', 'RGBA', 'P', 'L'),
+    'WEBP': ('RGB', 'RGBA')
+}
+
+QUICK_SIZES = [1, 4]
+FULL_SIZES = [1, 4, 12, 24, 50]
+
+SEPARATE_POSITIONING = {
+    'handle_position': {'left': '5%', 'bottom': '5%'},
+    'id_position': {'right': '5%', 'top': '5%'},
+    'handle_style': {'font_color': '#FF6B35', 'font_size': 32},
+    'id_style': {'font_color': '#FFFFFF', 'font_size': 20}
+}
+
+
+def latency_summary(samples_ms):
+    return {
+        'min': round(min(samples_ms), 3),
+        'mean': round(sum(samples_ms) / len(samples_ms), 3),
+        'p50': round(percentile(samples_ms, 50), 3),
+        'p90': round(percentile(samples_ms, 90), 3),
+        'p99': round(percentile(samples_ms, 99), 3),
+        'max': round(max(samples_ms), 3)
+    }
+
+
+def dimensions_for(megapixels):
+    """4:3 dimensions for roughly the requested number of megapixels"""
+    width = int(math.sqrt(megapixels * 1_000_000 * 4 / 3))
+    return width, int(width * 3 / 4)
+
+
+def make_test_image(megapixels, mode):
+    """Deterministic synthetic photo-like image in the requested mode"""
+    size = dimensions_for(megapixels)
+    red = Image.linear_gradient('L').resize(size)
+    green = Image.radial_gradient('L').resize(size)
+    blue = red.rotate(90).resize(size)
+    img = Image.merge('RGB', (red, green, blue))
+    if mode == 'RGBA':
+        img.putalpha(green.point(lambda p: 255 - p // 2))
+    elif mode == 'P':
+        img = img.quantize(colors=256)
+    elif mode == 'L':
+        img = img.convert('L')
+    return img
+
+
+def encode_test_image(img, input_format):
+    buffer = io.BytesIO()
+    img.save(buffer, format=input_format, quality=90)
+    return buffer.getvalue()
+
+
+def build_config(positioning, transparency):
+    """Same shape of config that /watermark builds from a request"""
+    config = {
+        'font_size': 24,
+        'font': 'DejaVuSans-Bold.ttf',
+        'font_color': '#FFFFFF',
+        'stroke_color': '#000000',
+        'stroke_width': 2,
+        'position': 'bottom-right',
+        'margin': 20,
+        'transparency': 0.7 if transparency == 'on' else 1.0,
+        'handle_position': None,
+        'id_position': None,
+        'handle_style': {},
+        'id_style': {}
+    }
+    if positioning == 'separate':
+        config.update(SEPARATE_POSITIONING)
+    return config
+
+
+def build_request(encoded, positioning, transparency, output_format):
+    body = {
+        'image': base64.b64encode(encoded).decode('utf-8'),
+        'social_handle': '@benchmark',
+        'id_code': 'BENCH-001',
+        'transparency': 0.7 if transparency == 'on' else 1.0,
+        'format': output_format
+    }
+    if positioning == 'separate':
+        body.update(SEPARATE_POSITIONING)
+    return body
+
+
+def measure(func, repeat, warmup):
+    """Run func warmup+repeat times and return per-run latencies in ms"""
+    for _ in range(warmup):
+        func()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def peak_from_stages(stages):
+    """Estimated peak bytes from per-stage memory figures"""
+    return (sum(s['image_bytes'] for s in stages) +
+            max((s['python_peak_bytes'] for s in stages), default=0))
+
+
+def measure_peak_memory(func):
+    """Estimated peak bytes of one run, from a tracked stage recording"""
+    recorder = StageRecorder(track_allocations=True)
+    with recorder.activate():
+        func()
+    return peak_from_stages(memory_stats.summarize_stages(recorder))
+
+
+def measure_route_peak_memory(client, body):
+    """Estimated peak bytes of one /watermark request.
+
+    The view records its stages on its own recorder, so the figures come
+    back in the response's debug output instead.
+    """
+    enabled = service.DEBUG_TIMINGS_ENABLED
+    service.DEBUG_TIMINGS_ENABLED = True
+    try:
+        response = client.post('/watermark', json=dict(body, debug_timings=True))
+    finally:
+        service.DEBUG_TIMINGS_ENABLED = enabled
+    if response.status_code != 200:
+        raise RuntimeError(f"/watermark returned {response.status_code}: {response.get_json()}")
+    return peak_from_stages(response.get_json()['metadata']['debug']['memory'])
+
+
+def engine_parity(image, config):
+    """Largest channel difference and changed-pixel share of NumPy vs Pillow"""
+    outputs = {}
+    for engine in ('pillow', 'numpy'):
+        service.RENDER_ENGINE = engine
+        outputs[engine] = service.add_watermark(image, '@benchmark', 'BENCH-001', config)
+    diff = ImageChops.difference(outputs['pillow'], outputs['numpy'])
+    # Largest channel difference per pixel
+    bands = diff.split()
+    worst = bands[0]
+    for band in bands[1:]:
+        worst = ImageChops.lighter(worst, band)
+    histogram = worst.histogram()
+    return {
+        'max_channel_diff': max(i for i, count in enumerate(histogram) if count),
+        'changed_pixel_ratio': round(sum(histogram[1:]) / (image.width * image.height), 6)
+    }
+
+
+def iter_cases(args):
+    for size, input_format in itertools.product(args.sizes, args.formats):
+        for mode in FORMAT_MODES[input_format]:
+            if mode not in args.modes:
+                continue
+            for positioning, transparency in itertools.product(args.positioning, args.transparency):
+                for target, engine in itertools.product(args.targets, args.engines):
+                    # add_watermark never encodes, so output format does not apply
+                    outputs = args.output_formats if target == 'route' else [None]
+                    for output_format in outputs:
+                        yield {
+                            'target': target,
+                            'engine': engine,
+                            'megapixels': size,
+                            'input_format': input_format,
+                            'mode': mode,
+                            'positioning': positioning,
+                            'transparency': transparency,
+                            'output_format': output_format
+                        }
+
+
+def case_id(case):
+    return '|'.join(str(case[k]) for k in (
+        'target', 'engine', 'megapixels', 'input_format', 'mode',
+        'positioning', 'transparency', 'output_format'))
+
+
+def run_case(case, client, image_cache, args):
+    key = (case['megapixels'], case['input_format'], case['mode'])
+    if key not in image_cache:
+        source = make_test_image(case['megapixels'], case['mode'])
+        image_cache.clear()  # keep at most one large source in memory
+        image_cache[key] = (source, encode_test_image(source, case['input_format']))
+    source, encoded = image_cache[key]
+    service.RENDER_ENGINE = case['engine']
+
+    if case['target'] == 'add_watermark':
+        decoded = Image.open(io.BytesIO(encoded))
+        decoded.load()
+        config = build_config(case['positioning'], case['transparency'])
+
+        def run():
+            service.add_watermark(decoded, '@benchmark', 'BENCH-001', config)
+    else:
+        body = build_request(encoded, case['positioning'], case['transparency'], case['output_format'])
+
+        def run():
+            response = client.post('/watermark', json=body)
+            if response.status_code != 200:
+                raise RuntimeError(f"/watermark returned {response.status_code}: {response.get_json()}")
+
+    samples = measure(run, args.repeat, args.warmup)
+    peak_memory = None
+    if args.memory:
+        if case['target'] == 'add_watermark':
+            peak_memory = measure_peak_memory(run)
+        else:
+            peak_memory = measure_route_peak_memory(client, body)
+    mean_s = sum(samples) / len(samples) / 1000
+    megapixels = source.width * source.height / 1_000_000
+    result = dict(case)
+    result.update({
+        'id': case_id(case),
+        'dimensions': list(source.size),
+        'input_bytes': len(encoded),
+        'runs': len(samples),
+        'latency_ms': latency_summary(samples),
+        'throughput': {
+            'images_per_s': round(1 / mean_s, 3),
+            'megapixels_per_s': round(megapixels / mean_s, 3)
+        },
+        'peak_memory_bytes': peak_memory
+    })
+    if case['engine'] == 'numpy' and case['target'] == 'add_watermark':
+        result['parity'] = engine_parity(decoded, config)
+    return result
+
+
+def compare(results, baseline, threshold):
+    """Compare p50 latency and throughput against a saved baseline"""
+    previous = {r['id']: r for r in baseline.get('results', [])}
+    comparison = []
+    for result in results:
+        before = previous.get(result['id'])
+        if not before:
+            continue
+        p50_ratio = result['latency_ms']['p50'] / before['latency_ms']['p50']
+        throughput_ratio = (result['throughput']['images_per_s'] /
+                            before['throughput']['images_per_s'])
+        entry = {
+            'id': result['id'],
+            'p50_ms': {'baseline': before['latency_ms']['p50'], 'current': result['latency_ms']['p50']},
+            'p50_ratio': round(p50_ratio, 3),
+            'throughput_ratio': round(throughput_ratio, 3),
+            'regression': p50_ratio > 1 + threshold
+        }
+        if result.get('peak_memory_bytes') and before.get('peak_memory_bytes'):
+            entry['memory_ratio'] = round(result['peak_memory_bytes'] / before['peak_memory_bytes'], 3)
+        comparison.append(entry)
+    return comparison
+
+
+def parse_size(value):
+    """Megapixel size; whole numbers stay ints so case ids are stable"""
+    size = float(value)
+    return int(size) if size.is_integer() else size
+
+
+def parse_list(value, cast=str):
+    return [cast(v.strip()) for v in value.split(',') if v.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='In-process watermark benchmark')
+    parser.add_argument('--sizes', type=lambda v: parse_list(v, parse_size),
+                        help='megapixel sizes, e.g. 1,4,12 (default 1,4; --full uses 1,4,12,24,50)')
+    parser.add_argument('--formats', type=parse_list, default=list(FORMAT_MODES),
+                        help='input formats (JPEG,PNG,WEBP)')
+    parser.add_argument('--modes', type=parse_list, default=['RGB', 'RGBA', 'P', 'L'],
+                        help='input modes (RGB,RGBA,P,L)')
+    parser.add_argument('--positioning', type=parse_list, default=['combined', 'separate'])
+    parser.add_argument('--transparency', type=parse_list, default=['off', 'on'])
+    parser.add_argument('--output-formats', type=parse_list,
+                        help='route output formats (default JPEG; --full uses JPEG,PNG,WEBP)')
+    parser.add_argument('--targets', type=parse_list, default=['add_watermark', 'route'])
+    parser.add_argument('--engines', type=parse_list, default=[service.RENDER_ENGINE],
+                        help='compositing engines to compare (pillow,numpy)')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per case')
+    parser.add_argument('--warmup', type=int, default=1, help='untimed runs per case')
+    parser.add_argument('--full', action='store_true', help='run the full size/output matrix')
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help='skip the extra tracked run used for peak memory')
+    parser.add_argument('-o', '--output', help='write results JSON here instead of stdout')
+    parser.add_argument('--baseline', help='compare against a previously saved results JSON')
+    parser.add_argument('--save-baseline', help='also save these results as a baseline JSON')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='p50 slowdown that counts as a regression (default 0.10)')
+    parser.add_argument('--fail-on-regression', action='store_true')
+    args = parser.parse_args(argv)
+
+    if args.sizes is None:
+        args.sizes = FULL_SIZES if args.full else QUICK_SIZES
+    if args.output_formats is None:
+        args.output_formats = ['JPEG', 'PNG', 'WEBP'] if args.full else ['JPEG']
+    args.formats = [f.upper() for f in args.formats]
+    args.output_formats = [f.upper() for f in args.output_formats]
+
+    # Large benchmark inputs are intentional
+    Image.MAX_IMAGE_PIXELS = None
+    # Keep sampling, access logging and their log lines out of the measurements
+    memory_stats.MEMORY_SAMPLE_RATE = 0
+    access_log.ACCESS_LOG_ENABLED = False
+    access_log.SLOW_REQUEST_MS = 0
+
+    client = service.app.test_client()
+    image_cache = {}
+    results = []
+    cases = list(iter_cases(args))
+    for index, case in enumerate(cases, 1):
+        result = run_case(case, client, image_cache, args)
+        results.append(result)
+        print(f"[{index}/{len(cases)}] {result['id']}: "
+              f"p50 {result['latency_ms']['p50']}ms, "
+              f"{result['throughput']['megapixels_per_s']} MP/s", file=sys.stderr)
+
+    report = {
+        'meta': {
+            'created_at': datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'pillow': PIL.__version__,
+            'engines': args.engines,
+            'platform': platform.platform(),
+            'repeat': args.repeat,
+            'warmup': args.warmup,
+            'peak_rss_bytes': memory_stats.peak_rss_bytes()
+        },
+        'results': results
+    }
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            report['comparison'] = compare(results, json.load(f), args.threshold)
+        regressions = [c for c in report['comparison'] if c['regression']]
+        for c in regressions:
+            print(f"⚠️  regression {c['id']}: p50 x{c['p50_ratio']}", file=sys.stderr)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            f.write(output)
+
+    if regressions and args.fail_on_regression:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,174 @@
+"""Reusable pixel and byte buffers for the request hot path.
+
+Pixel buffers: Pillow allocates image memory from an arena of fixed-size
+blocks. By default freed blocks go straight back to the heap, so every copy,
+RGBA conversion and JPEG flattening of a large image mallocs and frees
+megabytes. Keeping a bounded number of freed blocks cached lets the next
+request reuse them instead.
+
+Byte buffers: encoded output is written into pooled bytearrays, bucketed by
+power-of-two size, instead of a fresh BytesIO that grows by reallocation on
+every request. Outputs too large for the pool to ever keep get a plain
+BytesIO.
+"""
+import io
+import os
+import threading
+
+from PIL import Image
+
+# Both pools are per process, so every web worker and render process keeps
+# its own: size them for the worker count. Memory kept in freed Pillow
+# blocks for reuse (off unless set; Pillow's own default)
+IMAGE_POOL_BYTES = int(os.environ.get('WATERMARK_IMAGE_POOL_BYTES', 0))
+# Memory kept in idle encode buffers (0 disables)
+BYTE_POOL_BYTES = int(os.environ.get('WATERMARK_BYTE_POOL_BYTES', 8 * 1024 * 1024))
+MIN_BUCKET_BYTES = 64 * 1024
+
+_lock = threading.Lock()
+_buckets = {}  # capacity -> [bytearray, ...]
+_retained_bytes = 0
+_stats = {'acquired': 0, 'reused': 0, 'released': 0, 'dropped': 0, 'unpooled': 0}
+
+
+def configure_image_pool(max_bytes=IMAGE_POOL_BYTES):
+    """Cache up to max_bytes of freed Pillow blocks for reuse"""
+    blocks = max_bytes // Image.core.get_block_size() if max_bytes > 0 else 0
+    Image.core.set_blocks_max(blocks)
+    return blocks
+
+
+def _bucket(size):
+    """Smallest power-of-two capacity that holds size bytes"""
+    capacity = MIN_BUCKET_BYTES
+    while capacity < size:
+        capacity *= 2
+    return capacity
+
+
+def _bucket_below(size):
+    """Largest power-of-two capacity that size bytes fill (at least the smallest)"""
+    capacity = MIN_BUCKET_BYTES
+    while capacity * 2 <= size:
+        capacity *= 2
+    return capacity
+
+
+class PooledBuffer(io.RawIOBase):
+    """Writable file object backed by a pooled bytearray"""
+
+    def __init__(self, data):
+        super().__init__()
+        self._data = data
+        self._position = 0
+        self._length = 0
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def write(self, b):
+        data = self._data
+        with memoryview(b) as view, view.cast('B') as view:
+            size = view.nbytes
+            end = self._position + size
+            if self._position > len(data):
+                # A seek past the end leaves a gap of zeros, as in BytesIO
+                data.extend(bytes(self._position - len(data)))
+            # Overwrite what a previous request left, then append the rest
+            # straight from the view (no zero-filling, no temporary copy)
+            overlap = max(0, min(size, len(data) - self._position))
+            data[self._position:self._position + overlap] = view[:overlap]
+            if overlap < size:
+                data += view[overlap:]
+        self._position = end
+        self._length = max(self._length, end)
+        return size
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._length
+        self._position = max(0, offset)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def getbuffer(self):
+        """Written bytes, without copying; release the view before release()"""
+        return memoryview(self._data)[:self._length]
+
+    def getvalue(self):
+        return bytes(self._data[:self._length])
+
+
+def acquire(size_hint=0):
+    """A file object for about size_hint bytes of output: a PooledBuffer,
+    reusing an idle buffer of that size when there is one, or a BytesIO
+    when the pool could never keep a buffer that large"""
+    global _retained_bytes
+    capacity = _bucket(size_hint)
+    data = None
+    with _lock:
+        _stats['acquired'] += 1
+        if capacity > BYTE_POOL_BYTES:
+            _stats['unpooled'] += 1
+            return io.BytesIO()
+        # Reuse the smallest idle buffer that is large enough
+        for bucket in sorted(c for c in _buckets if c >= capacity and _buckets[c]):
+            data = _buckets[bucket].pop()
+            _retained_bytes -= len(data)
+            _stats['reused'] += 1
+            break
+    # A new buffer starts empty and grows as output is written
+    return PooledBuffer(data if data is not None else bytearray())
+
+
+def release(buffer):
+    """Return a buffer's memory to the pool, or drop it when the pool is full"""
+    global _retained_bytes
+    if not isinstance(buffer, PooledBuffer):
+        return
+    data = buffer._data
+    buffer._data = bytearray()
+    size = len(data)
+    with _lock:
+        if size and _retained_bytes + size <= BYTE_POOL_BYTES:
+            _buckets.setdefault(_bucket_below(size), []).append(data)
+            _retained_bytes += size
+            _stats['released'] += 1
+        else:
+            _stats['dropped'] += 1
+
+
+def snapshot():
+    """Reuse rates and retained bytes for the /metrics endpoint"""
+    image_stats = Image.core.get_stats()
+    block_size = Image.core.get_block_size()
+    block_requests = image_stats['allocated_blocks'] + image_stats['reused_blocks']
+    with _lock:
+        byte_stats = dict(_stats)
+        retained = _retained_bytes
+        idle = {str(capacity): len(items) for capacity, items in sorted(_buckets.items()) if items}
+    return {
+        'images': {
+            'block_size': block_size,
+            'max_blocks': Image.core.get_blocks_max(),
+            'cached_blocks': image_stats['blocks_cached'],
+            # Cached blocks are at most block_size each
+            'retained_bytes': image_stats['blocks_cached'] * block_size,
+            'allocated_blocks': image_stats['allocated_blocks'],
+            'reused_blocks': image_stats['reused_blocks'],
+            'reuse_rate': round(image_stats['reused_blocks'] / block_requests, 4) if block_requests else None
+        },
+        'bytes': dict(byte_stats, **{
+            'retained_bytes': retained,
+            'max_bytes': BYTE_POOL_BYTES,
+            'idle_buffers': idle,
+            'reuse_rate': round(byte_stats['reused'] / byte_stats['acquired'], 4) if byte_stats['acquired'] else None
+        })
+    }
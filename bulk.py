@@ -0,0 +1,231 @@
+"""Offline bulk watermarking for archive backfills.
+
+Walks an input directory (or reads a manifest), watermarks every image with
+add_watermark across all cores and writes the results to an output tree with
+the same layout. No HTTP and no base64: files are read and written directly.
+
+    python bulk.py photos/ watermarked/ --config style.json
+    python bulk.py photos/ watermarked/ --config style.json --workers 8 -o summary.json
+    python bulk.py photos/ watermarked/ --config style.json --manifest backfill.jsonl
+
+The config file uses the /watermark request format without "image" (a
+"preset" name works too). "social_handle" and "id_code" may contain {stem},
+{name} and {parent} placeholders, filled in per file. A manifest has one
+path per line (relative to the input directory), or JSON lines like
+{"path": "a/b.jpg", "id_code": "ARCH-001"} with per-file overrides.
+
+Finished files are recorded in a journal (.bulk-journal.jsonl in the output
+directory). Re-running the same command skips them, so an interrupted
+backfill resumes where it stopped.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from PIL import Image
+
+import app
+import memory_stats
+
+JOURNAL_NAME = '.bulk-journal.jsonl'
+EXTENSIONS = {
+    'JPEG': '.jpg', 'MPO': '.jpg', 'PNG': '.png', 'WEBP': '.webp', 'GIF': '.gif',
+    'TIFF': '.tif', 'BMP': '.bmp'
+}
+
+# Set in each worker process by _init_worker
+_worker = {}
+
+
+def find_images(input_dir):
+    """Relative paths of every file under input_dir with an image extension"""
+    suffixes = tuple(set(EXTENSIONS.values()) | {'.jpeg', '.tiff'})
+    paths = []
+    for root, dirs, files in os.walk(input_dir):
+        dirs.sort()
+        for file in sorted(files):
+            if file.lower().endswith(suffixes):
+                paths.append(os.path.relpath(os.path.join(root, file), input_dir))
+    return paths
+
+
+def read_manifest(path):
+    """(relative path, overrides) per manifest line: plain paths or JSON objects"""
+    entries = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('{'):
+                entry = json.loads(line)
+                entries.append((entry.pop('path'), entry))
+            else:
+                entries.append((line, {}))
+    return entries
+
+
+def read_journal(path):
+    """Relative paths already written successfully"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # torn last line after a crash
+            if record.get('status') == 'ok':
+                done.add(record['path'])
+    return done
+
+
+def load_config(path):
+    """Request-format config, with its preset (if any) applied"""
+    with open(path) as f:
+        data = json.load(f)
+    if data.get('preset'):
+        data = app.apply_preset(data)
+    return data
+
+
+def _fill(template, rel_path):
+    stem = os.path.splitext(os.path.basename(rel_path))[0]
+    return str(template).format(stem=stem, name=os.path.basename(rel_path),
+                                parent=os.path.basename(os.path.dirname(rel_path)))
+
+
+def _init_worker(data, input_dir, output_dir, output_format):
+    # Keep per-request sampling and its log lines out of the batch
+    memory_stats.MEMORY_SAMPLE_RATE = 0
+    _worker.update(data=data, input_dir=input_dir, output_dir=output_dir, output_format=output_format)
+
+
+def watermark_file(input_path, output_dir, rel_path, data, output_format=None):
+    """Watermark one file into output_dir/rel_path (extension follows the format).
+    
+    Returns a journal record; the output appears atomically or not at all.
+    """
+    started = time.perf_counter()
+    try:
+        spec = app.compile_spec(app.build_config(data))
+        with Image.open(input_path, formats=app.DECODE_FORMATS) as image:
+            image.load()
+            # Keep the input format (and animation) unless one is requested
+            output_format = (output_format or data.get('format') or image.format).upper()
+            if output_format == 'MPO':
+                output_format = 'JPEG'
+            animated = getattr(image, 'is_animated', False) and output_format in app.ANIMATED_FORMATS
+            large_image = not animated and image.width * image.height >= app.LARGE_IMAGE_PIXELS
+
+            stem, extension = os.path.splitext(rel_path)
+            if EXTENSIONS.get(output_format) != EXTENSIONS.get(image.format):
+                extension = EXTENSIONS.get(output_format, '.' + output_format.lower())
+            output_path = os.path.join(output_dir, stem + extension)
+
+            # Written next to the target and renamed, so a crash never leaves half a file
+            app.write_atomically(output_path, lambda f: app.watermark_to_file(
+                image, f, _fill(data['social_handle'], rel_path), _fill(data['id_code'], rel_path),
+                spec, output_format, data.get('quality', 95), animated, large_image,
+                app._is_truthy(data.get('forensic', app.FORENSIC_DEFAULT))))
+            pixels = image.width * image.height
+        return {'path': rel_path, 'status': 'ok', 'output': os.path.relpath(output_path, output_dir),
+                'pixels': pixels, 'ms': round((time.perf_counter() - started) * 1000, 1)}
+    except Exception as e:
+        return {'path': rel_path, 'status': 'failed', 'error': f'{type(e).__name__}: {e}'}
+
+
+def process_file(task):
+    """Pool task: watermark one file of the batch"""
+    rel_path, overrides = task
+    return watermark_file(os.path.join(_worker['input_dir'], rel_path), _worker['output_dir'], rel_path,
+                          dict(_worker['data'], **overrides), _worker['output_format'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Watermark a directory of images offline')
+    parser.add_argument('input_dir')
+    parser.add_argument('output_dir')
+    parser.add_argument('--config', required=True, help='JSON config in the /watermark request format')
+    parser.add_argument('--manifest', help='process only these files (paths or JSON lines)')
+    parser.add_argument('--format', help='output format for every file (default: keep the input format)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--chunksize', type=int, default=4, help='files handed to a worker at a time')
+    parser.add_argument('--journal', help=f'progress journal (default: OUTPUT_DIR/{JOURNAL_NAME})')
+    parser.add_argument('--restart', action='store_true', help='ignore the journal and redo every file')
+    parser.add_argument('-o', '--output', help='write the JSON summary here instead of stdout')
+    args = parser.parse_args(argv)
+
+    data = load_config(args.config)
+    for field in ('social_handle', 'id_code'):
+        if field not in data:
+            print(f"❌ config needs {field} (placeholders: {{stem}}, {{name}}, {{parent}})", file=sys.stderr)
+            return 2
+    app.compile_spec(app.build_config(data))  # fail fast on an invalid style
+
+    if args.manifest:
+        entries = read_manifest(args.manifest)
+    else:
+        entries = [(path, {}) for path in find_images(args.input_dir)]
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    journal_path = args.journal or os.path.join(args.output_dir, JOURNAL_NAME)
+    done = set() if args.restart else read_journal(journal_path)
+    tasks = [(path, overrides) for path, overrides in entries if path not in done]
+    skipped = len(entries) - len(tasks)
+    print(f"🗂️  {len(entries)} files, {skipped} already done, {len(tasks)} to process "
+          f"with {args.workers} workers", file=sys.stderr)
+
+    started = time.perf_counter()
+    succeeded, failures, pixels = 0, [], 0
+    # spawn, like the render pool: workers start clean instead of forking this process
+    with open(journal_path, 'a') as journal, multiprocessing.get_context('spawn').Pool(
+            args.workers, initializer=_init_worker,
+            initargs=(data, args.input_dir, args.output_dir, args.format)) as pool:
+        for index, record in enumerate(pool.imap_unordered(process_file, tasks, args.chunksize), 1):
+            journal.write(json.dumps(record) + '\n')
+            journal.flush()
+            if record['status'] == 'ok':
+                succeeded += 1
+                pixels += record['pixels']
+            else:
+                failures.append(record)
+                print(f"❌ {record['path']}: {record['error']}", file=sys.stderr)
+            if index % 100 == 0 or index == len(tasks):
+                elapsed = time.perf_counter() - started
+                print(f"[{index}/{len(tasks)}] {index / elapsed:.1f} images/s", file=sys.stderr)
+    elapsed = time.perf_counter() - started
+
+    summary = {
+        'input_dir': args.input_dir,
+        'output_dir': args.output_dir,
+        'workers': args.workers,
+        'files': len(entries),
+        'skipped': skipped,
+        'processed': len(tasks),
+        'succeeded': succeeded,
+        'failed': len(failures),
+        'elapsed_s': round(elapsed, 3),
+        'throughput': {
+            'images_per_s': round(succeeded / elapsed, 3) if elapsed else None,
+            'megapixels_per_s': round(pixels / 1_000_000 / elapsed, 3) if elapsed else None
+        },
+        'failures': failures
+    }
+    print(f"✅ {succeeded} written, {len(failures)} failed, {skipped} skipped in {elapsed:.1f}s",
+          file=sys.stderr)
+    output = json.dumps(summary, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,336 @@
+"""Load generator for the watermark service.
+
+Sweeps concurrency levels against /watermark with a payload mix modeled on
+our n8n traffic and reports throughput, error rate and latency percentiles
+per level, plus the level where latency knees.
+
+    python loadtest.py                                   # start a local gunicorn, default sweep
+    python loadtest.py --workers 4 --concurrency 1,2,4,8,16,32
+    python loadtest.py --url http://localhost:5001 --duration 30 -o sweep.json
+    python loadtest.py --mix social_square=0.7,camera_original=0.3
+"""
+import argparse
+import base64
+import http.client
+import io
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+from collections import Counter
+
+from PIL import Image
+
+from profiling import percentile
+
+# Request shapes seen from our n8n workflows
+PAYLOADS = {
+    'social_square': {
+        'size': (1080, 1080), 'input_format': 'JPEG', 'mode': 'RGB',
+        'request': {
+            'handle_position': {'left': '5%', 'bottom': '5%'},
+            'id_position': {'right': '5%', 'top': '5%'},
+            'handle_style': {'font_color': '#FF6B35', 'font_size': 28, 'transparency': 0.9},
+            'id_style': {'font_color': '#FFFFFF', 'font_size': 18, 'transparency': 0.8}
+        }
+    },
+    'story': {
+        'size': (1080, 1920), 'input_format': 'JPEG', 'mode': 'RGB',
+        'request': {'position': 'bottom-center', 'font_size': 32}
+    },
+    'product_png': {
+        'size': (1600, 1600), 'input_format': 'PNG', 'mode': 'RGBA',
+        'request': {'position': 'bottom-right', 'transparency': 0.8}
+    },
+    'camera_original': {
+        'size': (4000, 3000), 'input_format': 'JPEG', 'mode': 'RGB',
+        'request': {
+            'handle_position': 'bottom-left',
+            'id_position': 'top-right',
+            'handle_style': {'font_size': 64},
+            'id_style': {'font_size': 40}
+        }
+    }
+}
+
+MIXES = {
+    'n8n': {'social_square': 0.5, 'story': 0.25, 'product_png': 0.15, 'camera_original': 0.10},
+    'small': {'social_square': 1.0},
+    'large': {'camera_original': 1.0}
+}
+
+
+def make_payload(name):
+    """Serialized /watermark body for one payload kind"""
+    spec = PAYLOADS[name]
+    width, height = spec['size']
+    red = Image.linear_gradient('L').resize((width, height))
+    green = Image.radial_gradient('L').resize((width, height))
+    img = Image.merge('RGB', (red, green, red.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+    if spec['mode'] == 'RGBA':
+        img.putalpha(green)
+    buffer = io.BytesIO()
+    img.save(buffer, format=spec['input_format'], quality=90)
+
+    body = {
+        'image': base64.b64encode(buffer.getvalue()).decode('utf-8'),
+        'social_handle': '@loadtest',
+        'id_code': f'LOAD-{name}'
+    }
+    body.update(spec['request'])
+    return json.dumps(body).encode('utf-8')
+
+
+def parse_mix(value):
+    """Mix name from MIXES or an explicit 'payload=weight,...' list"""
+    if value in MIXES:
+        return MIXES[value]
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in PAYLOADS:
+            raise argparse.ArgumentTypeError(f"unknown payload '{name}' (choose from {', '.join(PAYLOADS)})")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_until_ready(base_url, timeout=60, polls=1):
+    """Poll /ready until it answers 200 `polls` times in a row.
+
+    /health answers before warm-up has finished, so waiting on it would
+    leave cold-start work in the first concurrency level. Each poll is a
+    new connection, so with several workers more polls are likely to reach
+    (and warm up) each of them. Servers without /ready fall back to /health.
+    """
+    parsed = urllib.parse.urlsplit(base_url)
+    path = '/ready'
+    ready = 0
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=2)
+            conn.request('GET', path)
+            status = conn.getresponse().status
+            conn.close()
+            if status == 404 and path == '/ready':
+                path = '/health'
+                continue
+            if status == 200:
+                ready += 1
+                if ready >= polls:
+                    return True
+                continue
+        except OSError:
+            pass
+        ready = 0
+        time.sleep(0.25)
+    return False
+
+
+def start_local_server(server, workers, threads, show_log):
+    """Start the service on a free local port and return (process, base_url)"""
+    port = free_port()
+    here = os.path.dirname(os.path.abspath(__file__))
+    if server == 'gunicorn':
+        cmd = [sys.executable, '-m', 'gunicorn', '-w', str(workers), '--threads', str(threads),
+               '-b', f'127.0.0.1:{port}', 'app:app']
+    else:
+        cmd = [sys.executable, '-c',
+               f"from app import app; app.run(host='127.0.0.1', port={port}, threaded=True)"]
+    output = None if show_log else subprocess.DEVNULL
+    process = subprocess.Popen(cmd, cwd=here, stdout=output, stderr=output)
+    base_url = f'http://127.0.0.1:{port}'
+    if not wait_until_ready(base_url, polls=workers if server == 'gunicorn' else 1):
+        process.terminate()
+        raise RuntimeError(f'local {server} server did not become ready')
+    return process, base_url
+
+
+class Worker(threading.Thread):
+    """Sends requests back to back on one keep-alive connection"""
+
+    def __init__(self, base_url, payloads, mix, deadline, seed, results):
+        super().__init__(daemon=True)
+        parsed = urllib.parse.urlsplit(base_url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.path = (parsed.path.rstrip('/') or '') + '/watermark'
+        self.payloads = payloads
+        self.names = list(mix)
+        self.weights = [mix[n] for n in self.names]
+        self.deadline = deadline
+        self.random = random.Random(seed)
+        self.results = results
+        self.connection = None
+
+    def _connect(self):
+        self.connection = http.client.HTTPConnection(self.host, self.port, timeout=120)
+
+    def run(self):
+        self._connect()
+        while time.time() < self.deadline:
+            name = self.random.choices(self.names, self.weights)[0]
+            start = time.perf_counter()
+            try:
+                self.connection.request('POST', self.path, body=self.payloads[name],
+                                        headers={'Content-Type': 'application/json'})
+                response = self.connection.getresponse()
+                response.read()
+                outcome = response.status
+            except (OSError, http.client.HTTPException) as e:
+                outcome = type(e).__name__
+                self.connection.close()
+                self._connect()
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            self.results.append((name, outcome, elapsed_ms))
+        self.connection.close()
+
+
+def run_level(base_url, payloads, mix, concurrency, duration, seed):
+    results = []
+    deadline = time.time() + duration
+    workers = [Worker(base_url, payloads, mix, deadline, seed + i, results) for i in range(concurrency)]
+    started = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - started
+
+    latencies = [ms for _, outcome, ms in results if outcome == 200]
+    outcomes = Counter(str(outcome) for _, outcome, _ in results)
+    errors = len(results) - len(latencies)
+    per_payload = {}
+    for name in mix:
+        samples = [ms for n, outcome, ms in results if n == name and outcome == 200]
+        if samples:
+            per_payload[name] = {'requests': len(samples), 'p50_ms': round(percentile(samples, 50), 2)}
+
+    return {
+        'concurrency': concurrency,
+        'duration_s': round(elapsed, 3),
+        'requests': len(results),
+        'successes': len(latencies),
+        'errors': errors,
+        'error_rate': round(errors / len(results), 4) if results else 0.0,
+        'outcomes': dict(outcomes),
+        'throughput_rps': round(len(latencies) / elapsed, 3),
+        'latency_ms': {
+            'mean': round(sum(latencies) / len(latencies), 2) if latencies else None,
+            'p50': round(percentile(latencies, 50), 2) if latencies else None,
+            'p95': round(percentile(latencies, 95), 2) if latencies else None,
+            'p99': round(percentile(latencies, 99), 2) if latencies else None,
+            'max': round(max(latencies), 2) if latencies else None
+        },
+        'per_payload': per_payload
+    }
+
+
+def find_knee(levels, min_gain=0.10, latency_jump=0.50):
+    """First level where throughput stops scaling while p95 latency jumps"""
+    for previous, current in zip(levels, levels[1:]):
+        if not previous['throughput_rps'] or current['latency_ms']['p95'] is None:
+            continue
+        gain = current['throughput_rps'] / previous['throughput_rps'] - 1
+        jump = current['latency_ms']['p95'] / previous['latency_ms']['p95'] - 1
+        if gain < min_gain and jump > latency_jump:
+            return {
+                'concurrency': current['concurrency'],
+                'last_scaling_concurrency': previous['concurrency'],
+                'throughput_gain': round(gain, 3),
+                'p95_increase': round(jump, 3)
+            }
+    return None
+
+
+def print_table(levels):
+    print(f"{'conc':>5} {'req':>6} {'err%':>6} {'rps':>8} {'p50':>9} {'p95':>9} {'p99':>9}", file=sys.stderr)
+    for level in levels:
+        latency = level['latency_ms']
+        print(f"{level['concurrency']:>5} {level['requests']:>6} {level['error_rate'] * 100:>6.1f} "
+              f"{level['throughput_rps']:>8.2f} {latency['p50'] or 0:>9.1f} "
+              f"{latency['p95'] or 0:>9.1f} {latency['p99'] or 0:>9.1f}", file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Concurrency sweep load test for /watermark')
+    parser.add_argument('--url', help='target an existing deployment instead of starting one')
+    parser.add_argument('--server', choices=['gunicorn', 'werkzeug'], default='gunicorn',
+                        help='local server to start when --url is not given')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers for the local server')
+    parser.add_argument('--threads', type=int, default=1, help='gunicorn threads per worker')
+    parser.add_argument('--server-log', action='store_true', help="show the local server's output")
+    parser.add_argument('--concurrency', default='1,2,4,8,16',
+                        help='comma separated concurrency levels')
+    parser.add_argument('--duration', type=float, default=15, help='seconds per level')
+    parser.add_argument('--mix', type=parse_mix, default=MIXES['n8n'],
+                        help=f"mix name ({', '.join(MIXES)}) or payload=weight list")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('-o', '--output', help='write JSON report here instead of stdout')
+    args = parser.parse_args(argv)
+
+    levels_to_run = [int(c) for c in args.concurrency.split(',') if c.strip()]
+    payloads = {name: make_payload(name) for name in args.mix}
+
+    process = None
+    base_url = args.url
+    if not base_url:
+        process, base_url = start_local_server(args.server, args.workers, args.threads, args.server_log)
+        print(f"🚀 Started local {args.server} at {base_url}", file=sys.stderr)
+    elif not wait_until_ready(base_url, timeout=30):
+        print(f"❌ {base_url}/ready is not reporting ready", file=sys.stderr)
+        return 1
+
+    try:
+        levels = []
+        for concurrency in levels_to_run:
+            print(f"⏱️  concurrency {concurrency} for {args.duration}s...", file=sys.stderr)
+            levels.append(run_level(base_url, payloads, args.mix, concurrency, args.duration, args.seed))
+    finally:
+        if process:
+            process.terminate()
+            process.wait(timeout=30)
+
+    print_table(levels)
+    knee = find_knee(levels)
+    peak = max(levels, key=lambda level: level['throughput_rps'])
+    if knee:
+        print(f"📈 Latency knee at concurrency {knee['concurrency']} "
+              f"(throughput {knee['throughput_gain'] * 100:+.0f}%, p95 {knee['p95_increase'] * 100:+.0f}%)",
+              file=sys.stderr)
+    else:
+        print("📈 No latency knee within the tested levels", file=sys.stderr)
+
+    report = {
+        'target': base_url if args.url else f'local {args.server}',
+        'workers': None if args.url else args.workers,
+        'threads': None if args.url else args.threads,
+        'mix': args.mix,
+        'payload_bytes': {name: len(body) for name, body in payloads.items()},
+        'levels': levels,
+        'knee': knee,
+        'peak_throughput': {'concurrency': peak['concurrency'], 'throughput_rps': peak['throughput_rps']}
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
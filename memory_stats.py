@@ -0,0 +1,142 @@
+"""Process and per-request memory accounting.
+
+A sampled fraction of requests run with allocation tracking. Python-side
+allocations (request JSON, base64 strings, BytesIO buffers) come from
+tracemalloc; Pillow allocates pixel data outside the Python allocator, so
+image buffers are accounted from the sizes and modes each stage records.
+"""
+import heapq
+import os
+import random
+import threading
+import time
+from collections import deque
+
+from profiling import get_json_logger, log_event
+
+try:
+    import resource
+except ImportError:  # Windows development machines
+    resource = None
+
+# Traced requests run one at a time and slower, so sampling is opt-in
+MEMORY_SAMPLE_RATE = float(os.environ.get('WATERMARK_MEMORY_SAMPLE_RATE', '0'))
+RSS_SAMPLE_INTERVAL = float(os.environ.get('WATERMARK_RSS_INTERVAL', '5'))
+RSS_HISTORY_SIZE = int(os.environ.get('WATERMARK_RSS_HISTORY', '720'))
+LARGEST_REQUESTS_KEPT = int(os.environ.get('WATERMARK_LARGEST_REQUESTS', '10'))
+
+logger = get_json_logger('watermark.memory')
+
+_lock = threading.Lock()
+_rss_history = deque(maxlen=RSS_HISTORY_SIZE)
+_largest = []  # min-heap of (peak_bytes, sequence, record)
+_sequence = 0
+_sampled_requests = 0
+_sampler_thread = None
+
+
+def current_rss_bytes():
+    """Resident set size of this process, or None if it cannot be read"""
+    try:
+        with open('/proc/self/statm') as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def peak_rss_bytes():
+    """Highest resident set size this process has reached"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+
+def should_sample():
+    """Decide whether the next request runs with allocation tracking"""
+    return MEMORY_SAMPLE_RATE > 0 and random.random() < MEMORY_SAMPLE_RATE
+
+
+def _sample_rss_forever():
+    while True:
+        rss = current_rss_bytes()
+        if rss is not None:
+            with _lock:
+                _rss_history.append((round(time.time(), 3), rss))
+        time.sleep(RSS_SAMPLE_INTERVAL)
+
+
+def start_rss_sampler():
+    """Start the background RSS sampler once per process"""
+    global _sampler_thread
+    if RSS_SAMPLE_INTERVAL <= 0:
+        return
+    with _lock:
+        if _sampler_thread is not None and _sampler_thread.is_alive():
+            return
+        _sampler_thread = threading.Thread(target=_sample_rss_forever, name='rss-sampler', daemon=True)
+        _sampler_thread.start()
+
+
+def summarize_stages(recorder):
+    """Per-stage memory figures from a recorder that tracked allocations"""
+    stages = []
+    for s in recorder.stages:
+        image_bytes = sum(i['buffer_bytes'] for i in s.images)
+        stages.append({
+            'name': s.name,
+            'python_peak_bytes': s.peak_bytes or 0,
+            'image_bytes': image_bytes,
+            'peak_bytes': (s.peak_bytes or 0) + image_bytes
+        })
+    return stages
+
+
+def record_request(recorder, **details):
+    """Account one sampled request and log it as a structured line"""
+    global _sequence, _sampled_requests
+    stages = summarize_stages(recorder)
+    peak_stage = max(stages, key=lambda s: s['peak_bytes'], default=None)
+    image_bytes = sum(s['image_bytes'] for s in stages)
+    python_peak = max((s['python_peak_bytes'] for s in stages), default=0)
+    record = {
+        # Upper bound: assumes every image buffer of the request is alive at once
+        'peak_bytes': image_bytes + python_peak,
+        'peak_stage': peak_stage['name'] if peak_stage else None,
+        'image_bytes_allocated': image_bytes,
+        'python_peak_bytes': python_peak,
+        'rss_bytes': current_rss_bytes(),
+        'total_ms': round(recorder.total_ms, 3),
+        'stages': stages
+    }
+    record.update(details)
+
+    with _lock:
+        _sampled_requests += 1
+        _sequence += 1
+        entry = (record['peak_bytes'], _sequence, record)
+        if len(_largest) < LARGEST_REQUESTS_KEPT:
+            heapq.heappush(_largest, entry)
+        elif entry[0] > _largest[0][0]:
+            heapq.heapreplace(_largest, entry)
+
+    log_event(logger, 'request_memory', **record)
+    return record
+
+
+def snapshot():
+    """Memory figures for the /metrics endpoint"""
+    with _lock:
+        history = list(_rss_history)
+        largest = [entry[2] for entry in sorted(_largest, reverse=True)]
+        sampled = _sampled_requests
+    return {
+        'rss_bytes': current_rss_bytes(),
+        'peak_rss_bytes': peak_rss_bytes(),
+        'rss_history': [{'ts': ts, 'rss_bytes': rss} for ts, rss in history],
+        'sample_rate': MEMORY_SAMPLE_RATE,
+        'sampled_requests': sampled,
+        'largest_requests': largest
+    }
@@ -0,0 +1,129 @@
+"""NumPy compositing engine (WATERMARK_ENGINE=numpy).
+
+Blends a watermark layer (text sprite, pattern tile or logo) into only the
+region it covers, using premultiplied alpha. The premultiplied form of each
+layer is computed once and reused for every image or frame it is blended
+into, and the same layer can be blended into a whole batch of same-sized
+images (e.g. animation frames) in one vectorized operation.
+"""
+import threading
+import weakref
+from collections import namedtuple
+
+import numpy as np
+from PIL import Image
+
+# id(layer) -> (weak reference to the layer, prepared arrays)
+_prepared = {}
+_prepared_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0}
+
+CacheInfo = namedtuple('CacheInfo', 'hits misses maxsize currsize')
+
+
+def _forget(key):
+    with _prepared_lock:
+        _prepared.pop(key, None)
+
+
+def prepare_layer(layer):
+    """Premultiplied color, alpha and inverse alpha arrays for an RGBA layer.
+
+    Cached for as long as the layer image itself is alive, which ties the
+    arrays to the sprite/tile/logo caches in app.py.
+    """
+    key = id(layer)
+    with _prepared_lock:
+        entry = _prepared.get(key)
+        if entry is not None and entry[0]() is layer:
+            _stats['hits'] += 1
+            return entry[1]
+        _stats['misses'] += 1
+
+    rgba = np.asarray(layer.convert('RGBA') if layer.mode != 'RGBA' else layer, dtype=np.uint32)
+    alpha = rgba[..., 3:4]
+    arrays = {
+        'premultiplied': rgba[..., :3] * alpha,  # color * alpha, scaled by 255
+        'alpha': alpha,
+        'inverse_alpha': 255 - alpha
+    }
+    with _prepared_lock:
+        _prepared[key] = (weakref.ref(layer, lambda _, key=key: _forget(key)), arrays)
+    return arrays
+
+
+def cache_info():
+    """Hit/miss counters in the same shape as functools' cache_info()"""
+    with _prepared_lock:
+        return CacheInfo(_stats['hits'], _stats['misses'], None, len(_prepared))
+
+
+def _clip(layer_size, position, img_size):
+    """Overlapping part as (destination box, source box), or None"""
+    x, y = position
+    width, height = layer_size
+    left, top = max(0, -x), max(0, -y)
+    right = min(width, img_size[0] - x)
+    bottom = min(height, img_size[1] - y)
+    if right <= left or bottom <= top:
+        return None
+    return (x + left, y + top, x + right, y + bottom), (left, top, right, bottom)
+
+
+def blend_arrays(dst, arrays, source_box):
+    """Blend a prepared layer into dst (..., h, w, 3 or 4) uint8 arrays.
+
+    dst may carry leading batch dimensions; the layer broadcasts over them.
+    """
+    left, top, right, bottom = source_box
+    premultiplied = arrays['premultiplied'][top:bottom, left:right]
+    alpha = arrays['alpha'][top:bottom, left:right]
+    inverse_alpha = arrays['inverse_alpha'][top:bottom, left:right]
+
+    if dst.shape[-1] == 3 or (dst[..., 3] == 255).all():
+        # Opaque destination: out = src * a + dst * (1 - a), in integers
+        color = dst[..., :3].astype(np.uint32)
+        out = (premultiplied + color * inverse_alpha + 127) // 255
+        result = dst.copy()
+        result[..., :3] = out
+        return result
+
+    # Destination with its own alpha: full premultiplied "over"
+    src_alpha = alpha.astype(np.float32) / 255
+    dst_alpha = dst[..., 3:4].astype(np.float32) / 255
+    out_alpha = src_alpha + dst_alpha * (1 - src_alpha)
+    out_premultiplied = (premultiplied.astype(np.float32) / 255 +
+                         dst[..., :3].astype(np.float32) * dst_alpha * (1 - src_alpha))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        color = np.where(out_alpha > 0, out_premultiplied / out_alpha, 0)
+    result = np.empty_like(dst)
+    result[..., :3] = np.clip(np.rint(color), 0, 255)
+    result[..., 3:4] = np.rint(out_alpha * 255)
+    return result
+
+
+def blend_into(img, layer, position):
+    """Blend an RGBA layer into an RGB/RGBA image in place, region only"""
+    clipped = _clip(layer.size, position, img.size)
+    if clipped is None:
+        return img
+    box, source_box = clipped
+    region = np.asarray(img.crop(box))
+    blended = blend_arrays(region, prepare_layer(layer), source_box)
+    img.paste(Image.fromarray(blended, img.mode), box[:2])
+    return img
+
+
+def blend_batch(images, layer, position):
+    """Blend one layer into many same-sized images (e.g. frames) in place"""
+    if not images:
+        return images
+    clipped = _clip(layer.size, position, images[0].size)
+    if clipped is None:
+        return images
+    box, source_box = clipped
+    regions = np.stack([np.asarray(img.crop(box)) for img in images])
+    blended = blend_arrays(regions, prepare_layer(layer), source_box)
+    for img, region in zip(images, blended):
+        img.paste(Image.fromarray(region, img.mode), box[:2])
+    return images
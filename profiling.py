@@ -0,0 +1,245 @@
+"""Per-request stage timing for the watermark pipeline.
+
+The pipeline functions in app.py wrap their work in ``stage(...)`` blocks.
+When no recorder is active for the current request these blocks cost a
+single context variable lookup, so they can stay in the hot path.
+"""
+import contextvars
+import math
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+_active_recorder = contextvars.ContextVar('watermark_stage_recorder', default=None)
+
+# tracemalloc is process wide, so keep it running while any recorder needs it
+_tracing_lock = threading.Lock()
+_tracing_users = 0
+_tracing_started_here = False
+# tracemalloc's peak is process wide too, so only one recorder measures at a
+# time; allocations made meanwhile by untracked requests still count
+_measuring_lock = threading.Lock()
+
+
+def _start_tracing():
+    global _tracing_users, _tracing_started_here
+    with _tracing_lock:
+        if _tracing_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _tracing_started_here = True
+        _tracing_users += 1
+
+
+def _stop_tracing():
+    global _tracing_users, _tracing_started_here
+    with _tracing_lock:
+        _tracing_users -= 1
+        if _tracing_users == 0 and _tracing_started_here:
+            tracemalloc.stop()
+            _tracing_started_here = False
+
+
+def image_buffer_bytes(img):
+    """Approximate size of Pillow's pixel storage for an image"""
+    mode = img.mode
+    if mode in ('1', 'L', 'P'):
+        pixel_bytes = 1
+    elif mode.startswith('I;16'):
+        pixel_bytes = 2
+    else:
+        # Pillow stores every multi-band mode (RGB included) in 32-bit pixels
+        pixel_bytes = 4
+    return img.width * img.height * pixel_bytes
+
+
+class _NullStage:
+    """Stage handle used when nothing is being recorded"""
+
+    def image(self, img, label=None):
+        pass
+
+    def note(self, **values):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class Stage:
+    """Timing, allocation and image details for one pipeline step"""
+
+    def __init__(self, name):
+        self.name = name
+        self.elapsed_ms = 0.0
+        self.allocated_bytes = None
+        self.peak_bytes = None
+        self.images = []
+        self.notes = {}
+
+    def image(self, img, label=None):
+        """Record the size and mode of an image produced by this stage"""
+        self.images.append({
+            'label': label or 'output',
+            'size': list(img.size),
+            'mode': img.mode,
+            'buffer_bytes': image_buffer_bytes(img)
+        })
+
+    def note(self, **values):
+        self.notes.update(values)
+
+    def to_dict(self):
+        result = {'name': self.name, 'ms': round(self.elapsed_ms, 3)}
+        if self.allocated_bytes is not None:
+            result['allocated_bytes'] = self.allocated_bytes
+            result['peak_bytes'] = self.peak_bytes
+        if self.images:
+            result['images'] = self.images
+        if self.notes:
+            result.update(self.notes)
+        return result
+
+
+class StageRecorder:
+    """Collects the stages run while it is active"""
+
+    def __init__(self, track_allocations=False):
+        self.track_allocations = track_allocations
+        self.stages = []
+        self.started = None
+        self.finished = None
+        self._peaks = []  # peak seen so far by each open stage, outermost first
+
+    @contextmanager
+    def activate(self):
+        """Make this recorder receive stages from the current context.
+        
+        Recorders that track allocations wait for each other, since the
+        figures of two at once would mix.
+        """
+        if self.track_allocations:
+            _measuring_lock.acquire()
+            _start_tracing()
+        token = _active_recorder.set(self)
+        self.started = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.finished = time.perf_counter()
+            _active_recorder.reset(token)
+            if self.track_allocations:
+                _stop_tracing()
+                _measuring_lock.release()
+
+    @contextmanager
+    def stage(self, name):
+        current = Stage(name)
+        if self.track_allocations:
+            before, peak = tracemalloc.get_traced_memory()
+            # Resetting the peak for this stage would lose the enclosing
+            # stage's, so carry that over by hand
+            if self._peaks:
+                self._peaks[-1] = max(self._peaks[-1], peak)
+            tracemalloc.reset_peak()
+            self._peaks.append(0)
+        start = time.perf_counter()
+        try:
+            yield current
+        finally:
+            current.elapsed_ms = (time.perf_counter() - start) * 1000
+            if self.track_allocations:
+                after, peak = tracemalloc.get_traced_memory()
+                peak = max(peak, self._peaks.pop())
+                if self._peaks:
+                    self._peaks[-1] = max(self._peaks[-1], peak)
+                current.allocated_bytes = after - before
+                current.peak_bytes = max(0, peak - before)
+            self.stages.append(current)
+
+    @property
+    def total_ms(self):
+        end = self.finished if self.finished is not None else time.perf_counter()
+        return (end - self.started) * 1000 if self.started is not None else 0.0
+
+    def to_dict(self):
+        return {
+            'total_ms': round(self.total_ms, 3),
+            'stages': [s.to_dict() for s in self.stages]
+        }
+
+
+def percentile(values, pct):
+    """Linear-interpolated percentile of a list of numbers"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100
+    low = math.floor(rank)
+    high = math.ceil(rank)
+    if low == high:
+        return ordered[low]
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+@contextmanager
+def stage(name):
+    """Record a pipeline stage on the active recorder, if there is one"""
+    recorder = _active_recorder.get()
+    if recorder is None:
+        yield _NULL_STAGE
+        return
+    with recorder.stage(name) as current:
+        yield current
+
+
+def record_stages(stages):
+    """Add stages measured elsewhere (a render process) to the active recorder"""
+    recorder = _active_recorder.get()
+    if recorder is None:
+        return
+    for fields in stages:
+        fields = dict(fields)
+        current = Stage(fields.pop('name'))
+        current.elapsed_ms = fields.pop('ms')
+        current.allocated_bytes = fields.pop('allocated_bytes', None)
+        current.peak_bytes = fields.pop('peak_bytes', None)
+        current.images = fields.pop('images', [])
+        current.notes = fields
+        recorder.stages.append(current)
+
+
+def profile_call(func, *args, limit=25, **kwargs):
+    """Run func under cProfile and return (result, pstats summary text)"""
+    import cProfile
+    import io
+    import pstats
+
+    profiler = cProfile.Profile()
+    result = profiler.runcall(func, *args, **kwargs)
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(limit)
+    return result, out.getvalue()
+
+
+def get_json_logger(name):
+    """Logger that writes one JSON document per line to stderr"""
+    import logging
+
+    logger = logging.getLogger(name)
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    return logger
+
+
+def log_event(logger, event, **fields):
+    """Emit a structured log line with an event name and timestamp"""
+    import json
+
+    record = {'event': event, 'ts': round(time.time(), 3)}
+    record.update(fields)
+    logger.info(json.dumps(record, default=str))
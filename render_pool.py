@@ -0,0 +1,319 @@
+"""Supervised render processes for /watermark.
+
+With WATERMARK_RENDER_PROCESSES set, images are decoded, watermarked and
+encoded in a pool of child processes instead of the web worker, so an image
+that crashes Pillow or balloons memory takes down one child rather than the
+requests of other clients. The web tier only moves encoded bytes: it writes
+the input into a shared memory block that the child decodes from in place,
+and the child encodes into a second block that the parent base64-encodes
+from, so no image data goes through the pipe.
+
+A child that dies, or has not answered after WATERMARK_RENDER_TIMEOUT
+seconds, is killed and replaced and only its own request fails. Children are
+also replaced after WATERMARK_RENDER_MAX_TASKS requests, or once their RSS
+passes WATERMARK_RENDER_MAX_RSS_MB, which hands back memory that allocator
+fragmentation would otherwise keep.
+"""
+import io
+import itertools
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+
+import buffer_pool
+import memory_stats
+from profiling import get_json_logger, log_event
+
+# 0 renders in the web worker itself
+PROCESSES = int(os.environ.get('WATERMARK_RENDER_PROCESSES', 0))
+MAX_TASKS = int(os.environ.get('WATERMARK_RENDER_MAX_TASKS', 500))
+MAX_RSS_BYTES = int(os.environ.get('WATERMARK_RENDER_MAX_RSS_MB', 1024)) * 1024 * 1024
+TIMEOUT_SECONDS = float(os.environ.get('WATERMARK_RENDER_TIMEOUT', '120'))
+
+logger = get_json_logger('watermark.render_pool')
+
+
+class RenderError(Exception):
+    """A render that failed in its process, with the HTTP status to answer"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def enabled():
+    """True when renders go to child processes (never inside a child itself)"""
+    return PROCESSES > 0 and multiprocessing.parent_process() is None
+
+
+class _MemoryReader(io.RawIOBase):
+    """Seekable read-only file over a memoryview, without copying it"""
+
+    def __init__(self, view):
+        super().__init__()
+        self._view = view
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        with self._view[self._position:self._position + len(b)] as data:
+            size = data.nbytes
+            b[:size] = data
+        self._position += size
+        return size
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._view.nbytes
+        self._position = max(0, offset)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        if not self.closed:
+            self._view.release()
+        super().close()
+
+
+def _service():
+    """The app module in this child process.
+
+    Under `python app.py` the spawn start method has already loaded it as
+    __main__, so reuse that rather than importing it twice.
+    """
+    main = sys.modules.get('__main__')
+    if hasattr(main, 'render_task'):
+        return main
+    import app
+    return app
+
+
+def _render(render_task, task):
+    """Run one task: the reply for the parent, output left in shared memory"""
+    shm = source = None
+    try:
+        if task.get('input'):
+            name, size = task['input']
+            shm = shared_memory.SharedMemory(name)
+            source = _MemoryReader(shm.buf[:size])
+        if task.get('output_path'):
+            return {'details': render_task(task, source)}
+
+        output = buffer_pool.acquire(task['input'][1] if task.get('input') else 0)
+        try:
+            details = render_task(task, source, output)
+            with output.getbuffer() as encoded:
+                block = shared_memory.SharedMemory(task['output_name'], create=True, size=max(1, encoded.nbytes))
+                block.buf[:encoded.nbytes] = encoded
+                block.close()
+                return {'details': details, 'output_bytes': encoded.nbytes}
+        finally:
+            buffer_pool.release(output)
+    finally:
+        if source is not None:
+            source.close()
+        if shm is not None:
+            shm.close()
+
+
+def _serve(connection):
+    """Child process main loop: render tasks until told to stop"""
+    service = _service()
+    service.start_warm_up()
+    render_task = service.render_task
+    while True:
+        try:
+            task = connection.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        try:
+            reply = _render(render_task, task)
+        except RenderError as e:
+            reply = {'status': e.status, 'error': str(e)}
+        except ValueError as e:
+            reply = {'status': 400, 'error': str(e)}
+        except Exception as e:
+            reply = {'status': 500, 'error': f'Processing failed: {str(e)}'}
+        reply['rss_bytes'] = memory_stats.current_rss_bytes()
+        connection.send(reply)
+
+
+class _Worker:
+    """One render process and what the parent knows about it"""
+
+    def __init__(self, context, number):
+        self.connection, child = context.Pipe()
+        self.process = context.Process(target=_serve, args=(child,), name=f'render-{number}', daemon=True)
+        self.process.start()
+        child.close()
+        self.tasks = 0
+        self.rss_bytes = None
+        self.logos = {}  # logo name -> version this process has been sent
+
+
+class RenderPool:
+    """A fixed number of render processes, each running one task at a time"""
+
+    def __init__(self, processes):
+        # spawn: a fork of a threaded web worker could inherit held locks
+        self._context = multiprocessing.get_context('spawn')
+        self._idle = queue.Queue()
+        self._numbers = itertools.count(1)
+        self._names = itertools.count()
+        self._lock = threading.Lock()
+        self._workers = set()
+        self._stats = {'started': 0, 'tasks': 0, 'failed': 0, 'crashed': 0, 'timed_out': 0,
+                       'recycled_tasks': 0, 'recycled_rss': 0}
+        self.processes = processes
+        for _ in range(processes):
+            self._idle.put(self._start())
+
+    def _start(self):
+        worker = _Worker(self._context, next(self._numbers))
+        with self._lock:
+            self._workers.add(worker)
+            self._stats['started'] += 1
+        return worker
+
+    def _retire(self, worker, kill=False):
+        """Stop a worker (killing it if it is stuck) and start its replacement"""
+        with self._lock:
+            self._workers.discard(worker)
+        if kill:
+            worker.process.kill()
+        else:
+            try:
+                worker.connection.send(None)
+            except OSError:
+                pass
+        worker.connection.close()
+        # Reap it off the request path
+        threading.Thread(target=worker.process.join, name='render-reaper', daemon=True).start()
+        self._idle.put(self._start())
+
+    def _logo_updates(self, worker, logos):
+        """Logos this worker lacks or has an old version of; None removes one"""
+        updates = {name: entry for name, entry in logos.items() if worker.logos.get(name) != entry[0]}
+        updates.update((name, None) for name in worker.logos if name not in logos)
+        return updates
+
+    def _exchange(self, task, logos):
+        """Send a task to an idle worker and wait for its reply"""
+        worker = self._idle.get()
+        while True:
+            try:
+                # A worker that died while idle (e.g. the OOM killer) fails
+                # here, before it has the task, so no request is lost. Its
+                # exit may not be visible to is_alive() yet, but its end of
+                # the pipe is already closed.
+                if not worker.process.is_alive():
+                    raise BrokenPipeError
+                worker.connection.send(dict(task, logos=self._logo_updates(worker, logos)))
+                break
+            except OSError:
+                log_event(logger, 'render_worker_lost', pid=worker.process.pid, tasks=worker.tasks,
+                          reason='died_idle', exitcode=worker.process.exitcode)
+                with self._lock:
+                    self._stats['crashed'] += 1
+                self._retire(worker, kill=True)
+                worker = self._idle.get()
+        worker.logos = {name: version for name, (version, _) in logos.items()}
+        try:
+            if not worker.connection.poll(TIMEOUT_SECONDS):
+                raise TimeoutError
+            reply = worker.connection.recv()
+        except (EOFError, OSError, TimeoutError) as e:
+            timed_out = isinstance(e, TimeoutError)
+            with self._lock:
+                self._stats['timed_out' if timed_out else 'crashed'] += 1
+            log_event(logger, 'render_worker_lost', pid=worker.process.pid, tasks=worker.tasks,
+                      reason='timeout' if timed_out else 'crash', exitcode=worker.process.exitcode)
+            self._retire(worker, kill=True)
+            raise RenderError(500, 'Render timed out' if timed_out else 'Render worker crashed')
+
+        worker.tasks += 1
+        worker.rss_bytes = reply.get('rss_bytes')
+        with self._lock:
+            self._stats['tasks'] += 1
+            self._stats['failed'] += 'error' in reply
+        if worker.tasks >= MAX_TASKS or (worker.rss_bytes or 0) > MAX_RSS_BYTES:
+            reason = 'tasks' if worker.tasks >= MAX_TASKS else 'rss'
+            with self._lock:
+                self._stats[f'recycled_{reason}'] += 1
+            log_event(logger, 'render_worker_recycled', pid=worker.process.pid, reason=reason,
+                      tasks=worker.tasks, rss_bytes=worker.rss_bytes)
+            self._retire(worker)
+        else:
+            self._idle.put(worker)
+        return reply
+
+    @contextmanager
+    def render(self, task, logos, input_bytes=None):
+        """Render task in a child; yields (details, encoded output view or None).
+
+        input_bytes (the encoded image, unless the task reads input_path) is
+        handed over in shared memory, and the output view is only valid
+        inside the with block. RenderError for failed renders.
+        """
+        name = f'wm-{os.getpid()}-{next(self._names)}'
+        task = dict(task, output_name=f'{name}-out')
+        block = None
+        try:
+            if input_bytes is not None:
+                block = shared_memory.SharedMemory(f'{name}-in', create=True, size=max(1, len(input_bytes)))
+                block.buf[:len(input_bytes)] = input_bytes
+                task['input'] = (block.name, len(input_bytes))
+            try:
+                reply = self._exchange(task, logos)
+            except RenderError:
+                _unlink(task['output_name'])  # a crash may leave the output behind
+                raise
+        finally:
+            if block is not None:
+                block.close()
+                block.unlink()
+
+        if 'error' in reply:
+            raise RenderError(reply['status'], reply['error'])
+        if 'output_bytes' not in reply:
+            yield reply['details'], None
+            return
+        output = shared_memory.SharedMemory(task['output_name'])
+        try:
+            with output.buf[:reply['output_bytes']] as view:
+                yield reply['details'], view
+        finally:
+            output.close()
+            output.unlink()
+
+    def snapshot(self):
+        """Task counts, failures and per-process usage for the /metrics endpoint"""
+        with self._lock:
+            workers = [{'pid': w.process.pid, 'tasks': w.tasks, 'rss_bytes': w.rss_bytes}
+                       for w in self._workers]
+            return dict(self._stats, processes=self.processes, max_tasks=MAX_TASKS,
+                        max_rss_bytes=MAX_RSS_BYTES, workers=workers)
+
+
+def _unlink(name):
+    try:
+        block = shared_memory.SharedMemory(name)
+    except FileNotFoundError:
+        return
+    block.close()
+    block.unlink()
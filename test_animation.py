@@ -0,0 +1,123 @@
+"""Animated input tests: every frame is watermarked and timing is kept.
+
+Sends generated GIF, WebP and APNG animations through /watermark and checks
+the frame count, per-frame durations and loop count of the result, that
+the watermark is on every frame, that a JPEG output is a still, and that
+an animation over the pixel budget is refused before its frames decode.
+
+    python test_animation.py
+    python -m pytest test_animation.py
+"""
+import base64
+import io
+import sys
+
+from PIL import Image, ImageChops, ImageSequence
+
+import app as service
+
+DURATIONS = [80, 120, 200, 160]
+LOOP = 3
+COLORS = ['#1f4e79', '#7a1f1f', '#1f7a3a', '#5a1f7a']
+SIZE = (240, 160)
+
+client = service.app.test_client()
+
+
+def make_animation(image_format):
+    """Four flat frames with different durations, looping LOOP times"""
+    frames = [Image.new('RGB', SIZE, color) for color in COLORS]
+    if image_format == 'GIF':
+        frames = [frame.quantize(colors=8) for frame in frames]
+    buffer = io.BytesIO()
+    options = {'lossless': True} if image_format == 'WEBP' else {}
+    frames[0].save(buffer, format=image_format, save_all=True, append_images=frames[1:],
+                   duration=DURATIONS, loop=LOOP, **options)
+    return base64.b64encode(buffer.getvalue()).decode('utf-8')
+
+
+def watermark(image, **fields):
+    data = {'image': image, 'social_handle': '@anim', 'id_code': 'ANIM-001'}
+    data.update(fields)
+    response = client.post('/watermark', json=data)
+    assert response.status_code == 200, response.get_json()
+    body = response.get_json()
+    return body, Image.open(io.BytesIO(base64.b64decode(body['image'])))
+
+
+def check_animation(image_format):
+    body, result = watermark(make_animation(image_format))
+    assert result.format == image_format, result.format
+    assert body['metadata']['frames'] == len(DURATIONS)
+    assert result.n_frames == len(DURATIONS), result.n_frames
+    assert result.info.get('loop') == LOOP, result.info.get('loop')
+
+    durations = []
+    for index, frame in enumerate(ImageSequence.Iterator(result)):
+        frame = frame.convert('RGB')
+        durations.append(frame.info.get('duration', result.info.get('duration')))
+        # The watermark (bottom-right by default) changed this frame, and the rest is its own color
+        plain = Image.new('RGB', SIZE, COLORS[index])
+        changed = ImageChops.difference(frame, plain).point(lambda p: 255 if p > 40 else 0).getbbox()
+        assert changed and changed[0] > SIZE[0] // 4 and changed[1] > SIZE[1] // 2, (index, changed)
+    assert durations == DURATIONS, durations
+
+
+def test_gif_keeps_frames_durations_and_loop():
+    check_animation('GIF')
+
+
+def test_webp_keeps_frames_durations_and_loop():
+    check_animation('WEBP')
+
+
+def test_apng_keeps_frames_durations_and_loop():
+    check_animation('PNG')
+
+
+def test_gif_to_webp_keeps_timing():
+    body, result = watermark(make_animation('GIF'), format='WEBP')
+    assert result.format == 'WEBP' and result.n_frames == len(DURATIONS)
+    # Loading a frame fills in its duration
+    durations = [frame.convert('RGB').info.get('duration') for frame in ImageSequence.Iterator(result)]
+    assert durations == DURATIONS, durations
+    assert result.info.get('loop') == LOOP
+
+
+def test_still_output_uses_first_frame():
+    body, result = watermark(make_animation('GIF'), format='JPEG')
+    assert result.format == 'JPEG' and not getattr(result, 'is_animated', False)
+    assert 'frames' not in body['metadata']
+
+
+def test_oversized_animation_is_refused():
+    budget = service.MAX_ANIMATION_PIXELS
+    # Four 240x160 frames are 153,600 pixels
+    service.MAX_ANIMATION_PIXELS = len(DURATIONS) * SIZE[0] * SIZE[1] - 1
+    try:
+        response = client.post('/watermark', json={'image': make_animation('GIF'),
+                                                   'social_handle': '@anim', 'id_code': 'ANIM-001'})
+    finally:
+        service.MAX_ANIMATION_PIXELS = budget
+    assert response.status_code == 400
+    assert response.get_json()['error'].startswith('Animation is too large: 4 frames of 240x160')
+
+
+def main():
+    tests = [test_gif_keeps_frames_durations_and_loop, test_webp_keeps_frames_durations_and_loop,
+             test_apng_keeps_frames_durations_and_loop, test_gif_to_webp_keeps_timing,
+             test_still_output_uses_first_frame, test_oversized_animation_is_refused]
+    failures = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ {test.__name__}")
+        except AssertionError as e:
+            failures += 1
+            print(f"❌ {test.__name__}: {e}")
+    print(f"\n{len(tests) - failures}/{len(tests)} animation tests passed")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,169 @@
+"""bulk.py and watch.py tests on temporary directories.
+
+Runs both command lines in-process on a few generated files: outputs,
+journal resume, failures and manifests for bulk.py; processed and
+dead-letter moves for watch.py, and that a source which cannot be moved is
+logged and skipped without stopping the watcher.
+
+Both use spawned worker processes, so running this file directly needs the
+__main__ guard at the bottom:
+
+    python test_cli.py
+    python -m pytest test_cli.py
+"""
+import json
+import os
+import sys
+import tempfile
+
+from PIL import Image
+
+import bulk
+import watch
+
+CONFIG = {'social_handle': '@cli', 'id_code': 'CLI-{stem}'}
+
+
+def make_inputs(directory):
+    """a.jpg, sub/b.png and an undecodable bad.jpg"""
+    os.makedirs(os.path.join(directory, 'sub'))
+    Image.new('RGB', (240, 160), 'navy').save(os.path.join(directory, 'a.jpg'))
+    Image.new('RGBA', (240, 160), 'orange').save(os.path.join(directory, 'sub', 'b.png'))
+    with open(os.path.join(directory, 'bad.jpg'), 'wb') as f:
+        f.write(b'not an image')
+
+
+def write_json(path, data):
+    with open(path, 'w') as f:
+        json.dump(data, f)
+    return path
+
+
+def read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def run_bulk(root, *extra):
+    summary = os.path.join(root, 'summary.json')
+    code = bulk.main([os.path.join(root, 'in'), os.path.join(root, 'out'), '--workers', '1',
+                      '--config', os.path.join(root, 'config.json'), '-o', summary, *extra])
+    return code, read_json(summary)
+
+
+def test_bulk_writes_outputs_and_resumes():
+    with tempfile.TemporaryDirectory() as root:
+        make_inputs(os.path.join(root, 'in'))
+        write_json(os.path.join(root, 'config.json'), CONFIG)
+
+        code, summary = run_bulk(root)
+        assert code == 1  # bad.jpg failed
+        assert (summary['succeeded'], summary['failed'], summary['skipped']) == (2, 1, 0), summary
+        assert summary['failures'][0]['path'] == 'bad.jpg'
+        with Image.open(os.path.join(root, 'out', 'a.jpg')) as image:
+            assert image.size == (240, 160) and image.format == 'JPEG'
+        with Image.open(os.path.join(root, 'out', 'sub', 'b.png')) as image:
+            assert image.format == 'PNG'
+        leftovers = [f for _, _, files in os.walk(os.path.join(root, 'out')) for f in files
+                     if f.endswith('.partial')]
+        assert not leftovers, leftovers
+
+        # The journal skips finished files; only the failed one is retried
+        code, summary = run_bulk(root)
+        assert (summary['skipped'], summary['processed']) == (2, 1), summary
+
+
+def test_bulk_manifest_and_format():
+    with tempfile.TemporaryDirectory() as root:
+        make_inputs(os.path.join(root, 'in'))
+        write_json(os.path.join(root, 'config.json'), CONFIG)
+        manifest = os.path.join(root, 'manifest.jsonl')
+        with open(manifest, 'w') as f:
+            f.write('# only the PNG\n')
+            f.write(json.dumps({'path': 'sub/b.png', 'id_code': 'OVERRIDE-1'}) + '\n')
+
+        code, summary = run_bulk(root, '--manifest', manifest, '--format', 'WEBP')
+        assert code == 0 and summary['succeeded'] == 1, summary
+        assert os.listdir(os.path.join(root, 'out', 'sub')) == ['b.webp']
+        assert not os.path.exists(os.path.join(root, 'out', 'a.jpg'))
+
+
+def make_watch_config(root, **folder):
+    entry = dict({'input': os.path.join(root, 'in'), 'output': os.path.join(root, 'out'),
+                  'preset': 'cli', 'config': {'id_code': 'W-{stem}'}}, **folder)
+    return write_json(os.path.join(root, 'watch.json'),
+                      {'presets': {'cli': {'social_handle': '@watch'}}, 'folders': [entry]})
+
+
+def run_watch(root):
+    return watch.main(['--config', os.path.join(root, 'watch.json'), '--once', '--workers', '1',
+                       '--interval', '0.1', '--settle', '0'])
+
+
+def test_watch_moves_processed_and_failed_files():
+    with tempfile.TemporaryDirectory() as root:
+        make_inputs(os.path.join(root, 'in'))
+        make_watch_config(root)
+
+        assert run_watch(root) == 1  # bad.jpg went to the dead-letter directory
+        assert os.path.exists(os.path.join(root, 'out', 'a.jpg'))
+        assert os.path.exists(os.path.join(root, 'out', 'sub', 'b.png'))
+        processed = os.path.join(root, 'in', '.processed')
+        assert os.path.exists(os.path.join(processed, 'a.jpg'))
+        assert os.path.exists(os.path.join(processed, 'sub', 'b.png'))
+        failed = os.path.join(root, 'in', '.failed')
+        assert os.path.exists(os.path.join(failed, 'bad.jpg'))
+        assert read_json(os.path.join(failed, 'bad.jpg.error.json'))['status'] == 'failed'
+        assert not os.path.exists(os.path.join(root, 'in', 'a.jpg'))
+
+
+def test_watch_survives_a_failed_move():
+    move = watch._move
+
+    def flaky_move(source, target):
+        if source.endswith('a.jpg'):
+            raise PermissionError(f'cannot move {source}')
+        move(source, target)
+
+    watch._move = flaky_move
+    try:
+        with tempfile.TemporaryDirectory() as root:
+            make_inputs(os.path.join(root, 'in'))
+            os.remove(os.path.join(root, 'in', 'bad.jpg'))
+            make_watch_config(root)
+
+            # The watcher keeps going, finishes the other file and exits
+            assert run_watch(root) == 1
+            assert os.path.exists(os.path.join(root, 'in', 'a.jpg'))
+            assert os.path.exists(os.path.join(root, 'in', '.processed', 'sub', 'b.png'))
+            assert os.path.exists(os.path.join(root, 'out', 'a.jpg'))
+    finally:
+        watch._move = move
+
+
+def test_watch_rejects_invalid_config():
+    with tempfile.TemporaryDirectory() as root:
+        write_json(os.path.join(root, 'watch.json'),
+                   {'folders': [{'input': os.path.join(root, 'in'), 'output': os.path.join(root, 'out'),
+                                 'config': {'social_handle': '@watch'}}]})
+        assert run_watch(root) == 2
+
+
+def main():
+    tests = [test_bulk_writes_outputs_and_resumes, test_bulk_manifest_and_format,
+             test_watch_moves_processed_and_failed_files, test_watch_survives_a_failed_move,
+             test_watch_rejects_invalid_config]
+    failures = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ {test.__name__}")
+        except AssertionError as e:
+            failures += 1
+            print(f"❌ {test.__name__}: {e}")
+    print(f"\n{len(tests) - failures}/{len(tests)} CLI tests passed")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,117 @@
+"""Forensic mark tests: JPEG robustness and false positives.
+
+Embeds the mark into a textured test image, re-encodes it as JPEG at
+several qualities and checks that the id_code still verifies, and that
+unmarked images and wrong ids do not. The last test goes through
+/watermark and /verify.
+
+    python test_forensic.py
+    python -m pytest test_forensic.py
+"""
+import base64
+import io
+import sys
+
+import numpy as np
+from PIL import Image
+
+import forensic
+from app import app
+
+ID_CODE = 'FORENSIC-001'
+JPEG_QUALITIES = (95, 85, 75, 60, 50)
+
+client = app.test_client()
+
+
+def make_photo(seed=7, size=(640, 480)):
+    """A smooth gradient with grain, closer to a photo than a flat color"""
+    rng = np.random.default_rng(seed)
+    width, height = size
+    x = np.linspace(0, 1, width)[None, :, None]
+    y = np.linspace(0, 1, height)[:, None, None]
+    base = 40 + 150 * x * np.array([1.0, 0.6, 0.3]) + 60 * y * np.array([0.2, 0.5, 1.0])
+    pixels = base + rng.normal(0, 12, (height, width, 3))
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8), 'RGB')
+
+
+def jpeg_roundtrip(img, quality):
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=quality)
+    buffer.seek(0)
+    return Image.open(buffer).convert('RGB')
+
+
+def test_mark_survives_jpeg_reencode():
+    img = make_photo()
+    assert forensic.embed(img, ID_CODE)
+    for quality in JPEG_QUALITIES:
+        result = forensic.verify(jpeg_roundtrip(img, quality), ID_CODE)
+        assert result['detected'] and result['match'], (quality, result)
+
+
+def test_unmarked_image_is_not_detected():
+    for seed in (1, 2, 3):
+        img = make_photo(seed)
+        for candidate in (img, jpeg_roundtrip(img, 85)):
+            result = forensic.verify(candidate, ID_CODE)
+            assert not result['detected'] and not result['match'], (seed, result)
+
+
+def test_wrong_id_does_not_match():
+    img = make_photo()
+    assert forensic.embed(img, ID_CODE)
+    marked = jpeg_roundtrip(img, 85)
+    for other in ('FORENSIC-002', 'forensic-001', 'OTHER'):
+        result = forensic.verify(marked, other)
+        assert result['detected'] and not result['match'], (other, result)
+        assert result['bit_errors'] > forensic.MAX_BIT_ERRORS
+
+
+def test_other_key_does_not_detect():
+    img = make_photo()
+    assert forensic.embed(img, ID_CODE)
+    result = forensic.verify(img, ID_CODE, key='another-key')
+    assert not result['detected'] and not result['match'], result
+
+
+def test_watermark_then_verify_endpoint():
+    buffer = io.BytesIO()
+    make_photo().save(buffer, format='PNG')
+    response = client.post('/watermark', json={
+        'image': base64.b64encode(buffer.getvalue()).decode('utf-8'),
+        'social_handle': '@forensic', 'id_code': ID_CODE,
+        'forensic': True, 'format': 'JPEG', 'quality': 75
+    })
+    assert response.status_code == 200, response.get_json()
+    body = response.get_json()
+    assert body['metadata']['forensic'] is True
+
+    response = client.post('/verify', json={'items': [
+        {'id': 'marked', 'image': body['image'], 'id_code': ID_CODE},
+        {'id': 'wrong', 'image': body['image'], 'id_code': 'FORENSIC-999'}
+    ]})
+    assert response.status_code == 200, response.get_json()
+    marked, wrong = response.get_json()['results']
+    assert marked['detected'] and marked['match'], marked
+    assert wrong['detected'] and not wrong['match'], wrong
+
+
+def main():
+    tests = [test_mark_survives_jpeg_reencode, test_unmarked_image_is_not_detected,
+             test_wrong_id_does_not_match, test_other_key_does_not_detect,
+             test_watermark_then_verify_endpoint]
+    failures = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ {test.__name__}")
+        except AssertionError as e:
+            failures += 1
+            print(f"❌ {test.__name__}: {e}")
+    print(f"\n{len(tests) - failures}/{len(tests)} forensic tests passed")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,230 @@
+"""Golden-image regression suite for the watermark renderer.
+
+Renders a fixed set of configs in-process (no running service needed) and
+compares the pixels against reference images stored in golden/. Run it
+before and after any change to the rendering path:
+
+    python test_golden.py            # compare against the references
+    python test_golden.py --update   # regenerate references (review the diff!)
+    python -m pytest test_golden.py
+
+References are rendered with DejaVuSans; other fonts produce different glyphs.
+"""
+import os
+import sys
+
+from PIL import Image, ImageChops, ImageDraw
+
+from app import (add_watermark, add_watermark_regions, get_system_fonts, prepare_for_format,
+                 register_logo)
+
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden')
+IMAGE_SIZE = (320, 240)
+
+# A channel may differ by this much before the pixel counts as changed
+PIXEL_TOLERANCE = 2
+# Share of pixels allowed beyond PIXEL_TOLERANCE (anti-aliasing noise)
+MAX_CHANGED_RATIO = 0.001
+
+BASE_CONFIG = {
+    'font_size': 24,
+    'font': 'DejaVuSans-Bold.ttf',
+    'font_color': '#FFFFFF',
+    'stroke_color': '#000000',
+    'stroke_width': 2,
+    'position': 'bottom-right',
+    'margin': 20,
+    'transparency': 1.0,
+    'handle_position': None,
+    'id_position': None,
+    'handle_style': {},
+    'id_style': {}
+}
+
+SEPARATE = {
+    'handle_position': {'left': '5%', 'bottom': '5%'},
+    'id_position': {'right': '5%', 'top': '5%'},
+    'handle_style': {'font_color': '#FF6B35', 'font_size': 28, 'stroke_color': '#FFFFFF',
+                     'stroke_width': 3, 'transparency': 0.9},
+    'id_style': {'font_color': '#FFFFFF', 'font_size': 18, 'font': 'DejaVuSans.ttf',
+                 'transparency': 0.8}
+}
+
+CASES = {
+    # Named positions
+    'named_bottom_right': {'config': {}},
+    'named_top_left': {'config': {'position': 'top-left'}},
+    'named_center': {'config': {'position': 'center', 'font_color': '#FFD700'}},
+    'named_top_center_no_stroke': {'config': {'position': 'top-center', 'stroke_width': 0}},
+    # Percentage and pixel positions
+    'percent_left_bottom': {'config': {'position': {'left': '10%', 'bottom': '5%'}}},
+    'pixel_right_top': {'config': {'position': {'right': 30, 'top': 12}}},
+    'clamped_off_edge': {'config': {'position': {'left': '95%', 'top': '98%'}}},
+    # Separate positioning and styles
+    'separate_styles': {'config': SEPARATE},
+    'separate_named': {'config': {'handle_position': 'top-left', 'id_position': 'bottom-right',
+                                  'handle_style': {'font_color': '#FF0000'},
+                                  'id_style': {'font_color': '#0000FF', 'font_size': 16}}},
+    # Transparency levels
+    'transparency_50': {'config': {'transparency': 0.5}},
+    'transparency_20': {'config': {'transparency': 0.2, 'font_size': 36}},
+    'transparency_0': {'config': {'transparency': 0.0}},
+    # Every input mode the decoders hand us
+    'mode_rgba': {'mode': 'RGBA', 'config': SEPARATE},
+    'mode_p': {'mode': 'P', 'config': {}},
+    'mode_p_transparency': {'mode': 'P_transparency', 'config': {'transparency': 0.7}},
+    'mode_l': {'mode': 'L', 'config': {'font_color': '#FF6B35'}},
+    'mode_la': {'mode': 'LA', 'config': {}},
+    'mode_cmyk': {'mode': 'CMYK', 'config': {}},
+    'mode_1': {'mode': '1', 'config': {}},
+    'mode_i': {'mode': 'I', 'config': {}},
+    # Tiled pattern mode
+    'pattern_diagonal': {'config': {'pattern': {'angle': 30, 'spacing': [24, 16]}, 'font_size': 16,
+                                    'transparency': 0.5}},
+    'pattern_flat_custom_text': {'config': {'pattern': {'angle': 0, 'spacing': 10, 'text': 'PREVIEW'},
+                                            'font_size': 14}},
+    # Shadow and glow baked into the sprites
+    'effect_shadow': {'config': {'shadow': True, 'stroke_width': 0, 'font_size': 28}},
+    'effect_glow_separate': {'config': dict(SEPARATE, handle_style=dict(SEPARATE['handle_style'], glow={
+        'color': '#FF0000', 'blur': 4, 'spread': 2}), shadow={'offset': [3, 3], 'blur': 1.5})},
+    # "auto" colors picked per text box (dark top-left, light bottom-right)
+    'auto_color_separate': {'config': {'handle_position': 'top-left', 'id_position': 'bottom-right',
+                                       'font_color': 'auto', 'stroke_color': 'auto', 'stroke_width': 1}},
+    'auto_color_palette_pattern': {'regions': True, 'config': {
+        'pattern': {'angle': 30, 'spacing': [24, 16]}, 'font_size': 16, 'font_color': 'auto',
+        'stroke_width': 0, 'color_palette': ['#FFD700', '#1E90FF', '#FFFFFF']}},
+    # Logo layers
+    'logo_percent_width': {'config': {'logos': [{'name': 'golden_logo', 'width': '30%',
+                                                 'position': 'top-right', 'opacity': 0.8}]}},
+    'logo_under_separate_text': {'mode': 'RGBA', 'config': dict(SEPARATE, logos=[
+        {'name': 'golden_logo', 'height': 40, 'position': {'left': 10, 'top': 10}}])},
+    # Large-image mode (in place, strip by strip) must match the normal path
+    'regions_separate_logo': {'regions': True, 'config': dict(SEPARATE, logos=[
+        {'name': 'golden_logo', 'width': 60, 'position': 'center'}])},
+    'regions_pattern_rgba': {'regions': True, 'mode': 'RGBA', 'config': {
+        'pattern': {'angle': 30, 'spacing': [24, 16]}, 'font_size': 16, 'transparency': 0.5}},
+    # ... and keep the input's mode (CMYK is stored as PNG, so converted last)
+    'regions_mode_l': {'regions': True, 'mode': 'L', 'config': SEPARATE},
+    'regions_mode_cmyk': {'regions': True, 'mode': 'CMYK', 'format': 'PNG', 'config': {}},
+    # Output flattening
+    'rgba_to_jpeg': {'mode': 'RGBA', 'format': 'JPEG', 'config': {'transparency': 0.6}},
+    'rgba_to_png': {'mode': 'RGBA', 'format': 'PNG', 'config': {'transparency': 0.6}},
+}
+
+
+def make_logo():
+    """Deterministic logo with soft alpha edges"""
+    logo = Image.new('RGBA', (120, 80), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(logo)
+    draw.ellipse((4, 4, 116, 76), fill=(220, 40, 40, 255), outline=(255, 255, 255, 180), width=4)
+    draw.rectangle((40, 30, 80, 50), fill=(255, 255, 255, 128))
+    return logo
+
+
+register_logo('golden_logo', make_logo())
+
+
+def make_base_image(mode):
+    """Deterministic gradient image converted to the requested input mode"""
+    red = Image.linear_gradient('L').resize(IMAGE_SIZE)
+    green = Image.radial_gradient('L').resize(IMAGE_SIZE)
+    blue = red.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+    img = Image.merge('RGB', (red, green, blue))
+    if mode == 'RGBA':
+        img.putalpha(green.point(lambda p: 255 - p // 2))
+    elif mode == 'LA':
+        img = img.convert('L')
+        img.putalpha(blue)
+    elif mode == 'P_transparency':
+        img = img.quantize(colors=64)
+        img.info['transparency'] = 0
+    elif mode == 'I':
+        img = img.convert('I')
+    elif mode != 'RGB':
+        img = img.convert(mode)
+    return img
+
+
+def render_case(name):
+    """Render one golden case exactly as /watermark would before encoding"""
+    case = CASES[name]
+    config = dict(BASE_CONFIG)
+    config.update(case['config'])
+    img = make_base_image(case.get('mode', 'RGB'))
+    if case.get('regions'):
+        # Small strips so that items straddle strip boundaries
+        result = add_watermark_regions(img, '@golden_handle', 'GOLD-001', config, strip_height=37)
+    else:
+        result = add_watermark(img, '@golden_handle', 'GOLD-001', config)
+    if 'format' in case:
+        result = prepare_for_format(result, case['format'])
+    return result
+
+
+def reference_path(name):
+    return os.path.join(GOLDEN_DIR, f'{name}.png')
+
+
+def compare_images(actual, expected):
+    """Return a problem description, or None when within tolerance"""
+    if actual.mode != expected.mode:
+        return f'mode {actual.mode} != reference {expected.mode}'
+    if actual.size != expected.size:
+        return f'size {actual.size} != reference {expected.size}'
+    diff = ImageChops.difference(actual, expected)
+    # Largest channel difference per pixel
+    bands = diff.split()
+    worst = bands[0]
+    for band in bands[1:]:
+        worst = ImageChops.lighter(worst, band)
+    histogram = worst.histogram()
+    changed = sum(histogram[PIXEL_TOLERANCE + 1:])
+    ratio = changed / (actual.width * actual.height)
+    if ratio > MAX_CHANGED_RATIO:
+        max_diff = max(i for i, count in enumerate(histogram) if count)
+        return f'{changed} pixels ({ratio:.2%}) differ by more than {PIXEL_TOLERANCE} (max {max_diff})'
+    return None
+
+
+def check_case(name):
+    path = reference_path(name)
+    if not os.path.exists(path):
+        return f'missing reference {path} (run with --update)'
+    with Image.open(path) as expected:
+        expected.load()
+        return compare_images(render_case(name), expected)
+
+
+def update_references():
+    os.makedirs(GOLDEN_DIR, exist_ok=True)
+    for name in CASES:
+        render_case(name).save(reference_path(name), format='PNG')
+        print(f"💾 {name}")
+
+
+def test_golden_images():
+    failures = {name: problem for name in CASES if (problem := check_case(name))}
+    assert not failures, '\n'.join(f'{name}: {problem}' for name, problem in failures.items())
+
+
+def main():
+    if 'DejaVuSans-Bold.ttf' not in get_system_fonts():
+        print("⚠️  DejaVuSans-Bold.ttf not found - results will not match the references")
+    if '--update' in sys.argv:
+        update_references()
+        return 0
+
+    failures = 0
+    for name in CASES:
+        problem = check_case(name)
+        if problem:
+            failures += 1
+            print(f"❌ {name}: {problem}")
+        else:
+            print(f"✅ {name}")
+    print(f"\n{len(CASES) - failures}/{len(CASES)} golden images match")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,169 @@
+"""/layout tests: boxes from the image header alone.
+
+Checks that /layout never decodes pixels (Pillow's load is never called,
+and a file cut off after its header still previews), that a short header
+is read from the first probe alone and a longer one by widening it, that
+the reported box lines up with the pixels /watermark actually changes,
+and that input_path works too.
+
+    python test_layout.py
+    python -m pytest test_layout.py
+"""
+import base64
+import io
+import os
+import sys
+import tempfile
+
+from PIL import Image, ImageChops, ImageFile
+
+import app as service
+
+client = service.app.test_client()
+
+FIELDS = {'social_handle': '@layout', 'id_code': 'LAYOUT-001', 'font_size': 28, 'stroke_width': 2}
+
+
+def encode(img, image_format='JPEG', **options):
+    buffer = io.BytesIO()
+    img.save(buffer, format=image_format, **options)
+    return buffer.getvalue()
+
+
+def layout(image_bytes, **fields):
+    response = client.post('/layout', json=dict(FIELDS, image=base64.b64encode(image_bytes).decode('utf-8'),
+                                                **fields))
+    return response.status_code, response.get_json()
+
+
+def test_pixels_are_never_decoded():
+    # Warm-up decodes a sample of every codec; let it finish first
+    client.get('/ready')
+    service._ready.wait(30)
+    load = ImageFile.ImageFile.load
+    calls = []
+
+    def counting_load(self):
+        calls.append(self.format)
+        return load(self)
+
+    ImageFile.ImageFile.load = counting_load
+    try:
+        status, body = layout(encode(Image.new('RGB', (1600, 1200), 'white')))
+    finally:
+        ImageFile.ImageFile.load = load
+    assert status == 200, body
+    assert calls == [], calls
+    assert (body['width'], body['height'], body['format']) == (1600, 1200, 'JPEG')
+
+
+def test_truncated_file_still_previews():
+    full = encode(Image.effect_noise((3000, 2000), 64).convert('RGB'), quality=90)
+    # The header plus a little scan data, then nothing: decoding would fail
+    truncated = full[:4096]
+    status, body = layout(truncated)
+    assert status == 200, body
+    assert (body['width'], body['height']) == (3000, 2000)
+
+    response = client.post('/watermark', json=dict(FIELDS, image=base64.b64encode(truncated).decode('utf-8')))
+    assert response.status_code != 200
+
+
+def test_short_header_needs_one_probe():
+    image_bytes = encode(Image.effect_noise((3000, 2000), 64).convert('RGB'), quality=90)
+    assert len(image_bytes) > 4 * service.HEADER_PROBE_BYTES
+    b64decode = base64.b64decode
+    decoded = []
+
+    def counting_b64decode(value, *args, **kwargs):
+        decoded.append(len(value))
+        return b64decode(value, *args, **kwargs)
+
+    base64.b64decode = counting_b64decode
+    try:
+        status, body = layout(image_bytes)
+    finally:
+        base64.b64decode = b64decode
+    assert status == 200, body
+    assert decoded == [service.HEADER_PROBE_BYTES // 3 * 4], decoded
+
+
+def test_long_header_widens_the_probe():
+    # A 300KB ICC profile puts the frame header far beyond the first probe
+    icc = bytes(range(256)) * 1200
+    image_bytes = encode(Image.new('RGB', (800, 600), 'gray'), icc_profile=icc)
+    assert len(icc) > service.HEADER_PROBE_BYTES
+    status, body = layout(image_bytes)
+    assert status == 200, body
+    assert (body['width'], body['height']) == (800, 600)
+
+
+def test_box_matches_the_rendered_watermark():
+    original = Image.new('RGB', (640, 480), 'navy')
+    image_bytes = encode(original, 'PNG')
+    status, body = layout(image_bytes, format='PNG')
+    assert status == 200, body
+    [item] = body['items']
+    assert item['role'] == 'combined' and item['text'] == '@layout\nLAYOUT-001'
+
+    response = client.post('/watermark', json=dict(FIELDS, image=base64.b64encode(image_bytes).decode('utf-8'),
+                                                   format='PNG'))
+    assert response.status_code == 200
+    rendered = Image.open(io.BytesIO(base64.b64decode(response.get_json()['image']))).convert('RGB')
+    changed = ImageChops.difference(rendered, original).getbbox()
+    left, top, right, bottom = item['box']
+    stroke = FIELDS['stroke_width'] + 1  # the stroke reaches past the text box
+    assert abs(changed[0] - left) <= stroke and abs(changed[2] - right) <= stroke, (changed, item['box'])
+    # The box is the measured text height used for positioning; the ink sits
+    # lower by the font's top bearing, so only check that they line up
+    assert changed[1] <= (top + bottom) / 2 <= changed[3], (changed, item['box'])
+    assert bottom - top <= changed[3] - changed[1] + stroke, (changed, item['box'])
+
+
+def test_layout_from_input_path():
+    shared_root = service.SHARED_ROOT
+    with tempfile.TemporaryDirectory() as root:
+        service.SHARED_ROOT = os.path.realpath(root)
+        try:
+            with open(os.path.join(root, 'photo.jpg'), 'wb') as f:
+                f.write(encode(Image.new('RGB', (1024, 768), 'olive')))
+            response = client.post('/layout', json=dict(FIELDS, input_path='photo.jpg'))
+            assert response.status_code == 200, response.get_json()
+            assert (response.get_json()['width'], response.get_json()['height']) == (1024, 768)
+
+            response = client.post('/layout', json=dict(FIELDS, input_path='.'))
+            assert response.status_code == 400
+
+            # Errors name the file as the caller did, not where it is on the server
+            for endpoint in ('/layout', '/watermark'):
+                response = client.post(endpoint, json=dict(FIELDS, input_path='missing/photo.jpg'))
+                assert response.status_code == 400
+                assert response.get_json()['error'] == 'Invalid path: missing/photo.jpg: No such file or directory'
+        finally:
+            service.SHARED_ROOT = shared_root
+
+
+def test_invalid_image_is_a_400():
+    status, body = layout(b'not an image at all')
+    assert status == 400 and body['error'] == 'Invalid image data: cannot identify image file'
+
+
+def main():
+    tests = [test_pixels_are_never_decoded, test_truncated_file_still_previews,
+             test_short_header_needs_one_probe, test_long_header_widens_the_probe,
+             test_box_matches_the_rendered_watermark,
+             test_layout_from_input_path, test_invalid_image_is_a_400]
+    failures = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ {test.__name__}")
+        except AssertionError as e:
+            failures += 1
+            print(f"❌ {test.__name__}: {e}")
+    print(f"\n{len(tests) - failures}/{len(tests)} layout tests passed")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,122 @@
+"""Preset tests: registration, merging, prewarming and errors.
+
+Registers presets through /presets and checks that a request naming one
+renders exactly like the same request with the fields spelled out, that
+request fields override the preset's (style blocks key by key), that
+registering pre-renders the sprites a preset fixes, and that bad presets
+and unknown names are refused.
+
+    python test_presets.py
+    python -m pytest test_presets.py
+"""
+import base64
+import io
+import sys
+
+from PIL import Image, ImageChops
+
+import app as service
+
+client = service.app.test_client()
+
+BRAND = {
+    'social_handle': '@preset', 'font_size': 30, 'font_color': '#FFD700', 'stroke_width': 3,
+    'handle_position': 'top-left', 'id_position': 'bottom-right',
+    'handle_style': {'font_size': 26, 'font_color': '#FF6B35'}, 'format': 'PNG'
+}
+
+
+def make_image():
+    img_byte_arr = io.BytesIO()
+    Image.new('RGB', (320, 200), 'teal').save(img_byte_arr, format='PNG')
+    return base64.b64encode(img_byte_arr.getvalue()).decode('utf-8')
+
+
+def register(name, **fields):
+    return client.post('/presets', json=dict(fields, name=name))
+
+
+def watermark(**fields):
+    response = client.post('/watermark', json=dict(fields, image=make_image()))
+    assert response.status_code == 200, response.get_json()
+    return Image.open(io.BytesIO(base64.b64decode(response.get_json()['image']))).convert('RGB')
+
+
+def test_preset_renders_like_spelled_out_request():
+    assert register('brand', **BRAND).status_code == 200
+    with_preset = watermark(preset='brand', id_code='PRESET-001')
+    spelled_out = watermark(id_code='PRESET-001', **BRAND)
+    assert ImageChops.difference(with_preset, spelled_out).getbbox() is None
+
+
+def test_request_fields_override_preset():
+    assert register('brand', **BRAND).status_code == 200
+    merged = service.apply_preset({'preset': 'brand', 'id_code': 'X', 'font_size': 40,
+                                   'handle_style': {'font_color': '#FFFFFF'}})
+    assert merged['font_size'] == 40 and merged['id_code'] == 'X'
+    # Style blocks merge key by key: the preset's font_size stays
+    assert merged['handle_style'] == {'font_size': 26, 'font_color': '#FFFFFF'}
+    assert merged['social_handle'] == '@preset'
+
+    overridden = watermark(preset='brand', id_code='PRESET-001', social_handle='@other')
+    with_preset = watermark(preset='brand', id_code='PRESET-001')
+    assert ImageChops.difference(overridden, with_preset).getbbox() is not None
+
+
+def test_registering_prewarms_fixed_sprites():
+    client.get('/ready')
+    service._ready.wait(30)  # warm-up renders sprites of its own
+    response = register('warm', **dict(BRAND, social_handle='@prewarmed-handle'))
+    assert response.status_code == 200, response.get_json()
+    assert response.get_json()['warmed']['sprites'] == 1  # the handle; the id varies per request
+
+    misses = service._render_text_sprite.cache_info().misses
+    watermark(preset='warm', id_code='PREWARM-001')
+    # Only the id sprite was rendered for the request
+    assert service._render_text_sprite.cache_info().misses == misses + 1
+
+
+def test_list_and_delete_presets():
+    assert register('listed', social_handle='@listed').status_code == 200
+    presets = client.get('/presets').get_json()['presets']
+    assert presets['listed'] == {'social_handle': '@listed'}
+
+    assert client.delete('/presets/listed').status_code == 200
+    assert 'listed' not in client.get('/presets').get_json()['presets']
+    assert client.delete('/presets/listed').status_code == 404
+
+
+def test_bad_presets_are_refused():
+    assert register('', social_handle='@x').status_code == 400
+    response = register('typo', social_handle='@x', font_sise=20)
+    assert response.status_code == 400 and 'font_sise' in response.get_json()['error']
+    assert register('huge', font_size=100000).status_code == 400
+    assert register('thick', stroke_width=3000).status_code == 400
+    response = register('fractional', stroke_width=2.5)
+    assert response.status_code == 400 and 'whole number' in response.get_json()['error']
+    assert register('nologo', logos=[{'name': 'missing-logo'}]).status_code == 400
+
+    response = client.post('/watermark', json={'image': make_image(), 'preset': 'no-such-preset',
+                                               'id_code': 'X'})
+    assert response.status_code == 400
+    assert response.get_json()['error'] == 'Unknown preset: no-such-preset'
+
+
+def main():
+    tests = [test_preset_renders_like_spelled_out_request, test_request_fields_override_preset,
+             test_registering_prewarms_fixed_sprites, test_list_and_delete_presets,
+             test_bad_presets_are_refused]
+    failures = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ {test.__name__}")
+        except AssertionError as e:
+            failures += 1
+            print(f"❌ {test.__name__}: {e}")
+    print(f"\n{len(tests) - failures}/{len(tests)} preset tests passed")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
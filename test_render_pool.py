@@ -0,0 +1,159 @@
+"""Render process tests: errors, crash containment and recycling.
+
+Sends /watermark requests through a one-process render pool and checks that
+its errors read like in-process ones, that a worker killed while idle or in
+the middle of a task costs at most that task and is replaced, and that
+workers are recycled after WATERMARK_RENDER_MAX_TASKS renders.
+
+Render processes are spawned, so running this file directly needs the
+__main__ guard at the bottom:
+
+    python test_render_pool.py
+    python -m pytest test_render_pool.py
+"""
+import base64
+import io
+import os
+import signal
+import sys
+import time
+
+from PIL import Image
+
+import app as service
+import render_pool
+
+client = service.app.test_client()
+
+
+class _ExitOnArrival:
+    """Unpickles as os._exit(3): the render process dies holding the task"""
+
+    def __reduce__(self):
+        return os._exit, (3,)
+
+
+def make_image():
+    img_byte_arr = io.BytesIO()
+    Image.new('RGB', (200, 120), 'lightblue').save(img_byte_arr, format='JPEG')
+    return base64.b64encode(img_byte_arr.getvalue()).decode('utf-8')
+
+
+def watermark(image=None):
+    return client.post('/watermark', json={'image': image or make_image(), 'social_handle': '@pool',
+                                           'id_code': 'POOL-001'})
+
+
+PROCESSES = render_pool.PROCESSES
+
+
+def render_processes():
+    """The app's pool, started with a single render process"""
+    render_pool.PROCESSES = 1
+    return service._render_pool()
+
+
+def teardown_module():
+    # Later test files render in-process again
+    render_pool.PROCESSES = PROCESSES
+
+
+def worker_pids(pool):
+    return [worker['pid'] for worker in pool.snapshot()['workers']]
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.02)
+    return condition()
+
+
+def test_errors_match_in_process():
+    bad_image = base64.b64encode(b'not an image').decode('utf-8')
+    processes = render_pool.PROCESSES
+    render_pool.PROCESSES = 0
+    try:
+        in_process = watermark(bad_image)
+    finally:
+        render_pool.PROCESSES = processes
+    render_processes()
+    pooled = watermark(bad_image)
+    assert pooled.status_code == in_process.status_code == 400
+    assert pooled.get_json() == in_process.get_json(), (pooled.get_json(), in_process.get_json())
+    assert ' at 0x' not in pooled.get_json()['error']
+
+
+def test_worker_killed_while_idle_is_replaced():
+    pool = render_processes()
+    assert watermark().status_code == 200
+    [pid] = worker_pids(pool)
+    crashed = pool.snapshot()['crashed']
+    os.kill(pid, signal.SIGKILL)
+    # Until every thread of the child has exited, it is not dead yet: a
+    # request sent before then is in flight when it dies
+    assert wait_for(lambda: os.waitid(os.P_PID, pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is not None)
+
+    # The next request gets a fresh worker instead of failing
+    assert watermark().status_code == 200
+    assert pool.snapshot()['crashed'] == crashed + 1
+    assert worker_pids(pool) != [pid]
+
+
+def test_worker_crash_during_task_is_contained():
+    pool = render_processes()
+    assert watermark().status_code == 200
+    [pid] = worker_pids(pool)
+    crashed = pool.snapshot()['crashed']
+    task = {'data': {}, 'config': {}, 'input_path': None, 'output_path': None}
+    try:
+        with pool.render(task, {'crash': (0, _ExitOnArrival())}, b'x'):
+            pass
+        assert False, 'render should have failed'
+    except render_pool.RenderError as e:
+        assert e.status == 500 and str(e) == 'Render worker crashed'
+    assert pool.snapshot()['crashed'] == crashed + 1
+
+    # Only that task failed: the replacement serves the next request
+    assert watermark().status_code == 200
+    assert worker_pids(pool) != [pid]
+
+
+def test_worker_recycled_after_max_tasks():
+    pool = render_processes()
+    max_tasks = render_pool.MAX_TASKS
+    render_pool.MAX_TASKS = 2
+    try:
+        assert watermark().status_code == 200
+        [pid] = worker_pids(pool)
+        recycled = pool.snapshot()['recycled_tasks']
+        # Counts restart with each worker, so at most two more requests reach the limit
+        for _ in range(2):
+            assert watermark().status_code == 200
+            if worker_pids(pool) != [pid]:
+                break
+        assert pool.snapshot()['recycled_tasks'] == recycled + 1
+        assert worker_pids(pool) != [pid]
+        assert watermark().status_code == 200
+    finally:
+        render_pool.MAX_TASKS = max_tasks
+
+
+def main():
+    tests = [test_errors_match_in_process, test_worker_killed_while_idle_is_replaced,
+             test_worker_crash_during_task_is_contained, test_worker_recycled_after_max_tasks]
+    failures = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ {test.__name__}")
+        except AssertionError as e:
+            failures += 1
+            print(f"❌ {test.__name__}: {e}")
+    teardown_module()
+    print(f"\n{len(tests) - failures}/{len(tests)} render pool tests passed")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,114 @@
+"""NDJSON streaming tests for /watermark/stream.
+
+Checks that every result line carries its item's id (or line number), that
+a slow item does not hold back the results of faster ones, that bad lines
+get error lines without ending the stream, and that the server reads only
+a window of items ahead of the results it has written.
+
+    python test_stream.py
+    python -m pytest test_stream.py
+"""
+import base64
+import io
+import json
+import sys
+
+from PIL import Image
+
+import app as service
+
+# Enough stream workers for a slow and a fast item to run side by side
+service.STREAM_WORKERS = max(service.STREAM_WORKERS, 3)
+
+client = service.app.test_client()
+
+
+def make_image(size=(160, 120), image_format='JPEG'):
+    img_byte_arr = io.BytesIO()
+    Image.new('RGB', size, 'slategray').save(img_byte_arr, format=image_format)
+    return base64.b64encode(img_byte_arr.getvalue()).decode('utf-8')
+
+
+def item(item_id=None, **fields):
+    data = {'image': make_image(), 'social_handle': '@stream', 'id_code': 'STREAM-001'}
+    if item_id is not None:
+        data['id'] = item_id
+    data.update(fields)
+    return json.dumps(data)
+
+
+def stream(lines):
+    response = client.post('/watermark/stream', data='\n'.join(lines) + '\n',
+                           content_type='application/x-ndjson')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+def test_results_carry_ids():
+    results = stream([item('a1'), item('a2', format='PNG'), item()])
+    assert sorted(str(r['id']) for r in results) == ['3', 'a1', 'a2']
+    by_id = {r['id']: r for r in results}
+    assert all(r['success'] for r in results), results
+    assert by_id['a2']['metadata']['format'] == 'PNG'
+    assert base64.b64decode(by_id['a1']['image'])
+
+
+def test_fast_items_are_not_held_back():
+    slow = item('slow', image=make_image((3000, 2000), 'PNG'), format='PNG', quality=100)
+    results = stream([slow, item('fast-1'), item('fast-2')])
+    order = [r['id'] for r in results]
+    assert sorted(order) == ['fast-1', 'fast-2', 'slow']
+    assert order[-1] == 'slow', order
+
+
+def test_bad_lines_do_not_end_the_stream():
+    results = stream([item('ok-1'), '{not json',
+                      json.dumps({'id': 'no-id-code', 'image': make_image(), 'social_handle': '@s'}),
+                      json.dumps({'id': 'no-handle', 'image': make_image(), 'id_code': 'X'}),
+                      item('bad-image', image='bm90IGFuIGltYWdl'), '', item('ok-2')])
+    assert len(results) == 6, results
+    by_key = {r.get('id', r.get('line')): r for r in results}
+    assert by_key['ok-1']['success'] and by_key['ok-2']['success']
+    assert by_key[2]['status'] == 400 and by_key[2]['error'].startswith('Invalid JSON')
+    assert by_key['no-handle'] == {'id': 'no-handle', 'success': False, 'status': 400,
+                                   'error': 'Social handle is required'}
+    assert by_key['no-id-code']['error'] == 'ID code is required'
+    assert by_key['bad-image']['status'] == 400
+    assert by_key['bad-image']['error'].startswith('Invalid image data')
+
+
+def test_reads_only_a_window_ahead():
+    read = []
+
+    def lines():
+        for index in range(12):
+            read.append(index)
+            yield item(f'w{index}')
+
+    results = service.stream_results(lines(), window=2)
+    first = json.loads(next(results))
+    # Two items in flight, plus at most the line the reader holds while it waits
+    assert len(read) <= 3, read
+    rest = [json.loads(line) for line in results]
+    assert first['success'] and len(rest) == 11
+    assert len(read) == 12
+
+
+def main():
+    tests = [test_results_carry_ids, test_fast_items_are_not_held_back,
+             test_bad_lines_do_not_end_the_stream, test_reads_only_a_window_ahead]
+    failures = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ {test.__name__}")
+        except AssertionError as e:
+            failures += 1
+            print(f"❌ {test.__name__}: {e}")
+    print(f"\n{len(tests) - failures}/{len(tests)} stream tests passed")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,167 @@
+"""Completion callback tests against a local receiver (no network access needed).
+
+Sends /watermark jobs with a callback_url through Flask's test client and
+checks what webhook_receiver.Receiver gets: results, failures, retries with
+backoff, signatures, connection reuse, the outbox limit and refused private
+hosts.
+
+    python test_webhooks.py
+    python -m pytest test_webhooks.py
+"""
+import base64
+import http.client
+import io
+import sys
+import time
+
+from PIL import Image
+
+import webhooks
+from app import app
+from webhook_receiver import Receiver
+
+# Fast retries and one delivery thread, so connection reuse is observable
+webhooks.BACKOFF_SECONDS = 0.05
+webhooks.DELIVERY_WORKERS = 1
+webhooks.SECRET = 'test-secret'
+# The local receiver; any other private host stays refused
+webhooks.ALLOWED_HOSTS = {'127.0.0.1'}
+
+client = app.test_client()
+
+
+def make_image():
+    img_byte_arr = io.BytesIO()
+    Image.new('RGB', (200, 120), 'lightblue').save(img_byte_arr, format='JPEG')
+    return base64.b64encode(img_byte_arr.getvalue()).decode('utf-8')
+
+
+def submit(receiver, **fields):
+    data = {'image': make_image(), 'social_handle': '@hook', 'id_code': 'HOOK-001',
+            'callback_url': receiver.url}
+    data.update(fields)
+    return client.post('/watermark', json=data)
+
+
+def test_success_callback():
+    receiver = Receiver(secret=webhooks.SECRET).start()
+    try:
+        response = submit(receiver, job_id='job-ok')
+        assert response.status_code == 202, response.get_json()
+        assert response.get_json()['job_id'] == 'job-ok'
+
+        [delivery] = receiver.wait(1)
+        payload = delivery['payload']
+        assert delivery['job_id'] == 'job-ok' and delivery['signature_ok']
+        assert payload['status'] == 'succeeded'
+        assert payload['result']['metadata']['id_code'] == 'HOOK-001'
+        assert base64.b64decode(payload['result']['image'])
+        assert set(payload['timings']) == {'queued_ms', 'processing_ms', 'total_ms'}
+    finally:
+        receiver.stop()
+
+
+def test_failed_job_callback():
+    receiver = Receiver().start()
+    try:
+        response = submit(receiver, job_id='job-bad', image='bm90IGFuIGltYWdl')
+        assert response.status_code == 202
+        [delivery] = receiver.wait(1)
+        assert delivery['payload']['status'] == 'failed'
+        assert delivery['payload']['status_code'] == 400
+        assert 'Invalid image data' in delivery['payload']['error']
+    finally:
+        receiver.stop()
+
+
+def test_retries_until_accepted():
+    receiver = Receiver(fail=2).start()
+    retried_before = webhooks.snapshot()['retried']
+    try:
+        for index in range(3):
+            assert submit(receiver, job_id=f'job-retry-{index}').status_code == 202
+        deliveries = receiver.wait(3)
+        assert sorted(d['job_id'] for d in deliveries) == ['job-retry-0', 'job-retry-1', 'job-retry-2']
+        assert all(receiver.refused[d['job_id']] == 2 for d in deliveries)
+        assert webhooks.snapshot()['retried'] - retried_before == 6
+        # Every attempt went over the single pooled keep-alive connection
+        assert len(receiver.connections) == 1
+    finally:
+        receiver.stop()
+
+
+def test_rejects_bad_callback_url():
+    response = client.post('/watermark', json={'image': make_image(), 'social_handle': '@hook',
+                                               'id_code': 'HOOK-001', 'callback_url': 'ftp://example'})
+    assert response.status_code == 400
+
+
+def test_refuses_private_callback_hosts():
+    receiver = Receiver().start()
+    try:
+        for url in (receiver.url.replace('127.0.0.1', 'localhost'), 'http://10.1.2.3/hook',
+                    'http://169.254.169.254/latest/meta-data', 'http://[::1]:8080/'):
+            response = submit(receiver, callback_url=url)
+            assert response.status_code == 400, (url, response.get_json())
+            assert 'not a public address' in response.get_json()['error']
+    finally:
+        receiver.stop()
+
+
+def test_send_failure_releases_slot():
+    send = webhooks.send
+    outbox_before = webhooks.snapshot()['outbox']
+
+    def broken_send(*args, **kwargs):
+        raise TypeError('payload is not serializable')
+
+    webhooks.send = broken_send
+    try:
+        assert submit(Receiver(), job_id='job-unsent').status_code == 202
+        deadline = time.monotonic() + 10
+        while webhooks.snapshot()['outbox'] != outbox_before and time.monotonic() < deadline:
+            time.sleep(0.02)
+        assert webhooks.snapshot()['outbox'] == outbox_before
+    finally:
+        webhooks.send = send
+
+
+def test_idle_connections_are_closed():
+    now = time.monotonic()
+    idle, busy = http.client.HTTPConnection('127.0.0.1'), http.client.HTTPConnection('127.0.0.1')
+    connections = {'idle': (idle, now - webhooks.IDLE_SECONDS - 1), 'busy': (busy, now)}
+    next_due = webhooks._close_idle(connections)
+    assert list(connections) == ['busy']
+    assert next_due == now + webhooks.IDLE_SECONDS
+
+
+def test_full_outbox_turns_jobs_away():
+    receiver = Receiver().start()
+    outbox_size = webhooks.OUTBOX_SIZE
+    webhooks.OUTBOX_SIZE = webhooks.snapshot()['outbox']
+    try:
+        assert submit(receiver).status_code == 503
+    finally:
+        webhooks.OUTBOX_SIZE = outbox_size
+        receiver.stop()
+
+
+def main():
+    tests = [test_success_callback, test_failed_job_callback, test_retries_until_accepted,
+             test_rejects_bad_callback_url, test_refuses_private_callback_hosts,
+             test_send_failure_releases_slot, test_idle_connections_are_closed,
+             test_full_outbox_turns_jobs_away]
+    failures = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ {test.__name__}")
+        except AssertionError as e:
+            failures += 1
+            print(f"❌ {test.__name__}: {e}")
+    print(f"\n{len(tests) - failures}/{len(tests)} webhook tests passed")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
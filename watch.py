@@ -0,0 +1,224 @@
+"""Watch-folder daemon for pipelines that share a volume with the service.
+
+Polls the configured input directories and watermarks every new file once
+its writes have finished (size and modification time unchanged for
+--settle seconds). Each folder has its own preset/config and output
+directory. Files are processed in a bounded process pool and the outputs
+appear atomically. The source is then moved to the folder's processed
+directory, or to its dead-letter directory (next to a .error.json) on failure.
+A source that cannot be moved is logged and left in place, and is not
+picked up again until it changes.
+
+    python watch.py --config watch.json
+    python watch.py --config watch.json --workers 4 --interval 2 --settle 5
+    python watch.py --config watch.json --once     # drain the folders and exit
+
+watch.json:
+
+    {
+      "presets": {"brand": {"social_handle": "@brand", "position": "bottom-left"}},
+      "folders": [
+        {"input": "/data/incoming/brand", "output": "/data/watermarked/brand",
+         "preset": "brand", "config": {"id_code": "BR-{stem}"}, "format": "JPEG",
+         "processed": "/data/processed/brand", "dead_letter": "/data/failed/brand"}
+      ]
+    }
+
+"config" uses the /watermark request format, like bulk.py. "processed" and
+"dead_letter" default to .processed/ and .failed/ inside the input
+directory; "on_success": "delete" removes sources instead of moving them.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import app
+from bulk import watermark_file
+from profiling import get_json_logger, log_event
+
+# Never picked up: our own partial outputs and other writers' temp files
+IGNORED_SUFFIXES = ('.partial', '.tmp', '.part', '.crdownload', '.error.json')
+
+logger = get_json_logger('watermark.watch')
+
+
+class Folder:
+    """One watched input directory and where its files go"""
+
+    def __init__(self, entry):
+        self.input = os.path.abspath(entry['input'])
+        self.output = os.path.abspath(entry['output'])
+        self.processed = os.path.abspath(entry.get('processed') or os.path.join(self.input, '.processed'))
+        self.dead_letter = os.path.abspath(entry.get('dead_letter') or os.path.join(self.input, '.failed'))
+        self.on_success = entry.get('on_success', 'move')
+        self.format = entry.get('format')
+
+        data = dict(entry.get('config') or {})
+        if entry.get('preset'):
+            data['preset'] = entry['preset']
+            data = app.apply_preset(data)
+        for field in ('social_handle', 'id_code'):
+            if field not in data:
+                raise ValueError(f'{self.input}: config needs {field}')
+        app.compile_spec(app.build_config(data))  # fail at startup, not per file
+        self.data = data
+        for path in (self.output, self.processed, self.dead_letter):
+            os.makedirs(path, exist_ok=True)
+
+    def scan(self):
+        """(relative path, stat) of candidate files, skipping dot directories"""
+        for root, dirs, files in os.walk(self.input):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+            for file in sorted(files):
+                if file.startswith('.') or file.endswith(IGNORED_SUFFIXES):
+                    continue
+                path = os.path.join(root, file)
+                try:
+                    yield os.path.relpath(path, self.input), os.stat(path)
+                except FileNotFoundError:
+                    continue  # moved away between listing and stat
+
+
+class Watcher:
+    def __init__(self, folders, workers, max_pending, interval, settle):
+        self.folders = folders
+        self.max_pending = max_pending
+        self.interval = interval
+        self.settle = settle
+        # spawn, like the render pool: workers start clean instead of forking this process
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        self.stopping = threading.Event()
+        self.seen = {}       # (folder, rel path) -> (size, mtime_ns, unchanged since)
+        self.in_flight = {}  # future -> (folder, rel path)
+        self.held = set()    # (folder, rel path) of sources that could not be moved
+        self.counts = {'succeeded': 0, 'failed': 0, 'not_moved': 0}
+
+    def ready_files(self):
+        """Files whose size and mtime have not changed for `settle` seconds"""
+        now = time.monotonic()
+        busy = set(self.in_flight.values())
+        present = set()
+        for folder in self.folders:
+            for rel_path, st in folder.scan():
+                key = (folder, rel_path)
+                present.add(key)
+                signature = (st.st_size, st.st_mtime_ns)
+                previous = self.seen.get(key)
+                if previous is None or previous[:2] != signature:
+                    self.seen[key] = signature + (now,)
+                    self.held.discard(key)
+                elif now - previous[2] >= self.settle and key not in busy and key not in self.held:
+                    yield key
+        # Forget files that disappeared
+        for key in set(self.seen) - present:
+            del self.seen[key]
+            self.held.discard(key)
+
+    def submit(self, folder, rel_path):
+        future = self.pool.submit(watermark_file, os.path.join(folder.input, rel_path),
+                                  folder.output, rel_path, folder.data, folder.format)
+        self.in_flight[future] = (folder, rel_path)
+
+    def finish(self, future):
+        folder, rel_path = self.in_flight.pop(future)
+        source = os.path.join(folder.input, rel_path)
+        try:
+            record = future.result()
+        except Exception as e:  # worker process died
+            record = {'path': rel_path, 'status': 'failed', 'error': f'{type(e).__name__}: {e}'}
+        record['input'] = folder.input
+
+        ok = record['status'] == 'ok'
+        self.counts['succeeded' if ok else 'failed'] += 1
+        try:
+            if ok and folder.on_success == 'delete':
+                os.remove(source)
+            elif ok:
+                _move(source, os.path.join(folder.processed, rel_path))
+            else:
+                target = os.path.join(folder.dead_letter, rel_path)
+                _move(source, target)
+                with open(f'{target}.error.json', 'w') as f:
+                    json.dump(record, f, indent=2)
+        except OSError as e:
+            # Keep watching; the source stays where it is until it changes
+            self.counts['not_moved'] += 1
+            self.held.add((folder, rel_path))
+            log_event(logger, 'watch_move_failed', path=rel_path, input=folder.input,
+                      error=f'{type(e).__name__}: {e}')
+        log_event(logger, 'watch_file_done' if ok else 'watch_file_failed', **record)
+
+    def run(self, once=False):
+        log_event(logger, 'watch_started', folders=[f.input for f in self.folders],
+                  max_pending=self.max_pending, interval=self.interval, settle=self.settle)
+        try:
+            while not self.stopping.is_set():
+                for folder, rel_path in list(self.ready_files()):
+                    if len(self.in_flight) >= self.max_pending:
+                        break
+                    self.submit(folder, rel_path)
+
+                if self.in_flight:
+                    done, _ = wait(list(self.in_flight), timeout=self.interval, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self.finish(future)
+                elif once and set(self.seen) <= self.held:
+                    break
+                else:
+                    self.stopping.wait(self.interval)
+        finally:
+            # Let running files finish so nothing is left half-moved
+            for future in list(self.in_flight):
+                future.exception()
+                self.finish(future)
+            self.pool.shutdown()
+            log_event(logger, 'watch_stopped', **self.counts)
+
+
+def _move(source, target):
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    shutil.move(source, target)
+
+
+def load_watch_config(path):
+    with open(path) as f:
+        config = json.load(f)
+    for name, preset in (config.get('presets') or {}).items():
+        app.register_preset(name, preset)
+    return [Folder(entry) for entry in config['folders']]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Watermark files dropped into watched folders')
+    parser.add_argument('--config', required=True, help='watch config JSON (folders and presets)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--max-pending', type=int, help='files in flight at once (default 2 x workers)')
+    parser.add_argument('--interval', type=float, default=1.0, help='seconds between polls')
+    parser.add_argument('--settle', type=float, default=2.0,
+                        help='seconds a file must stay unchanged before it is picked up')
+    parser.add_argument('--once', action='store_true', help='process what is there, then exit')
+    args = parser.parse_args(argv)
+
+    try:
+        folders = load_watch_config(args.config)
+    except (KeyError, ValueError) as e:
+        print(f"❌ invalid watch config: {e}", file=sys.stderr)
+        return 2
+
+    watcher = Watcher(folders, args.workers, args.max_pending or 2 * args.workers,
+                      args.interval, args.settle)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: watcher.stopping.set())
+    watcher.run(once=args.once)
+    return 1 if args.once and (watcher.counts['failed'] or watcher.counts['not_moved']) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,132 @@
+"""Local stand-in for a webhook receiver (e.g. an n8n webhook trigger).
+
+Accepts the completion callbacks the service POSTs for jobs sent with a
+callback_url and prints one JSON line per delivery. It can refuse the first
+deliveries of every job to exercise the service's retries, all without
+network access:
+
+    python webhook_receiver.py                          # listen on 127.0.0.1:5055
+    python webhook_receiver.py --fail 2                 # 503 twice per job, then accept
+    python webhook_receiver.py --secret s3cret -o callbacks.jsonl
+
+Then send a job with "callback_url": "http://127.0.0.1:5055/callback".
+test_webhooks.py starts it in-process through Receiver.
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Receiver:
+    """Callback server on a background thread that records what it receives"""
+
+    def __init__(self, host='127.0.0.1', port=0, fail=0, secret=None, on_delivery=None):
+        self.fail = fail
+        self.secret = secret
+        self.on_delivery = on_delivery
+        self.received = []  # accepted deliveries
+        self.refused = Counter()  # job id -> deliveries answered with 503
+        self.connections = set()  # client (host, port) pairs seen
+        self._condition = threading.Condition()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/callback'
+
+    def _handler(self):
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive, so connection reuse is visible
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                job_id = self.headers.get('X-Watermark-Job')
+                with receiver._condition:
+                    receiver.connections.add(self.client_address)
+                    refuse = receiver.refused[job_id] < receiver.fail
+                    if refuse:
+                        receiver.refused[job_id] += 1
+                if refuse:
+                    return self._respond(503, {'error': 'refused by --fail'})
+
+                record = {'job_id': job_id, 'path': self.path, 'received_at': time.time(),
+                          'payload': json.loads(body)}
+                if receiver.secret:
+                    expected = hmac.new(receiver.secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+                    record['signature_ok'] = hmac.compare_digest(
+                        self.headers.get('X-Watermark-Signature', ''), f'sha256={expected}')
+                with receiver._condition:
+                    receiver.received.append(record)
+                    receiver._condition.notify_all()
+                if receiver.on_delivery:
+                    receiver.on_delivery(record)
+                self._respond(200, {'ok': True})
+
+            def _respond(self, status, payload):
+                body = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='webhook-receiver', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def wait(self, count, timeout=10):
+        """The first `count` deliveries, waiting up to timeout seconds for them"""
+        with self._condition:
+            self._condition.wait_for(lambda: len(self.received) >= count, timeout)
+            return list(self.received[:count])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Record watermark job callbacks locally')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--fail', type=int, default=0, help='answer 503 this many times per job first')
+    parser.add_argument('--secret', help='check X-Watermark-Signature with WATERMARK_WEBHOOK_SECRET')
+    parser.add_argument('-o', '--output', help='append deliveries to this JSONL file instead of stdout')
+    args = parser.parse_args(argv)
+
+    output = open(args.output, 'a') if args.output else sys.stdout
+
+    def record(delivery):
+        # Keep the log readable: image data is replaced by its length
+        result = delivery['payload'].get('result') or {}
+        if 'image' in result:
+            result['image'] = f"<{len(result['image'])} base64 chars>"
+        output.write(json.dumps(delivery) + '\n')
+        output.flush()
+
+    receiver = Receiver(args.host, args.port, args.fail, args.secret, on_delivery=record)
+    print(f"📬 Listening on {receiver.url}", file=sys.stderr)
+    try:
+        receiver.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,239 @@
+"""Completion callbacks for asynchronous /watermark jobs.
+
+Notifications wait in a bounded in-memory outbox and are POSTed by a few
+delivery threads. Each thread keeps one keep-alive connection per callback
+host, so a busy receiver is not paying a TCP (and TLS) handshake per job.
+Failed deliveries (connection errors, 429 and 5xx) are retried with
+exponential backoff and jitter. A slot in the outbox is reserved when a
+job is accepted, so a full outbox turns new jobs away rather than dropping
+notifications for jobs that already ran.
+
+Callbacks only go to public addresses unless the host is listed in
+WATERMARK_WEBHOOK_ALLOWED_HOSTS or WATERMARK_WEBHOOK_ALLOW_PRIVATE is set,
+so a job cannot make the service POST to its own network. The address is
+checked when the job is accepted and again on the connected socket, which
+also covers a DNS answer that changes in between.
+"""
+import hashlib
+import heapq
+import hmac
+import http.client
+import ipaddress
+import itertools
+import json
+import os
+import random
+import socket
+import threading
+import time
+import urllib.parse
+
+from profiling import get_json_logger, log_event
+
+# Jobs accepted but not yet notified, plus notifications awaiting delivery
+OUTBOX_SIZE = int(os.environ.get('WATERMARK_WEBHOOK_OUTBOX', 1000))
+DELIVERY_WORKERS = int(os.environ.get('WATERMARK_WEBHOOK_WORKERS', 2))
+MAX_ATTEMPTS = int(os.environ.get('WATERMARK_WEBHOOK_MAX_ATTEMPTS', 6))
+# Delay before retry n is BACKOFF * 2^(n-1) seconds, jittered and capped
+BACKOFF_SECONDS = float(os.environ.get('WATERMARK_WEBHOOK_BACKOFF', '1'))
+MAX_BACKOFF_SECONDS = float(os.environ.get('WATERMARK_WEBHOOK_MAX_BACKOFF', '60'))
+TIMEOUT_SECONDS = float(os.environ.get('WATERMARK_WEBHOOK_TIMEOUT', '10'))
+# When set, each body is signed: X-Watermark-Signature: sha256=<hex HMAC>
+SECRET = os.environ.get('WATERMARK_WEBHOOK_SECRET')
+# Kept-alive connections unused for this long are closed
+IDLE_SECONDS = float(os.environ.get('WATERMARK_WEBHOOK_IDLE_TIMEOUT', '30'))
+# Hosts trusted whatever they resolve to; any other host must be public
+ALLOWED_HOSTS = {h.strip().lower() for h in os.environ.get('WATERMARK_WEBHOOK_ALLOWED_HOSTS', '').split(',')
+                 if h.strip()}
+ALLOW_PRIVATE = os.environ.get('WATERMARK_WEBHOOK_ALLOW_PRIVATE', 'false').lower() in ('1', 'true', 'yes')
+
+RETRY_STATUSES = (408, 429)
+
+logger = get_json_logger('watermark.webhooks')
+
+_condition = threading.Condition()
+_outbox = []  # heap of (due, sequence, delivery)
+_sequence = itertools.count()
+_claimed = 0  # reserved slots, queued deliveries and deliveries in progress
+_workers = []
+_stats = {'accepted': 0, 'rejected': 0, 'delivered': 0, 'retried': 0, 'failed': 0}
+
+
+def _trusted(host):
+    return ALLOW_PRIVATE or host.lower() in ALLOWED_HOSTS
+
+
+def _check_address(host, address):
+    """Raise ValueError for a loopback, private, link-local or otherwise non-public address"""
+    ip = ipaddress.ip_address(address.split('%')[0])
+    if ip.version == 6 and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    if not ip.is_global:
+        raise ValueError(f'callback_url host {host} is not a public address ({ip})')
+
+
+def validate_url(url):
+    """Raise ValueError unless url is an absolute http(s) URL to an allowed host"""
+    parsed = urllib.parse.urlsplit(url) if isinstance(url, str) else None
+    try:
+        port = parsed.port if parsed is not None else None
+    except ValueError:
+        parsed = None
+    if parsed is None or parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        raise ValueError('callback_url must be an absolute http:// or https:// URL')
+    if not _trusted(parsed.hostname):
+        try:
+            addresses = {info[4][0] for info in socket.getaddrinfo(parsed.hostname, port or 443,
+                                                                   type=socket.SOCK_STREAM)}
+        except OSError as e:
+            raise ValueError(f'callback_url host {parsed.hostname} cannot be resolved: {e}')
+        for address in addresses:
+            _check_address(parsed.hostname, address)
+    return url
+
+
+def reserve():
+    """Claim an outbox slot for a notification sent later; False when full"""
+    global _claimed
+    with _condition:
+        if _claimed >= OUTBOX_SIZE:
+            _stats['rejected'] += 1
+            return False
+        _claimed += 1
+        _stats['accepted'] += 1
+        return True
+
+
+def release():
+    """Give back a slot taken with reserve() when no notification will be sent"""
+    global _claimed
+    with _condition:
+        _claimed -= 1
+        _stats['failed'] += 1
+
+
+def send(url, payload, job_id=None):
+    """Queue a notification on a slot taken with reserve()"""
+    body = json.dumps(payload, default=str).encode('utf-8')
+    headers = {'Content-Type': 'application/json', 'User-Agent': 'watermark-service'}
+    if job_id:
+        headers['X-Watermark-Job'] = str(job_id)
+    if SECRET:
+        signature = hmac.new(SECRET.encode('utf-8'), body, hashlib.sha256).hexdigest()
+        headers['X-Watermark-Signature'] = f'sha256={signature}'
+    delivery = {'url': url, 'body': body, 'headers': headers, 'job_id': job_id, 'attempts': 0}
+    _start_workers()
+    with _condition:
+        heapq.heappush(_outbox, (time.monotonic(), next(_sequence), delivery))
+        _condition.notify()
+
+
+def _start_workers():
+    with _condition:
+        if _workers:
+            return
+        for index in range(max(1, DELIVERY_WORKERS)):
+            worker = threading.Thread(target=_deliver_forever, name=f'webhook-{index}', daemon=True)
+            worker.start()
+            _workers.append(worker)
+
+
+def backoff(attempt):
+    """Seconds to wait after failed attempt number `attempt` (1-based)"""
+    delay = min(MAX_BACKOFF_SECONDS, BACKOFF_SECONDS * 2 ** (attempt - 1))
+    return delay * random.uniform(0.5, 1.0)
+
+
+def _connect(url):
+    """A new connection to url's host, refused if it reached a non-public address"""
+    connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+    connection = connection_class(url.hostname, url.port, timeout=TIMEOUT_SECONDS)
+    connection.connect()
+    if not _trusted(url.hostname):
+        try:
+            _check_address(url.hostname, connection.sock.getpeername()[0])
+        except ValueError:
+            connection.close()
+            raise
+    return connection
+
+
+def _close_idle(connections):
+    """Close connections idle for IDLE_SECONDS; when the next one will be due"""
+    now = time.monotonic()
+    for key, (connection, last_used) in list(connections.items()):
+        if now - last_used >= IDLE_SECONDS:
+            connection.close()
+            del connections[key]
+    return min((last_used + IDLE_SECONDS for _, last_used in connections.values()), default=None)
+
+
+def _post(connections, delivery):
+    """One delivery attempt: (HTTP status, Retry-After seconds), raising on network errors"""
+    url = urllib.parse.urlsplit(delivery['url'])
+    key = (url.scheme, url.hostname, url.port)
+    connection = connections[key][0] if key in connections else _connect(url)
+    connections[key] = (connection, time.monotonic())
+    path = url.path or '/'
+    if url.query:
+        path += '?' + url.query
+    try:
+        connection.request('POST', path, body=delivery['body'], headers=delivery['headers'])
+        response = connection.getresponse()
+        response.read()  # drain so the connection can be reused
+    except Exception:
+        connection.close()
+        del connections[key]
+        raise
+    if response.will_close:
+        connection.close()
+        del connections[key]
+    retry_after = response.getheader('Retry-After', '')
+    return response.status, float(retry_after) if retry_after.isdigit() else None
+
+
+def _deliver_forever():
+    global _claimed
+    connections = {}  # (scheme, host, port) -> (kept-alive connection, last used), per thread
+    while True:
+        with _condition:
+            while not _outbox or _outbox[0][0] > time.monotonic():
+                # Wake for the next due delivery or the next idle connection to close
+                due = [d for d in (_outbox[0][0] if _outbox else None, _close_idle(connections)) if d is not None]
+                _condition.wait(min(due) - time.monotonic() if due else None)
+            _, _, delivery = heapq.heappop(_outbox)
+
+        delivery['attempts'] += 1
+        retry_after = None
+        try:
+            status, retry_after = _post(connections, delivery)
+            error = None if status < 400 else f'HTTP {status}'
+            retryable = status >= 500 or status in RETRY_STATUSES
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'
+            # A refused address (or other bad URL) will not get better
+            retryable = not isinstance(e, ValueError)
+
+        fields = {'job_id': delivery['job_id'], 'url': delivery['url'], 'attempts': delivery['attempts']}
+        if error and retryable and delivery['attempts'] < MAX_ATTEMPTS:
+            delay = max(backoff(delivery['attempts']), retry_after or 0)
+            log_event(logger, 'webhook_retry', error=error, retry_in_s=round(delay, 2), **fields)
+            with _condition:
+                _stats['retried'] += 1
+                heapq.heappush(_outbox, (time.monotonic() + delay, next(_sequence), delivery))
+                _condition.notify()
+            continue
+
+        with _condition:
+            _claimed -= 1
+            _stats['failed' if error else 'delivered'] += 1
+        if error:
+            log_event(logger, 'webhook_failed', error=error, **fields)
+        else:
+            log_event(logger, 'webhook_delivered', **fields)
+
+
+def snapshot():
+    """Outbox usage and delivery counters for the /metrics endpoint"""
+    with _condition:
+        return dict(_stats, outbox=_claimed, queued=len(_outbox), max_outbox=OUTBOX_SIZE)